@@ -0,0 +1,96 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from reservoir import SparseESN, READOUT_SOLVERS, solve_readout
+
+# Timings are kept out of the test suite, run with
+#     python benchmarks.py
+folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                      'UIUCDATA')
+
+
+def readout_solver_benchmark(n_reservoir=300, trainlen=3000):
+    """
+    This function times each readout solver on reservoir states driven
+    by the UIUC demand data, and prints the time and training RMSE of
+    each solver.
+    """
+    demand = pd.read_csv(os.path.join(folder, 'uiuc_demand_data.csv'),
+                         usecols=['kw']).kw.values[-trainlen:]
+    demand = demand / np.linalg.norm(demand, ord=np.inf)
+
+    esn = SparseESN(1, 1, n_reservoir=n_reservoir, sparsity=0.9,
+                    spectral_radius=0.9, random_state=85)
+    states = esn.harvest(np.ones((trainlen, 1)), demand)
+    X = np.hstack((states, np.ones((trainlen, 1))))
+
+    for solver in READOUT_SOLVERS:
+        tic = time.perf_counter()
+        W_out = solve_readout(X, demand, solver, ridge=1e-8)
+        toc = time.perf_counter()
+        error = np.sqrt(np.mean((X @ W_out.T - demand[:, None])**2))
+        print(f"{solver}: {toc - tic:0.4f} seconds, training RMSE {error}")
+
+    return
+
+
+# Reservoir parameters whose forecast error on each UIUC series is
+# within twice the error of repeating the previous day
+float32_params = {
+    'uiuc_demand_data': {'spectral_radius': 0.95, 'noise': 1e-4,
+                         'ridge': 1e-4},
+    'solarfarm_data': {'spectral_radius': 0.8, 'noise': 1e-2, 'ridge': 1.0},
+    'railsplitter_data': {'spectral_radius': 0.8, 'noise': 1e-2,
+                          'ridge': 1.0}}
+
+
+def float32_benchmark(trainlen=2000, future=24, days=10):
+    """
+    This function compares the float32 and float64 prediction errors
+    and times of a SparseESN on the three UIUC data sets, and prints
+    them. Each network forecasts the next future steps of several
+    consecutive days, trained on the trainlen steps before each one.
+    The MSE of repeating the previous day is printed as a baseline.
+    The results are tabulated in docs/reservoir.rst.
+    """
+    for name, options in float32_params.items():
+        series = pd.read_csv(os.path.join(folder, name + '.csv'),
+                             usecols=['kw']).kw.values
+        series = series[-(trainlen + future * days):]
+        series = series / np.linalg.norm(series, ord=np.inf)
+
+        errors = {}
+        for dtype in [np.float64, np.float32]:
+            tic = time.perf_counter()
+            errors[dtype], persistence = [], []
+            for day in range(days):
+                start = day * future
+                train = series[start:start + trainlen, None]
+                test = series[start + trainlen:start + trainlen + future,
+                              None]
+                esn = SparseESN(1, 1, n_reservoir=500, sparsity=0.9,
+                                spectral_radius=options['spectral_radius'],
+                                noise=options['noise'], random_state=85,
+                                dtype=dtype)
+                states = esn.harvest(np.ones((trainlen, 1)), train)
+                esn.fit_readout(states, np.ones((trainlen, 1)), train,
+                                ridge=options['ridge'])
+                prediction = esn.predict(np.ones((future, 1)))
+                errors[dtype].append(np.mean((prediction - test)**2))
+                persistence.append(np.mean((train[-future:] - test)**2))
+            toc = time.perf_counter()
+            errors[dtype] = np.mean(errors[dtype])
+            print(f"{name} {np.dtype(dtype).name}: "
+                  f"{toc - tic:0.4f} seconds, MSE {errors[dtype]}")
+
+        difference = abs(errors[np.float32] / errors[np.float64] - 1)
+        print(f"{name}: previous day MSE {np.mean(persistence)}, "
+              f"float32 relative difference {difference:0.1e}")
+
+    return
+
+
+if __name__ == "__main__":
+    readout_solver_benchmark()
+    float32_benchmark()
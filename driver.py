@@ -1,7 +1,8 @@
 from sunrise import generate_elevation_series
-from optimizers import grid_optimizer
-from tools import MSE, MAE, NRMSE, MASE
-from tools import esn_prediction, optimal_values, param_string
+from optimizers import grid_optimizer, incremental_optimizer
+from tools import error_metrics
+from tools import esn_prediction, esn_scenario, optimal_values, param_string
+from models import save_model
 import time
 import os
 import getopt
@@ -81,6 +82,7 @@ if __name__ == "__main__":
     # =============================================================================
     # Set Up the Training Data
     # =============================================================================
+
     X_in = []
     data_norms = []
     datafile_name = None
@@ -89,6 +91,8 @@ if __name__ == "__main__":
     list_keys = None
     sun_elevation = None
     save_prefix = None
+    resume = False
+    incremental = False
     options_dict = {'-u': 'windspeed',
                     '-w': 'wettemp',
                     '-d': 'drytemp',
@@ -100,7 +104,7 @@ if __name__ == "__main__":
 
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-                                   'uwdpheH:i:f:oS:',
+                                   'uwdpheH:i:f:oS:rI',
                                    ['infile=', 'altfile', 'outfile=',
                                     'save_prefix='])
     except getopt.GetoptError:
@@ -140,6 +144,14 @@ if __name__ == "__main__":
         if opt in ('-S', '--save_prefix'):
             save_prefix = arg
 
+        if opt in ('-r'):
+            # skip the cells checkpointed by an interrupted run
+            resume = True
+
+        if opt in ('-I'):
+            # only search around the optima saved by the last run
+            incremental = True
+
         if opt in ('-H'):
             params['window'] = int(arg)
             # params['future'] = int(arg)
@@ -200,13 +212,23 @@ if __name__ == "__main__":
 
     print('Optimizing spectral radius and regularization')
     tic = time.perf_counter()
-    radiusxnoise_loss = grid_optimizer(X_in.T,
-                                       params,
-                                       args=['rho', 'noise'],
-                                       xset=radius_set,
-                                       yset=noise_set,
-                                       verbose=True,
-                                       save_path=save_prefix)
+    if incremental:
+        radiusxnoise_loss, _ = incremental_optimizer(
+            X_in.T,
+            params,
+            {'rho': radius_set, 'noise': noise_set},
+            previous='./data/' + save_prefix + '_rho_noise_loss.npy',
+            verbose=True,
+            save_path=save_prefix)
+    else:
+        radiusxnoise_loss = grid_optimizer(X_in.T,
+                                           params,
+                                           args=['rho', 'noise'],
+                                           xset=radius_set,
+                                           yset=noise_set,
+                                           verbose=True,
+                                           save_path=save_prefix,
+                                           resume=resume)
 
     toc = time.perf_counter()
     elapsed = toc - tic
@@ -221,13 +243,24 @@ if __name__ == "__main__":
 
     print('Optimizing network size and sparsity')
     tic = time.perf_counter()
-    sizexsparsity_loss = grid_optimizer(X_in.T,
-                                        params,
-                                        args=['n_reservoir', 'sparsity'],
-                                        xset=reservoir_set,
-                                        yset=sparsity_set,
-                                        verbose=True,
-                                        save_path=save_prefix)
+    if incremental:
+        sizexsparsity_loss, _ = incremental_optimizer(
+            X_in.T,
+            params,
+            {'n_reservoir': reservoir_set, 'sparsity': sparsity_set},
+            previous=('./data/' + save_prefix
+                      + '_n_reservoir_sparsity_loss.npy'),
+            verbose=True,
+            save_path=save_prefix)
+    else:
+        sizexsparsity_loss = grid_optimizer(X_in.T,
+                                            params,
+                                            args=['n_reservoir', 'sparsity'],
+                                            xset=reservoir_set,
+                                            yset=sparsity_set,
+                                            verbose=True,
+                                            save_path=save_prefix,
+                                            resume=resume)
 
     toc = time.perf_counter()
     elapsed = toc - tic
@@ -244,20 +277,32 @@ if __name__ == "__main__":
 
     print('Optimizing training length')
     tic = time.perf_counter()
-    trainlen_loss = grid_optimizer(X_in.T,
-                                   params,
-                                   args=['trainlen'],
-                                   xset=trainingLengths,
-                                   verbose=True,
-                                   save_path=save_prefix)
+    if incremental:
+        # the earlier run had fewer training lengths
+        previous = np.load('./data/' + save_prefix + '_trainlen_loss.npy')
+        previous_lengths = 5000 + 300 * np.arange(len(previous))
+        trainlen_loss, _ = incremental_optimizer(
+            X_in.T,
+            params,
+            {'trainlen': trainingLengths},
+            previous=previous,
+            previous_space={'trainlen': previous_lengths},
+            verbose=True,
+            save_path=save_prefix)
+    else:
+        trainlen_loss = grid_optimizer(X_in.T,
+                                       params,
+                                       args=['trainlen'],
+                                       xset=trainingLengths,
+                                       verbose=True,
+                                       save_path=save_prefix,
+                                       resume=resume)
     toc = time.perf_counter()
     elapsed = toc - tic
     print(f"This simulation took {elapsed:0.02f} seconds")
     print(f"This simulation took {elapsed/60:0.02f} minutes")
 
-    minloss = np.min(trainlen_loss)
-    index_min = np.where(trainlen_loss == minloss)
-    l_opt = trainingLengths[index_min][0]
+    l_opt = trainingLengths[np.nanargmin(trainlen_loss)]
     params['trainlen'] = l_opt
 
 # =============================================================================
@@ -286,17 +331,17 @@ if __name__ == "__main__":
 
     futureTotal = params['future']
 
-    rmse = MSE(init_pred, X_in.T[-futureTotal:])
-    mae = MAE(init_pred, X_in.T[-futureTotal:])
-    nrmse = NRMSE(init_pred, X_in.T[-futureTotal:])
-
     startTrain = params['trainlen']
     endTrain = futureTotal
     trainset = X_in.T[-startTrain:-endTrain]
-    mase = MASE(init_pred, X_in.T[-futureTotal:],
-                ntargets=1,
-                training=trainset,
-                nsteps=params['window'])
+    # the first variable is the target
+    metrics = error_metrics(init_pred[:, :1], X_in.T[-futureTotal:, :1],
+                            training=trainset[:, :1],
+                            nsteps=params['window'])
+    rmse = metrics['MSE'][0]
+    mae = metrics['MAE'][0]
+    nrmse = metrics['NRMSE'][0]
+    mase = metrics['MASE'][0]
 # =============================================================================
 # Plot Prediction
 # =============================================================================
@@ -356,3 +401,10 @@ if __name__ == "__main__":
         file.write(f"Normalized RMSE: {nrmse}\n")
         file.write(f"Mean Absolute Scaled Error: {mase}\n")
         file.write("\n")
+
+# =============================================================================
+# Save the Model
+# =============================================================================
+    # scheduled forecasts start from the model trained on the latest data
+    _, esn = esn_scenario(X_in.T[-params['trainlen']:], params)
+    save_model('./models/' + save_prefix, esn, params, data_norms)
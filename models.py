@@ -0,0 +1,394 @@
+import json
+import os
+import shutil
+from itertools import chain
+import numpy as np
+import scipy.sparse as sparse
+from scipy.linalg import cho_factor, cho_solve
+from scipy.linalg.blas import dger
+from reservoir import SparseESN, _as_2d
+
+# Version of the model format, checked when loading
+MODEL_VERSION = 1
+
+# Arrays of a trained network that are saved as separate .npy files, so
+# that load_model can memory-map them.
+MODEL_ARRAYS = ('W_in', 'W_feedb', 'W_out',
+                'laststate', 'lastinput', 'lastoutput')
+
+
+def _to_json(value):
+    """
+    This function converts the numpy values of params and data_norms
+    into JSON types.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot save {type(value).__name__} in a model")
+
+
+def save_model(path, esn, params, data_norms=None):
+    """
+    This function saves a trained network so that forecasts can start
+    from it without refitting, see load_model. The model is a
+    directory with one .npy file per array and a model.json file with
+    the network sizes, params and data_norms. The recurrent weights are
+    saved as CSR arrays when they are sparse.
+
+    The model is written to a temporary directory that then replaces
+    the old one, so a model is never a mix of two saves and no array of
+    an earlier save is left behind. Only a missing or empty directory,
+    or one holding a saved model, is replaced, since any other file in
+    it would be deleted.
+
+    A pyESN network built by tools.build_esn has no input or teacher
+    scaling, so it is saved the same way and loads as a SparseESN that
+    predicts the same values.
+
+    Parameters
+    ----------
+    path : string
+        The model directory. It is created if needed. An existing
+        directory must be empty or hold a model, which is replaced
+        with all its files.
+    esn : SparseESN or pyESN.pyESN.ESN
+        The trained network, e.g. the one returned by
+        tools.esn_scenario.
+    params : dictionary
+        The parameters the network was built and trained with. See
+        tools.esn_prediction.
+    data_norms : list or None
+        The normalization constant of each variable, the data being
+        divided by them before training, as in driver.py.
+    """
+    assert(hasattr(esn, 'W_out')), "The network has not been trained."
+    if data_norms is not None:
+        assert(len(data_norms) == esn.n_outputs
+               ), "There must be one norm per output."
+
+    W = esn.W
+    if sparse.issparse(W):
+        arrays = {'W_data': W.data, 'W_indices': W.indices,
+                  'W_indptr': W.indptr}
+    else:
+        arrays = {'W': W}
+    for name in MODEL_ARRAYS:
+        arrays[name] = np.asarray(getattr(esn, name))
+    # the prediction continues the state noise from here
+    rng_state = esn.random_state_.get_state()
+    arrays['rng_keys'] = rng_state[1]
+
+    path = os.fspath(path)
+    if os.path.exists(path):
+        assert(os.path.isdir(path)), f"{path} is not a directory."
+        assert(not os.listdir(path)
+               or os.path.exists(os.path.join(path, 'model.json'))
+               ), f"{path} is not empty and does not hold a model."
+    temporary = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary, name + '.npy'), array)
+
+    meta = {'version': MODEL_VERSION,
+            'shape': list(W.shape),
+            'sparse': sparse.issparse(W),
+            'spectral_radius': esn.spectral_radius,
+            'sparsity': esn.sparsity,
+            'noise': esn.noise,
+            'rng_state': list(rng_state[2:]),
+            'params': params,
+            'data_norms': data_norms}
+    # written last, so a model without it is incomplete
+    with open(os.path.join(temporary, 'model.json'), 'w') as f:
+        json.dump(meta, f, default=_to_json, indent=1)
+
+    # a directory cannot replace a non-empty one, so the old model is
+    # moved aside first
+    old = f"{path}.{os.getpid()}.old"
+    if os.path.exists(path):
+        os.replace(path, old)
+    os.replace(temporary, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+    return
+
+
+def load_model(path, mmap=True):
+    """
+    This function loads a model saved by save_model.
+
+    Parameters
+    ----------
+    path : string
+        The model directory.
+    mmap : boolean
+        Memory-map the arrays read-only instead of reading them, so
+        that loading takes the same time whatever the network size.
+
+    Returns
+    -------
+    esn : SparseESN
+        The trained network, ready to predict from its last training
+        state.
+    params : dictionary
+        The parameters the network was trained with.
+    data_norms : list or None
+        The normalization constant of each variable.
+    """
+    with open(os.path.join(path, 'model.json')) as f:
+        meta = json.load(f)
+    assert(meta['version'] == MODEL_VERSION
+           ), f"Unknown model version {meta['version']}"
+
+    mmap_mode = 'r' if mmap else None
+
+    def load(name):
+        return np.load(os.path.join(path, name + '.npy'),
+                       mmap_mode=mmap_mode)
+
+    if meta['sparse']:
+        W = sparse.csr_matrix((load('W_data'), load('W_indices'),
+                               load('W_indptr')),
+                              shape=tuple(meta['shape']))
+    else:
+        W = load('W')
+
+    random_state = np.random.RandomState()
+    random_state.set_state(('MT19937', np.array(load('rng_keys')),
+                            *meta['rng_state']))
+
+    esn = SparseESN.from_weights(W, load('W_in'), load('W_feedb'),
+                                 meta['spectral_radius'],
+                                 sparsity=meta['sparsity'],
+                                 noise=meta['noise'],
+                                 random_state=random_state)
+    esn.W_out = load('W_out')
+    esn.laststate = load('laststate')
+    esn.lastinput = load('lastinput')
+    esn.lastoutput = load('lastoutput')
+
+    return esn, meta['params'], meta['data_norms']
+
+
+def model_forecast(path, future=None, mmap=True):
+    """
+    This function forecasts from a saved model, continuing from the
+    end of its training data. The forecast is scaled back by the saved
+    data_norms.
+
+    Parameters
+    ----------
+    path : string
+        The model directory. See save_model.
+    future : int or None
+        The number of steps to forecast. None uses params['future'].
+    mmap : boolean
+        Memory-map the model arrays. See load_model.
+
+    Returns
+    -------
+    forecast : numpy array
+        The (future, n_outputs) forecast.
+    """
+    esn, params, data_norms = load_model(path, mmap=mmap)
+    if future is None:
+        future = params['future']
+
+    forecast = esn.predict(np.ones((future, esn.n_inputs)))
+    if data_norms is not None:
+        forecast = forecast * np.asarray(data_norms)
+
+    return forecast
+
+
+class OnlineForecaster():
+    """
+    A forecaster that learns from one observation at a time. Each
+    observation advances the reservoir by one teacher forced step and
+    updates the readout by recursive least squares, so an update costs
+    O(n_features**2), with n_features = n_reservoir + n_inputs, however
+    long the history. The inverse correlation matrix takes
+    n_features**2 floats.
+
+    With a forgetting factor of 1 the readout is the ridge solution on
+    every observation so far. A smaller factor weighs an observation k
+    steps old by forgetting**k, which follows slow drifts in the data.
+
+    As in tools.esn_prediction, the inputs are constant ones unless
+    given.
+
+    Parameters
+    ----------
+    esn : SparseESN
+        The network. It keeps the current state, last output and
+        readout. A trained network, e.g. from load_model, is continued
+        from its last training state with the identity as inverse
+        correlation matrix scaled by 1 / ridge; fit gives the exact one.
+    forgetting : float
+        The forgetting factor, in (0, 1].
+    ridge : float
+        The Tikhonov regularization the readout starts from.
+
+    Example
+    -------
+    >>> forecaster = OnlineForecaster(esn, forgetting=0.999)
+    >>> forecaster.fit(history)
+    >>> for value in new_values:
+    ...     forecaster.update(value)
+    ...     next_day = forecaster.forecast(24)
+    """
+
+    def __init__(self, esn, forgetting=1.0, ridge=1e-4):
+        assert(0 < forgetting <= 1), "The forgetting factor must be in (0, 1]."
+        self.esn = esn
+        self.forgetting = forgetting
+        self.ridge = ridge
+
+        n_features = esn.n_reservoir + esn.n_inputs
+        self.P = np.eye(n_features) / ridge
+        # the readout is updated in place, so the network always
+        # predicts with the latest one
+        if hasattr(esn, 'W_out'):
+            esn.W_out = np.array(esn.W_out, dtype=np.float64)
+            esn.lastoutput = np.array(esn.lastoutput, dtype=esn.dtype)
+            self.started = True
+        else:
+            esn.W_out = np.zeros((esn.n_outputs, n_features))
+            esn.laststate = np.zeros(esn.n_reservoir, dtype=esn.dtype)
+            esn.lastinput = np.zeros(esn.n_inputs, dtype=esn.dtype)
+            esn.lastoutput = np.zeros(esn.n_outputs, dtype=esn.dtype)
+            self.started = False
+
+    def _inputs(self, inputs, n_steps):
+        """
+        This function returns the (n_steps, n_inputs) inputs, ones by
+        default, in the precision of the network.
+        """
+        if inputs is None:
+            inputs = np.ones((n_steps, self.esn.n_inputs))
+
+        return _as_2d(np.asarray(inputs)).astype(self.esn.dtype)
+
+    def fit(self, outputs, inputs=None):
+        """
+        This function trains the forecaster on a history in one batch,
+        from a zero state. The readout and inverse correlation matrix
+        are the ones the same observations would give one update at a
+        time, at the cost of a single ridge solve.
+
+        Parameters
+        ----------
+        outputs : numpy array
+            The (n_samples, n_outputs) observed history.
+        inputs : numpy array or None
+            The (n_samples, n_inputs) input signal. Ones by default.
+
+        Returns
+        -------
+        self : OnlineForecaster
+            The trained forecaster.
+        """
+        esn = self.esn
+        outputs = _as_2d(np.asarray(outputs, dtype=np.float64))
+        n_samples = len(outputs)
+        inputs = self._inputs(inputs, n_samples)
+        n_features = esn.n_reservoir + esn.n_inputs
+
+        # an observation k steps old is weighted by forgetting**k, and
+        # the initial regularization as if it came before the first
+        weights = self.forgetting ** np.arange(n_samples - 1, -1, -1)
+        XtX = (self.ridge * self.forgetting**n_samples) * np.eye(n_features)
+        XtY = np.zeros((n_features, esn.n_outputs))
+        state = np.zeros(esn.n_reservoir, dtype=esn.dtype)
+        blocks = chain([(-1, state[None, :])],
+                       esn._drive(state, inputs[1:],
+                                  outputs[:-1].astype(esn.dtype)))
+        for start, block in blocks:
+            start += 1
+            stop = start + len(block)
+            X = np.hstack((block, inputs[start:stop])).astype(np.float64)
+            XtX += (X.T * weights[start:stop]) @ X
+            XtY += (X.T * weights[start:stop]) @ outputs[start:stop]
+
+        factor = cho_factor(XtX)
+        self.P = np.ascontiguousarray(cho_solve(factor,
+                                                np.eye(n_features)))
+        esn.W_out = cho_solve(factor, XtY).T
+        esn.laststate = block[-1]
+        esn.lastinput = inputs[-1]
+        esn.lastoutput = outputs[-1].astype(esn.dtype)
+        self.started = True
+
+        return self
+
+    def update(self, observation, inputs=None):
+        """
+        This function learns from the next observation.
+
+        Parameters
+        ----------
+        observation : numpy array
+            The (n_outputs,) observed values.
+        inputs : numpy array or None
+            The (n_inputs,) input at this step. Ones by default.
+
+        Returns
+        -------
+        error : numpy array
+            The (n_outputs,) error of the one step prediction made
+            before the update.
+        """
+        esn = self.esn
+        observation = np.asarray(observation,
+                                 dtype=np.float64).reshape(esn.n_outputs)
+        inputs = self._inputs(inputs, 1)[0]
+
+        # the first observation of an untrained forecaster is paired
+        # with the zero state, as in SparseESN.harvest
+        if self.started:
+            esn.laststate = esn._update(esn.laststate, inputs,
+                                        esn.lastoutput)
+        x = np.concatenate((esn.laststate, inputs)).astype(np.float64)
+
+        Px = self.P @ x
+        gain = Px / (self.forgetting + x @ Px)
+        error = observation - esn.W_out @ x
+        esn.W_out += np.outer(error, gain)
+        # rank one update of P in place, P.T being its Fortran view
+        self.P = dger(-1.0, Px, gain, a=self.P.T, overwrite_a=True).T
+        if self.forgetting < 1:
+            self.P /= self.forgetting
+
+        esn.lastinput = inputs
+        esn.lastoutput = observation.astype(esn.dtype)
+        self.started = True
+
+        return error
+
+    def forecast(self, future, inputs=None):
+        """
+        This function forecasts the next steps from the current state,
+        without changing it. The random state of the state noise is
+        restored afterwards, so forecasting does not change later
+        updates and forecasts.
+
+        Parameters
+        ----------
+        future : int
+            The number of steps to forecast.
+        inputs : numpy array or None
+            The (future, n_inputs) input signal. Ones by default.
+
+        Returns
+        -------
+        forecast : numpy array
+            The (future, n_outputs) forecast.
+        """
+        rng_state = self.esn.random_state_.get_state()
+        forecast = self.esn.predict(self._inputs(inputs, future))
+        self.esn.random_state_.set_state(rng_state)
+
+        return forecast
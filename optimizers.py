@@ -1,18 +1,348 @@
+import os
+import json
 import time
+import hashlib
+import itertools
+from collections import deque
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from mpl_toolkits import mplot3d
-from tools import MSE, optimal_values, esn_prediction
+from tools import MSE, partial_MSE, optimal_values
+from tools import esn_partial_prediction
+from tools import top_configurations
+from tools import esn_ridge_path, esn_trainlen_scan, esn_batch_prediction
+from parallel import shared_pool, get_shared
+from surrogate import GaussianProcess, propose_batch
 from pyESN.pyESN import ESN
 
 variables = {'n_reservoir': 'Reservoir Size',
              'sparsity': 'Sparsity',
              'rho': 'Spectral Radius',
              'noise': 'Noise',
+             'ridge': 'Ridge Regularization',
              'trainlen': 'Training Length'}
 
 
+def _cell_loss(data, params, index, settings, prune_above=None, ntargets=1,
+               cache_states=False):
+    """
+    This function evaluates one cell of a parameter grid.
+
+    Parameters
+    ----------
+    data : numpy array
+        The dataset. See grid_optimizer.
+    params : dictionary
+        The ESN parameters. See grid_optimizer. It is not modified.
+    index : tuple
+        The index of the cell in the loss array.
+    settings : dictionary
+        The parameter values of the cell.
+    prune_above : float or None
+        Stop predicting once the cell is certain to have a larger loss.
+        See esn_prediction.
+    ntargets : integer
+        The number of target variables being predicted.
+    cache_states : boolean
+        Use the state cache.
+
+    Returns
+    -------
+    losses : list
+        The (index, loss, pruned) of the cell. The loss of a pruned
+        cell is the partial loss of the windows it did predict. A
+        prediction that diverges to NaN has a NaN loss.
+    """
+    cell = dict(params, **settings)
+    predicted, n_predicted = esn_partial_prediction(
+        data, cell, prune_above=prune_above, ntargets=ntargets,
+        cache_states=cache_states)
+    pruned = n_predicted < cell['future']
+
+    return [(index, partial_MSE(predicted, data[-cell['future']:],
+                                n_predicted, ntargets),
+             pruned)]
+
+
+def _ridge_row_loss(data, params, index, settings, ridges, ntargets=1,
+                    cache_states=False):
+    """
+    This function evaluates a row of a parameter grid whose last axis
+    is the ridge regularization, from a single esn_ridge_path call.
+
+    Parameters
+    ----------
+    data : numpy array
+        The dataset. See grid_optimizer.
+    params : dictionary
+        The ESN parameters. See grid_optimizer. It is not modified.
+    index : tuple
+        The index of the row in the loss array.
+    settings : dictionary
+        The parameter values shared by the row.
+    ridges : list or numpy array
+        The ridge values of the row.
+    ntargets : integer
+        The number of target variables being predicted.
+    cache_states : boolean
+        Use the state cache.
+
+    Returns
+    -------
+    losses : list
+        The (index, loss, pruned) of each cell of the row.
+    """
+    cell = dict(params, **settings)
+    predictions = esn_ridge_path(data, cell, ridges,
+                                 cache_states=cache_states)
+
+    return [(index + (k,), MSE(predicted, data[-cell['future']:], ntargets),
+             False)
+            for k, predicted in enumerate(predictions)]
+
+
+def _trainlen_scan_loss(data, params, index, settings, trainlens, ntargets=1,
+                        cache_states=False):
+    """
+    This function evaluates a row of a parameter grid whose last axis
+    is the training length, from a single esn_trainlen_scan call.
+
+    Parameters
+    ----------
+    data : numpy array
+        The dataset. See grid_optimizer.
+    params : dictionary
+        The ESN parameters. See grid_optimizer. It is not modified.
+    index : tuple
+        The index of the row in the loss array.
+    settings : dictionary
+        The parameter values shared by the row.
+    trainlens : list or numpy array
+        The training lengths of the row.
+    ntargets : integer
+        The number of target variables being predicted.
+    cache_states : boolean
+        Use the state cache.
+
+    Returns
+    -------
+    losses : list
+        The (index, loss, pruned) of each cell of the row.
+    """
+    cell = dict(params, **settings)
+    predictions = esn_trainlen_scan(data, cell, trainlens,
+                                    cache_states=cache_states)
+
+    return [(index + (k,), MSE(predicted, data[-cell['future']:], ntargets),
+             False)
+            for k, predicted in enumerate(predictions)]
+
+
+def _batch_row_loss(data, params, index, settings, variable, values,
+                    ntargets=1, cache_states=False):
+    """
+    This function evaluates a row of a parameter grid with a single
+    esn_batch_prediction call, which advances the reservoirs of the
+    whole row together.
+
+    Parameters
+    ----------
+    data : numpy array
+        The dataset. See grid_optimizer.
+    params : dictionary
+        The ESN parameters. See grid_optimizer. It is not modified.
+    index : tuple
+        The index of the row in the loss array.
+    settings : dictionary
+        The parameter values shared by the row.
+    variable : string
+        The parameter that varies along the row.
+    values : list or numpy array
+        The values of the row.
+    ntargets : integer
+        The number of target variables being predicted.
+    cache_states : boolean
+        Must be False, batches harvest their own states.
+
+    Returns
+    -------
+    losses : list
+        The (index, loss, pruned) of each cell of the row.
+    """
+    assert(not cache_states), "Batched rows do not use the state cache."
+    cell = dict(params, **settings)
+    predictions = esn_batch_prediction(data, cell,
+                                       [{variable: value} for value in values])
+
+    return [(index + (k,), MSE(predicted, data[-cell['future']:], ntargets),
+             False)
+            for k, predicted in enumerate(predictions)]
+
+
+def _cell_key(params, settings, data_hash, ntargets=1, scanned=False):
+    """
+    This function builds the checkpoint key of a grid cell.
+
+    Parameters
+    ----------
+    params : dictionary
+        The ESN parameters. See grid_optimizer.
+    settings : dictionary
+        The parameter values of the cell.
+    data_hash : string
+        The digest of the dataset.
+    ntargets : integer
+        The number of target variables being predicted.
+    scanned : boolean
+        The cell is evaluated with esn_trainlen_scan.
+
+    Returns
+    -------
+    key : string
+        The cell parameters, dataset and scoring as a JSON string.
+    """
+    cell = dict(params, **settings)
+    for name, value in cell.items():
+        if isinstance(value, np.generic):
+            cell[name] = value.item()
+
+    return json.dumps({'params': cell,
+                       'data': data_hash,
+                       'ntargets': ntargets,
+                       'trainlen_scan': scanned}, sort_keys=True)
+
+
+def _data_hash(data):
+    """
+    This function returns a digest of the dataset, so that checkpointed
+    cells are only reused for the same data.
+    """
+    data = np.ascontiguousarray(data)
+    digest = hashlib.sha1(data.tobytes())
+    digest.update(repr((data.shape, data.dtype.str)).encode())
+
+    return digest.hexdigest()
+
+
+def read_checkpoint(path):
+    """
+    This function reads the cells checkpointed by grid_optimizer.
+
+    Parameters
+    ----------
+    path : string
+        The checkpoint file.
+
+    Returns
+    -------
+    cells : dictionary
+        The (loss, pruned) of each checkpointed cell, keyed by the cell
+        key. The loss of a pruned cell is only the partial loss. A cell
+        that was written more than once keeps its last record. An
+        incomplete last line, left by an interrupted run, is ignored.
+    """
+    cells = {}
+    if not os.path.exists(path):
+        return cells
+
+    with open(path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            cells[record['key']] = (record['loss'],
+                                    record.get('pruned', False))
+
+    return cells
+
+
+def _repair_checkpoint(path):
+    """
+    This function cuts an incomplete last line, left by an interrupted
+    run, off the checkpoint file, so that the next record appended to
+    it starts on a line of its own.
+
+    Parameters
+    ----------
+    path : string
+        The checkpoint file.
+    """
+    if not os.path.exists(path):
+        return
+
+    with open(path, 'rb+') as file:
+        content = file.read()
+        if content and not content.endswith(b'\n'):
+            file.truncate(content.rfind(b'\n') + 1)
+
+    return
+
+
+def _shared_task(func, *args, **kwargs):
+    """
+    This function runs a grid task in a pool worker on the data shared
+    by grid_optimizer.
+    """
+    return func(get_shared('data'), *args, **kwargs)
+
+
+def _evaluate(data, params, tasks, ntargets=1, cache_states=False,
+              n_jobs=1):
+    """
+    This function evaluates the tasks of a parameter grid, either in
+    this process or spread over a process pool, and yields the losses
+    in task order. The tasks are consumed lazily, with at most two
+    tasks per process submitted ahead of the results.
+
+    Parameters
+    ----------
+    data : numpy array
+        The dataset. See grid_optimizer.
+    params : dictionary
+        The ESN parameters. See grid_optimizer.
+    tasks : iterable
+        The (function, arguments) of each task. The function is called
+        with the data, params and the arguments, with ntargets and
+        cache_states as keywords, and returns a list of
+        (index, loss, pruned).
+    ntargets : integer
+        The number of target variables being predicted.
+    cache_states : boolean
+        Use the state cache of each process.
+    n_jobs : int
+        The number of processes.
+
+    Yields
+    ------
+    index, loss, pruned : tuple, float, boolean
+        The index and loss of each evaluated cell, and whether its
+        evaluation was cut short.
+    """
+    # a single task is not worth starting a pool for
+    tasks = iter(tasks)
+    head = list(itertools.islice(tasks, 2))
+    tasks = itertools.chain(head, tasks)
+    if n_jobs > 1 and len(head) > 1:
+        with shared_pool(n_jobs, data=data) as executor:
+            pending = deque()
+            for func, args in tasks:
+                pending.append(executor.submit(
+                    _shared_task, func, params, *args, ntargets=ntargets,
+                    cache_states=cache_states))
+                if len(pending) >= 2 * n_jobs:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+    else:
+        for func, args in tasks:
+            yield from func(data, params, *args, ntargets=ntargets,
+                            cache_states=cache_states)
+
+    return
+
+
 def grid_optimizer(
         data,
         params,
@@ -22,7 +352,15 @@ def grid_optimizer(
         ntargets=1,
         verbose=False,
         visualize=False,
-        save_path=None):
+        save_path=None,
+        cache_states=False,
+        trainlen_scan=False,
+        batch_rows=False,
+        n_jobs=1,
+        resume=False,
+        prune=False,
+        seeds=None,
+        pruned_mask=None):
     """
     This function optimizes the ESN parameters, x and y, over a specified
     range of values. The optimal values are determined by minimizing
@@ -51,7 +389,8 @@ def grid_optimizer(
             * "window" : int or None, the window size
     args : list or tuple
         The list of variables you want to optimize. Must be less
-        than or equal to two.
+        than or equal to two. When "ridge" is the last variable, each
+        row of the grid is evaluated with a single esn_ridge_path call.
     xset : numpy array
         The first set of values to be tested. Cannot be None.
     yset : numpy array or None
@@ -67,11 +406,70 @@ def grid_optimizer(
         * 'surface' will plot a 3D error surface.
     save_path : string
         Specifies where the data should be saved. Default is None.
+        Each cell is also appended to a checkpoint file,
+        "./data/<save_path>_<variables>_cells.jsonl", as soon as it
+        has been evaluated, keyed by its parameters and a hash of the
+        data.
+    cache_states : boolean
+        Reuse harvested reservoir states between cells that drive the
+        same reservoir with the same data, so that only the readout is
+        re-solved. Only cells that differ in "ridge" or
+        "readout_solver" share their states, e.g. a grid over the
+        solver, or a ridge x axis with a reservoir y axis. A
+        "trainlen" axis drives every cell again, use trainlen_scan
+        instead. Default is False.
+    trainlen_scan : boolean
+        Evaluate a single "trainlen" axis with esn_trainlen_scan, which
+        drives the reservoir once over the longest training length.
+        Shorter lengths then start from a warm reservoir state and see
+        other noise draws, so the losses differ from separate fits, see
+        esn_trainlen_scan. Default is False.
+    batch_rows : boolean
+        Evaluate each row of the grid, the cells that share the x value,
+        with esn_batch_prediction, which advances all the reservoirs of
+        the row together. Requires the "sparse" backend, and the y
+        variable must be one of "rho", "noise", "sparsity", "rand_seed"
+        or "readout_solver". The losses match separate cells up to
+        rounding. Rows of a ridge or training length scan axis are
+        evaluated as usual. Not supported with cache_states. Default is
+        False.
+    n_jobs : int
+        The number of processes the cells are spread over. The data is
+        shared with the workers, every cell is evaluated with its own
+        copy of params, and the loss is the same as with one process.
+        Default is 1.
+    resume : boolean
+        Read the checkpoint file of an earlier run with the same
+        save_path and only evaluate the cells it does not contain.
+        Requires save_path. Default is False.
+    prune : boolean
+        Stop predicting a cell once the windows it has predicted so far
+        make its loss certain to exceed the best loss found so far. The
+        loss of a pruned cell is its partial loss, which is still larger
+        than the best loss, so the optimal values are unchanged. Cells
+        of a ridge axis or a training length scan are never pruned.
+        With n_jobs > 1, a cell only knows the best loss of the cells
+        finished before it was submitted. Default is False.
+    seeds : list or None
+        Evaluate every cell with each of these "rand_seed" values. All
+        cells see the same seeds, so the reservoirs, input weights and
+        noise are common to the cells and only the parameters differ.
+        The seeds are evaluated one after the other, so the "sparse"
+        backend reuses the reservoirs of a seed across the cells. The
+        loss then has a last axis with one entry per seed, which
+        optimal_values reduces to the mean or a quantile. The plots
+        show the mean. Cannot be combined with prune. Default is None.
+    pruned_mask : numpy array or None
+        A boolean array of the shape of the loss, set to True for the
+        cells that were pruned. With a save_path, the mask of a pruned
+        grid is also saved as "./data/<save_path>_<variables>_pruned".
+        Default is None.
 
     Returns
     -------
     loss : numpy array
-        The array or matrix of loss values.
+        The array or matrix of loss values, with a last axis over the
+        seeds if seeds is given.
     """
     assert(len(args) <= 2), "Too many variables to optimize. Pick two or fewer."
     for variable in args:
@@ -80,6 +478,8 @@ def grid_optimizer(
 
     if len(args) > 1:
         assert(yset is not None), "Two variables specified, two sets not given."
+    assert(not (batch_rows and cache_states)
+           ), "Batched rows do not use the state cache."
 
     xvar = args[0]
     loss = np.zeros(len(xset))
@@ -92,26 +492,135 @@ def grid_optimizer(
     if verbose:
         print(f"Optimizing over {args}:")
 
-    predictLen = params['future']
-    for x, xvalue in enumerate(xset):
-        params[xvar] = xvalue
-        if yset is not None:
-            for y, yvalue in enumerate(yset):
-                params[yvar] = yvalue
-                predicted = esn_prediction(data, params)
-                loss[x, y] = MSE(predicted, data[-predictLen:], ntargets)
+    scanned = trainlen_scan and xvar == 'trainlen' and yset is None
+    if scanned:
+        # the whole axis comes from one reservoir run
+        tasks = [(_trainlen_scan_loss, ((), {}, xset))]
+    # a ridge axis is evaluated a whole row at a time
+    elif yset is None and xvar == 'ridge':
+        tasks = [(_ridge_row_loss, ((), {}, xset))]
+    elif yset is None and batch_rows:
+        tasks = [(_batch_row_loss, ((), {}, xvar, xset))]
+    elif yset is None:
+        tasks = [(_cell_loss, ((x,), {xvar: xvalue}))
+                 for x, xvalue in enumerate(xset)]
+    elif yvar == 'ridge':
+        tasks = [(_ridge_row_loss, ((x,), {xvar: xvalue}, yset))
+                 for x, xvalue in enumerate(xset)]
+    elif batch_rows:
+        # the reservoirs of a row are advanced together
+        tasks = [(_batch_row_loss, ((x,), {xvar: xvalue}, yvar, yset))
+                 for x, xvalue in enumerate(xset)]
+    else:
+        tasks = [(_cell_loss, ((x, y), {xvar: xvalue, yvar: yvalue}))
+                 for x, xvalue in enumerate(xset)
+                 for y, yvalue in enumerate(yset)]
 
-                if verbose:
-                    print(
-                        f"{variables[xvar]} = {xvalue},"
-                        f"{variables[yvar]} = {yvalue}, MSE={loss[x][y]}")
+    # the seeds are the first axis while evaluating, so every kind of
+    # task can prefix its index with the seed
+    offset = 0
+    if seeds is not None:
+        assert('rand_seed' not in args), "rand_seed is already optimized."
+        assert(not prune), "Pruning cannot be combined with seeds."
+        # seed by seed, so consecutive cells reuse the reservoirs drawn
+        # for a seed
+        tasks = [(func, ((s,) + args[0], dict(args[1], rand_seed=seed))
+                  + args[2:])
+                 for s, seed in enumerate(seeds) for func, args in tasks]
+        loss = np.zeros((len(seeds),) + loss.shape)
+        offset = 1
 
-        else:
-            predicted = esn_prediction(data, params)
-            loss[x] = MSE(predicted, data[-predictLen:], ntargets)
+    if yset is not None:
+        fname = f"_{xvar}_{yvar}"
+    else:
+        fname = f"_{xvar}"
 
-            if verbose:
-                print(f"{xvar} = {xvalue}, MSE={loss[x]}")
+    # =======================================================================
+    # Checkpoint
+    # =======================================================================
+
+    checkpoint = None
+    keys = {}
+    if save_path is not None:
+        checkpoint = './data/' + save_path + fname + '_cells.jsonl'
+        _repair_checkpoint(checkpoint)
+        data_hash = _data_hash(data)
+        for index in np.ndindex(loss.shape):
+            settings = {xvar: xset[index[offset]]}
+            if yset is not None:
+                settings[yvar] = yset[index[offset + 1]]
+            if seeds is not None:
+                settings['rand_seed'] = seeds[index[0]]
+            keys[index] = _cell_key(params, settings, data_hash, ntargets,
+                                    scanned)
+
+    pruned = np.zeros(loss.shape, dtype=bool)
+    # the best complete loss so far
+    incumbent = np.inf
+    if resume:
+        assert(checkpoint is not None), "Cannot resume without a save_path."
+        done = read_checkpoint(checkpoint)
+        if not prune:
+            # partial losses cannot be compared without pruning
+            done = {key: cell for key, cell in done.items() if not cell[1]}
+        for index, key in keys.items():
+            if key in done:
+                loss[index], pruned[index] = done[key]
+                if not pruned[index]:
+                    incumbent = min(incumbent, loss[index])
+
+        # a task is only run again if one of its cells is missing
+        tasks = [(func, args) for func, args in tasks
+                 if any(keys[index] not in done for index in keys
+                        if index[:len(args[0])] == args[0])]
+
+        if verbose:
+            print(f"Resuming with {len(tasks)} tasks left to evaluate")
+
+    def scheduled():
+        # tasks are drawn as they are submitted, so the incumbent is as
+        # recent as possible
+        for func, args in tasks:
+            if prune and func is _cell_loss:
+                args = args + (incumbent,)
+            yield func, args
+
+    results = _evaluate(data, params, scheduled(), ntargets, cache_states,
+                        n_jobs)
+    for index, cell_loss, cell_pruned in results:
+        loss[index] = cell_loss
+        pruned[index] = cell_pruned
+        if not cell_pruned:
+            incumbent = min(incumbent, cell_loss)
+
+        if checkpoint is not None:
+            # one line per cell, so an interrupted run keeps its cells
+            with open(checkpoint, 'a') as file:
+                record = {'key': keys[index], 'loss': float(cell_loss),
+                          'pruned': cell_pruned}
+                file.write(json.dumps(record) + '\n')
+
+        status = " (pruned)" if cell_pruned else ""
+        if seeds is not None:
+            status = f" (seed {seeds[index[0]]})"
+        cell = index[offset:]
+        if verbose and yset is not None:
+            print(
+                f"{variables[xvar]} = {xset[cell[0]]},"
+                f"{variables[yvar]} = {yset[cell[1]]}, MSE={loss[index]}"
+                f"{status}")
+        elif verbose:
+            print(f"{xvar} = {xset[cell[0]]}, MSE={loss[index]}{status}")
+
+    if seeds is not None:
+        loss = np.moveaxis(loss, 0, -1)
+        pruned = np.moveaxis(pruned, 0, -1)
+        surface = np.mean(loss, axis=-1)
+        if verbose:
+            print(f"Mean MSE over seeds:\n{surface}")
+            print(f"Standard deviation over seeds:\n{np.std(loss, axis=-1)}")
+    else:
+        surface = loss
 
     # =======================================================================
     # Visualization
@@ -121,9 +630,9 @@ def grid_optimizer(
         plt.figure(figsize=(16, 9), facecolor='w', edgecolor='k')
         plt.title((f"Hyper-parameter Optimization over {variables[xvar]}",
                    f"and {variables[yvar]}"))
-        im = plt.imshow(loss.T,
-                        vmin=abs(loss).min(),
-                        vmax=abs(loss).max(),
+        im = plt.imshow(surface.T,
+                        vmin=abs(surface).min(),
+                        vmax=abs(surface).max(),
                         origin='lower',
                         cmap='PuBu')
         plt.xticks(np.linspace(0, len(xset) - 1,
@@ -140,7 +649,7 @@ def grid_optimizer(
 
     elif visualize is True and yset is None:
         plt.figure(figsize=(16, 9), facecolor='w', edgecolor='k')
-        plt.plot(xset, loss, '-ok', alpha=0.6)
+        plt.plot(xset, surface, '-ok', alpha=0.6)
         plt.title(f'MSE as a Function of {variables[xvar]}', fontsize=20)
         plt.xlabel(f'{variables[xvar]}', fontsize=18)
         plt.ylabel('MSE', fontsize=18)
@@ -151,7 +660,7 @@ def grid_optimizer(
 
         X = np.array(xset)
         Y = np.array(yset)
-        Z = np.array(loss).T
+        Z = np.array(surface).T
 
         print(f"Shape X {X.shape}")
         print(f"Shape Y {Y.shape}")
@@ -179,12 +688,610 @@ def grid_optimizer(
     # Save data
     # =======================================================================
 
+    if save_path is not None:
+        np.save('./data/' + save_path + fname + '_loss', loss)
+        if prune:
+            np.save('./data/' + save_path + fname + '_pruned', pruned)
+
+    if pruned_mask is not None:
+        pruned_mask[...] = pruned
+
+    return loss
+
+
+def successive_halving(
+        data,
+        params,
+        args,
+        xset,
+        yset=None,
+        budgets=None,
+        resource='trainlen',
+        eta=3,
+        min_budget=1,
+        ntargets=1,
+        verbose=False,
+        save_path=None,
+        cache_states=False,
+        n_jobs=1):
+    """
+    This function optimizes the ESN parameters, x and y, over a specified
+    range of values by successive halving. Every configuration is first
+    evaluated with a small budget of the resource, such as a short
+    training length. Only the best 1/eta of the configurations is kept
+    and evaluated again with the next, larger budget, until the
+    survivors are evaluated with the full budget of params.
+
+    Parameters
+    ----------
+    data : numpy array
+        This is the dataset that the ESN should train and predict.
+        See grid_optimizer.
+    params : dictionary
+        A dictionary containing all of the parameters required to
+        initialize an ESN. See grid_optimizer. It is not modified.
+    args : list or tuple
+        The list of variables you want to optimize. Must be less
+        than or equal to two, and cannot include the resource.
+    xset : numpy array
+        The first set of values to be tested. Cannot be None.
+    yset : numpy array or None
+        The second set of values to be tested at the same
+        time as the xset. Can be None.
+    budgets : list or None
+        The increasing budgets of the resource, one per round. The
+        last budget is the one the reported losses are computed with.
+        By default, the budgets grow by a factor of eta up to the
+        value in params, with enough rounds to narrow the grid down
+        to at most eta configurations for the last budget. Budgets
+        must be at least min_budget.
+    resource : string
+        The parameter used as the budget, "trainlen" or "n_reservoir".
+        Default is "trainlen".
+    eta : int
+        The fraction of configurations kept after each round is 1/eta.
+        Default is 3.
+    min_budget : int
+        The smallest budget. The default budgets are raised to it.
+        Default is 1.
+    ntargets : integer
+        The number of target variables being predicted.
+    verbose : boolean
+        Specifies if the simulation outputs should be printed.
+    save_path : string
+        Specifies where the loss should be saved. Default is None.
+    cache_states : boolean
+        Reuse harvested reservoir states between cells that drive the
+        same reservoir with the same data. Default is False.
+    n_jobs : int
+        The number of processes the cells of a round are spread over.
+        Default is 1.
+
+    Returns
+    -------
+    loss : numpy array
+        The array or matrix of loss values, with the same shape as
+        the one returned by grid_optimizer. The configurations that
+        survive the last round hold their loss with the last budget,
+        all others are set to infinity, so the result can be passed
+        to optimal_values.
+
+    Example
+    -------
+    >>> loss = successive_halving(data, params, args=['rho', 'noise'],
+    ...                           xset=radius_set, yset=noise_set)
+    >>> opt_radius, opt_noise = optimal_values(loss, radius_set, noise_set)
+    """
+    assert(len(args) <= 2), "Too many variables to optimize. Pick two or fewer."
+    for variable in args:
+        assert(variable in list(params.keys())
+               ), f"{variable} not in parameters"
+    assert(resource in ('trainlen', 'n_reservoir')
+           ), f"{resource} cannot be used as a budget"
+    assert(resource not in args), f"{resource} is both optimized and a budget"
+    assert(eta > 1), "eta must be greater than one"
+    assert(min_budget >= 1), "min_budget must be at least one"
+
+    if len(args) > 1:
+        assert(yset is not None), "Two variables specified, two sets not given."
+
+    xvar = args[0]
+    loss = np.full(len(xset), np.inf)
+
+    if yset is not None:
+        assert(len(args) > 1), "Second parameter set given, but not specified."
+        yvar = args[1]
+        loss = np.full([len(xset), len(yset)], np.inf)
+
+    if budgets is None:
+        rounds = 1
+        while eta**rounds < loss.size:
+            rounds += 1
+        budgets = [max(int(params[resource] / eta**k), min_budget)
+                   for k in reversed(range(rounds))]
+    assert(min(budgets) >= min_budget
+           ), f"Budgets must be at least {min_budget}"
+
+    # a diverged configuration ranks last
+    def rank(index):
+        return np.nan_to_num(rung_loss[index], nan=np.inf)
+
+    survivors = list(np.ndindex(loss.shape))
+    for rung, budget in enumerate(budgets):
+        rung_params = dict(params, **{resource: budget})
+
+        tasks = []
+        for index in survivors:
+            settings = {xvar: xset[index[0]]}
+            if yset is not None:
+                settings[yvar] = yset[index[1]]
+            tasks.append((_cell_loss, (index, settings)))
+
+        rung_loss = {index: cell_loss for index, cell_loss, _ in
+                     _evaluate(data, rung_params, tasks, ntargets,
+                               cache_states, n_jobs)}
+
+        if verbose:
+            best = min(survivors, key=rank)
+            print(f"Round {rung}: {resource} = {budget}, "
+                  f"{len(survivors)} configurations, "
+                  f"best MSE={rung_loss[best]}")
+
+        if rung == len(budgets) - 1:
+            for index in survivors:
+                loss[index] = rung_loss[index]
+        else:
+            # sorted is stable, so ties keep the grid order
+            keep = max(1, len(survivors) // eta)
+            survivors = sorted(survivors, key=rank)[:keep]
+
     if save_path is not None:
         if yset is not None:
-            fname = f"_{xvar}_{yvar}_loss"
-            np.save('./data/' + save_path + fname, loss)
+            fname = f"_{xvar}_{yvar}_halving_loss"
         else:
-            fname = f"_{xvar}_loss"
-            np.save('./data/' + save_path + fname, loss)
+            fname = f"_{xvar}_halving_loss"
+        np.save('./data/' + save_path + fname, loss)
 
     return loss
+
+
+def grid_search(
+        data,
+        params,
+        space,
+        order='grid',
+        max_cells=None,
+        top_k=5,
+        ntargets=1,
+        verbose=False,
+        cache_states=False,
+        n_jobs=1,
+        random_state=None):
+    """
+    This function searches the product of any number of parameter sets
+    jointly. The cells are generated lazily and streamed to the
+    evaluation, so the cost only depends on the number of cells that
+    are evaluated, not on the size of the full product.
+
+    Parameters
+    ----------
+    data : numpy array
+        This is the dataset that the ESN should train and predict.
+        See grid_optimizer.
+    params : dictionary
+        A dictionary containing all of the parameters required to
+        initialize an ESN. See grid_optimizer. It is not modified.
+    space : dictionary
+        The values to be tested, keyed by parameter name. Each
+        parameter is one axis of the loss, in the order of the keys.
+    order : string or iterable
+        The order the cells are evaluated in.
+            * "grid" : the order of np.ndindex over the loss
+            * "random" : a random order, without repeats
+            * an iterable of loss indices, e.g. the most promising
+              cells first
+        Default is "grid".
+    max_cells : int or None
+        Stop after this many cells. With a random order this is a
+        random subsample of the product. Default is None, every cell.
+    top_k : int
+        The number of best configurations to return. Default is 5.
+    ntargets : integer
+        The number of target variables being predicted.
+    verbose : boolean
+        Specifies if the simulation outputs should be printed.
+    cache_states : boolean
+        Reuse harvested reservoir states between cells that drive the
+        same reservoir with the same data. Default is False.
+    n_jobs : int
+        The number of processes the cells are spread over. Default is 1.
+    random_state : int or None
+        The seed of the random order. Default is None.
+
+    Returns
+    -------
+    loss : numpy array
+        The loss of every cell, with one axis per parameter of space.
+        Cells that were not evaluated are NaN.
+    best : list
+        The (settings, loss) of the top_k evaluated cells, best first.
+        See top_configurations.
+
+    Example
+    -------
+    >>> space = {'rho': radius_set, 'n_reservoir': reservoir_set,
+    ...          'noise': noise_set}
+    >>> loss, best = grid_search(data, params, space, order='random',
+    ...                          max_cells=100, n_jobs=8)
+    >>> params.update(best[0][0])
+    """
+    assert(len(space) > 0), "No variables to optimize."
+    for variable in space:
+        assert(variable in list(params.keys())
+               ), f"{variable} not in parameters"
+
+    names = list(space)
+    loss = np.full([len(space[name]) for name in names], np.nan)
+
+    if order == 'grid':
+        indices = np.ndindex(loss.shape)
+    elif order == 'random':
+        size = loss.size
+        if max_cells is not None:
+            size = min(max_cells, size)
+        # draws without building a permutation of the whole product
+        flat = np.random.default_rng(random_state).choice(
+            loss.size, size=size, replace=False)
+        indices = (np.unravel_index(f, loss.shape) for f in flat)
+    else:
+        assert(not isinstance(order, str)), f"Unknown order {order}"
+        indices = order
+
+    def cells():
+        for index in itertools.islice(indices, max_cells):
+            index = tuple(int(i) for i in index)
+            settings = {name: space[name][i]
+                        for name, i in zip(names, index)}
+            yield (_cell_loss, (index, settings))
+
+    results = _evaluate(data, params, cells(), ntargets, cache_states,
+                        n_jobs)
+    for index, cell_loss, _ in results:
+        loss[index] = cell_loss
+
+        if verbose:
+            settings = ", ".join(f"{name} = {space[name][i]}"
+                                 for name, i in zip(names, index))
+            print(f"{settings}, MSE={cell_loss}")
+
+    return loss, top_configurations(loss, space, top_k)
+
+
+def _warm_start_points(warm_start, params, names):
+    """
+    This function collects the cells of earlier loss grids that can be
+    used as observations of a search over names.
+
+    Parameters
+    ----------
+    warm_start : list
+        The (loss, space) of each grid, where loss is an array or the
+        path of a saved .npy loss, and space the values of each axis
+        keyed by parameter name, in the order of the axes.
+    params : dictionary
+        The ESN parameters. The parameters of names that are not an
+        axis of a grid take their value from params.
+    names : list
+        The parameters being searched.
+
+    Returns
+    -------
+    points : list
+        The (settings, loss) of every cell with a finite loss.
+    """
+    points = []
+    for loss, space in warm_start:
+        if isinstance(loss, str):
+            loss = np.load(loss)
+        loss = np.asarray(loss)
+        axes = list(space)
+        assert(loss.ndim == len(axes)), "One set of values is needed per axis."
+
+        for index in np.ndindex(loss.shape):
+            if not np.isfinite(loss[index]):
+                continue
+            settings = {name: params[name] for name in names}
+            settings.update({name: space[name][i]
+                             for name, i in zip(axes, index)})
+            points.append((settings, float(loss[index])))
+
+    return points
+
+
+def bayesian_optimizer(
+        data,
+        params,
+        bounds,
+        budget=24,
+        batch_size=4,
+        n_initial=None,
+        log_scale=('noise',),
+        warm_start=None,
+        ntargets=1,
+        verbose=False,
+        cache_states=False,
+        n_jobs=1,
+        random_state=None):
+    """
+    This function optimizes continuous ESN parameters with a Gaussian
+    process surrogate of the log loss. After a random initial design,
+    each round fits the surrogate to every loss observed so far and
+    evaluates the batch of configurations with the largest expected
+    improvement. The batch can be spread over a process pool.
+
+    Parameters
+    ----------
+    data : numpy array
+        This is the dataset that the ESN should train and predict.
+        See grid_optimizer.
+    params : dictionary
+        A dictionary containing all of the parameters required to
+        initialize an ESN. See grid_optimizer. It is not modified.
+    bounds : dictionary
+        The (low, high) range of each parameter to optimize. Parameters
+        whose value in params is an integer, such as "n_reservoir",
+        are rounded.
+    budget : int
+        The number of ESN predictions to evaluate. Default is 24.
+    batch_size : int
+        The number of configurations proposed, and evaluated in
+        parallel, at each round. Default is 4.
+    n_initial : int or None
+        The number of random configurations evaluated before the
+        surrogate is used. Warm start cells count towards it. Default
+        is None, twice the number of parameters plus one.
+    log_scale : list or tuple
+        The parameters searched on a logarithmic scale. Default is
+        ("noise",).
+    warm_start : list or None
+        Earlier loss grids to start from, as a list of (loss, space)
+        pairs. loss is the array returned by grid_optimizer or
+        grid_search, or the path of a saved "_loss.npy" file, and
+        space the values of each axis keyed by parameter name, in the
+        order of the axes. Cells outside the bounds are used as well.
+        They do not count towards the budget. Default is None.
+    ntargets : integer
+        The number of target variables being predicted.
+    verbose : boolean
+        Specifies if the simulation outputs should be printed.
+    cache_states : boolean
+        Reuse harvested reservoir states between cells that drive the
+        same reservoir with the same data. Default is False.
+    n_jobs : int
+        The number of processes a batch is spread over. Default is 1.
+    random_state : int or None
+        The seed of the initial design and of the proposals.
+
+    Returns
+    -------
+    best : tuple
+        The (settings, loss) of the best configuration found.
+    history : list
+        The (settings, loss) of the warm start cells followed by every
+        evaluated configuration, in evaluation order.
+
+    Example
+    -------
+    >>> bounds = {'rho': (0.5, 1.5), 'noise': (1e-4, 1e-2)}
+    >>> grid = ('./data/demand_rho_noise_loss.npy',
+    ...         {'rho': radius_set, 'noise': noise_set})
+    >>> best, history = bayesian_optimizer(data, params, bounds,
+    ...                                    warm_start=[grid], n_jobs=4)
+    >>> params.update(best[0])
+    """
+    assert(len(bounds) > 0), "No variables to optimize."
+    for variable, (low, high) in bounds.items():
+        assert(variable in list(params.keys())
+               ), f"{variable} not in parameters"
+        assert(low < high), f"Empty range for {variable}"
+        if variable in log_scale:
+            assert(low > 0), f"{variable} cannot be searched on a log scale"
+
+    names = list(bounds)
+    low = np.array([bounds[name][0] for name in names], dtype=float)
+    high = np.array([bounds[name][1] for name in names], dtype=float)
+    logs = np.array([name in log_scale for name in names])
+    low[logs], high[logs] = np.log(low[logs]), np.log(high[logs])
+
+    def to_unit(settings):
+        x = np.array([settings[name] for name in names], dtype=float)
+        x[logs] = np.log(x[logs])
+        return (x - low) / (high - low)
+
+    def from_unit(x):
+        x = low + np.asarray(x) * (high - low)
+        x[logs] = np.exp(x[logs])
+        settings = {}
+        for name, value in zip(names, x):
+            value = min(max(value, bounds[name][0]), bounds[name][1])
+            if isinstance(params[name], (int, np.integer)):
+                settings[name] = int(round(value))
+            else:
+                settings[name] = float(value)
+        return settings
+
+    rng = np.random.RandomState(random_state)
+    history = []
+    if warm_start is not None:
+        history = _warm_start_points(warm_start, params, names)
+    if n_initial is None:
+        n_initial = 2 * len(names) + 1
+
+    gp = GaussianProcess(random_state=rng)
+    evaluated = 0
+    while evaluated < budget:
+        size = min(batch_size, budget - evaluated)
+        losses = np.array([loss for _, loss in history], dtype=float)
+        finite = np.isfinite(losses)
+        if len(history) < n_initial or not finite.any():
+            if len(history) < n_initial:
+                size = min(size, n_initial - len(history))
+            batch = rng.uniform(size=(size, len(names)))
+        else:
+            # diverged cells count as the worst loss seen, so the
+            # surrogate steers away from them
+            losses[~finite] = losses[finite].max()
+            X = np.array([to_unit(settings) for settings, _ in history])
+            y = np.log(np.maximum(losses, 1e-300))
+            gp.fit(X, y)
+            batch = propose_batch(gp, X, y, size, random_state=rng)
+
+        tasks = [(_cell_loss, ((k,), from_unit(x)))
+                 for k, x in enumerate(batch)]
+        for (k,), cell_loss, _ in _evaluate(data, params, tasks, ntargets,
+                                            cache_states, n_jobs):
+            settings = tasks[k][1][1]
+            history.append((settings, cell_loss))
+            if verbose:
+                values = ", ".join(f"{name} = {settings[name]}"
+                                   for name in names)
+                print(f"{values}, MSE={cell_loss}")
+        evaluated += len(batch)
+
+    best = min(history, key=lambda point: np.nan_to_num(point[1],
+                                                        nan=np.inf))
+
+    return best, history
+
+
+def incremental_optimizer(
+        data,
+        params,
+        space,
+        previous,
+        previous_space=None,
+        radius=1,
+        ntargets=1,
+        verbose=False,
+        save_path=None,
+        cache_states=False,
+        n_jobs=1):
+    """
+    This function re-optimizes the ESN parameters after the data has
+    been updated, starting from an earlier loss surface. Only the cells
+    within radius grid steps of the earlier optimum are evaluated. If
+    the best of them lies on the boundary of that neighborhood, the
+    neighborhood is moved to it and the search continues, until the
+    best cell is inside the neighborhood or on the edge of the grid.
+
+    Parameters
+    ----------
+    data : numpy array
+        This is the updated dataset that the ESN should train and
+        predict. See grid_optimizer.
+    params : dictionary
+        A dictionary containing all of the parameters required to
+        initialize an ESN. See grid_optimizer. It is not modified.
+    space : dictionary
+        The values of each parameter, keyed by parameter name. See
+        grid_search.
+    previous : numpy array or string
+        The earlier loss, or the path of a saved "_loss.npy" file, as
+        written by grid_optimizer or this function. NaN cells are
+        ignored.
+    previous_space : dictionary or None
+        The values of each axis of the earlier loss, if they differ
+        from space, e.g. a longer list of training lengths. The search
+        starts from the values of space closest to the earlier optimum.
+        Default is None, the same values as space.
+    radius : int
+        The half width of the neighborhood, in grid steps. Default is 1.
+    ntargets : integer
+        The number of target variables being predicted.
+    verbose : boolean
+        Specifies if the simulation outputs should be printed.
+    save_path : string
+        Save the loss as "./data/<save_path>_<parameters>_loss.npy",
+        the name grid_optimizer uses, so the next update can start from
+        it. Default is None.
+    cache_states : boolean
+        Reuse harvested reservoir states between cells that drive the
+        same reservoir with the same data. Default is False.
+    n_jobs : int
+        The number of processes the cells are spread over. Default is 1.
+
+    Returns
+    -------
+    loss : numpy array
+        The loss on the updated data, with one axis per parameter of
+        space. Cells that were not evaluated, or whose prediction
+        diverged, are NaN. Diverged cells are not the best, and the
+        search fails if every evaluated cell diverged.
+    best : list
+        The (settings, loss) of the best configuration, as a one
+        element list. See top_configurations.
+
+    Example
+    -------
+    >>> loss, best = incremental_optimizer(
+    ...     data, params, {'rho': radius_set, 'noise': noise_set},
+    ...     previous='./data/demand_rho_noise_loss.npy',
+    ...     save_path='demand')
+    >>> params.update(best[0][0])
+    """
+    assert(radius >= 1), "The neighborhood needs a radius of at least one."
+    if isinstance(previous, str):
+        previous = np.load(previous)
+    previous = np.asarray(previous)
+    if previous_space is None:
+        previous_space = space
+
+    names = list(space)
+    assert(previous.ndim == len(names) and list(previous_space) == names
+           ), "The earlier loss must have the same parameters as space."
+    shape = tuple(len(space[name]) for name in names)
+
+    # the values of the earlier optimum, mapped onto the current grid
+    optimum = np.unravel_index(np.nanargmin(previous), previous.shape)
+    center = tuple(
+        int(np.argmin(np.abs(np.asarray(space[name], dtype=float)
+                             - float(previous_space[name][i]))))
+        for name, i in zip(names, optimum))
+
+    loss = np.full(shape, np.nan)
+    # a diverged cell has a NaN loss, but is not evaluated again
+    searched = np.zeros(shape, dtype=bool)
+    while True:
+        ranges = [range(max(c - radius, 0), min(c + radius + 1, n))
+                  for c, n in zip(center, shape)]
+        cells = [index for index in itertools.product(*ranges)
+                 if not searched[index]]
+
+        if verbose:
+            print(f"Searching {len(cells)} cells around "
+                  + ", ".join(f"{name} = {space[name][c]}"
+                              for name, c in zip(names, center)))
+
+        evaluated, _ = grid_search(data, params, space, order=cells,
+                                   ntargets=ntargets, verbose=verbose,
+                                   cache_states=cache_states, n_jobs=n_jobs)
+        for index in cells:
+            loss[index] = evaluated[index]
+            searched[index] = True
+
+        assert(not np.isnan(loss).all()
+               ), "Every cell around the earlier optimum diverged."
+        best = np.unravel_index(np.nanargmin(loss), shape)
+        # the neighborhood only moves if a cell on its boundary wins,
+        # and the grid continues beyond it
+        moved = any(abs(b - c) == radius and 0 < b < n - 1
+                    for b, c, n in zip(best, center, shape))
+        if not moved:
+            break
+        center = best
+
+    if save_path is not None:
+        fname = '_' + '_'.join(names) + '_loss'
+        np.save('./data/' + save_path + fname, loss)
+
+    return loss, top_configurations(loss, space, 1)
@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # shared_memory is only available from Python 3.8, before that the
+    # workers receive a pickled copy of the arrays when they start
+    shared_memory = None
+
+# Read-only views of the arrays shared by the parent process, available
+# to functions running in a pool worker.
+shared_arrays = {}
+
+
+def _attach_arrays(specs):
+    """
+    This function attaches a pool worker to the shared memory blocks
+    created by the parent process.
+
+    Parameters
+    ----------
+    specs : dictionary
+        The (name, shape, dtype) of the shared memory block holding
+        each array, keyed by the name the array is shared under.
+    """
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        # keep the block mapped for the lifetime of the worker
+        shared_arrays[key] = (shm, array)
+
+    return
+
+
+def _copy_arrays(arrays):
+    """
+    This function keeps the copies of the shared arrays a pool worker
+    received when shared memory is not available.
+
+    Parameters
+    ----------
+    arrays : dictionary
+        The arrays, keyed by the name they are shared under.
+    """
+    for key, array in arrays.items():
+        array.flags.writeable = False
+        shared_arrays[key] = (None, array)
+
+    return
+
+
+def get_shared(key):
+    """
+    This function returns an array shared with the pool workers.
+
+    Parameters
+    ----------
+    key : string
+        The name the array was shared under.
+
+    Returns
+    -------
+    array : numpy array
+        A read-only view of the shared array.
+    """
+    return shared_arrays[key][1]
+
+
+@contextmanager
+def shared_pool(n_jobs, **arrays):
+    """
+    This function starts a process pool whose workers can read the
+    given arrays from shared memory with get_shared, instead of
+    receiving a pickled copy with every task. The shared memory is
+    released when the pool is closed. Without shared memory, before
+    Python 3.8, each worker receives one pickled copy of the arrays
+    when it starts instead.
+
+    Parameters
+    ----------
+    n_jobs : int
+        The number of worker processes.
+    **arrays : numpy arrays
+        The arrays to share, keyed by the name they are shared under.
+
+    Yields
+    ------
+    executor : concurrent.futures.ProcessPoolExecutor
+        The process pool.
+
+    Example
+    -------
+    >>> with shared_pool(4, data=data) as executor:
+    ...     results = list(executor.map(task, range(10)))
+    """
+    if shared_memory is None:
+        with ProcessPoolExecutor(n_jobs, initializer=_copy_arrays,
+                                 initargs=(arrays,)) as executor:
+            yield executor
+        return
+
+    blocks = []
+    specs = {}
+    try:
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(array.nbytes, 1))
+            blocks.append(shm)
+            shared = np.ndarray(array.shape, dtype=array.dtype,
+                                buffer=shm.buf)
+            shared[...] = array
+            specs[key] = (shm.name, array.shape, array.dtype.str)
+
+        with ProcessPoolExecutor(n_jobs, initializer=_attach_arrays,
+                                 initargs=(specs,)) as executor:
+            yield executor
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return
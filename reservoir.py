@@ -0,0 +1,1090 @@
+from collections import OrderedDict
+from itertools import chain
+import hashlib
+import os
+import zipfile
+import numpy as np
+import scipy.sparse as sparse
+from scipy.linalg import cho_factor, cho_solve, qr, solve_triangular
+from scipy.linalg import LinAlgError
+from scipy.sparse.linalg import eigs, ArpackNoConvergence
+
+# Reservoirs with a smaller fraction of nonzero recurrent weights than
+# this are stored as CSR matrices. Denser reservoirs are cheaper to
+# multiply as plain arrays.
+SPARSE_DENSITY = 0.35
+
+# Number of time steps whose input drive and state noise are generated
+# at once while harvesting states.
+CHUNK = 1000
+
+# Solvers for the least squares readout
+READOUT_SOLVERS = ('pinv', 'lstsq', 'qr', 'cholesky')
+
+# Reservoirs rescaled to unit spectral radius, keyed by the parameters
+# that generate them, so a sweep over rho draws and decomposes each
+# reservoir only once.
+_unit_reservoirs = OrderedDict()
+UNIT_CACHE_SIZE = 4
+
+# Environment variable naming the directory of the on-disk store of
+# unit reservoirs, see set_reservoir_store. Pool workers inherit it.
+STORE_VARIABLE = 'ESN_RESERVOIR_STORE'
+STORE_VERSION = 1
+
+
+def _as_2d(x):
+    """
+    This function reshapes vectors of shape (x,) into (x, 1).
+
+    Parameters
+    ----------
+    x : numpy array
+        A vector or matrix.
+
+    Returns
+    -------
+    x : numpy array
+        The same data with at least two dimensions.
+    """
+    if x.ndim < 2:
+        x = np.reshape(x, (len(x), -1))
+
+    return x
+
+
+def _input_terms(inputs, *weights):
+    """
+    This function projects the input of every step with each of the
+    given weights. Constant inputs, which esn_prediction always uses,
+    are projected once and broadcast to every step.
+
+    Parameters
+    ----------
+    inputs : numpy array
+        The (n_samples, n_inputs) input signal.
+    *weights : numpy array
+        The (..., m, n_inputs) weights of each projection.
+
+    Returns
+    -------
+    terms : list
+        The (n_samples, ..., m) read-only projection of each weight.
+    """
+    n_samples = inputs.shape[0]
+    if n_samples > 0 and np.all(inputs == inputs[0]):
+        return [np.broadcast_to(W @ inputs[0],
+                                (n_samples,) + W.shape[:-1])
+                for W in weights]
+
+    return [np.moveaxis(W @ inputs.T, -1, 0) for W in weights]
+
+
+def spectral_radius(W):
+    """
+    This function computes the spectral radius of a square matrix.
+    Sparse matrices use a few Arnoldi iterations, which only need
+    matrix-vector products, and dense ones a full eigendecomposition.
+
+    Parameters
+    ----------
+    W : numpy array or scipy sparse matrix
+        The square matrix.
+
+    Returns
+    -------
+    radius : float
+        The largest absolute eigenvalue of W.
+    """
+    n = W.shape[0]
+    if sparse.issparse(W) and n > 50:
+        try:
+            # a fixed starting vector keeps the estimate reproducible
+            eigenvalues = eigs(W, k=10, ncv=min(40, n - 1), which='LM',
+                               return_eigenvectors=False, v0=np.ones(n))
+            return np.max(np.abs(eigenvalues))
+        except ArpackNoConvergence:
+            pass
+    if sparse.issparse(W):
+        W = W.toarray()
+
+    return np.max(np.abs(np.linalg.eigvals(W)))
+
+
+def rescale(W, rho):
+    """
+    This function multiplies a reservoir matrix by a scalar. Sparse
+    matrices share their index arrays with the original.
+
+    Parameters
+    ----------
+    W : numpy array or scipy CSR matrix
+        The reservoir matrix.
+    rho : float
+        The scale factor.
+
+    Returns
+    -------
+    W : numpy array or scipy CSR matrix
+        The rescaled reservoir matrix.
+    """
+    if sparse.issparse(W):
+        return sparse.csr_matrix((W.data * rho, W.indices, W.indptr),
+                                 shape=W.shape)
+
+    return W * rho
+
+
+def ridge_path(X, Y, ridges):
+    """
+    This function solves the Tikhonov regularized least squares
+    problem, min ||X W.T - Y||^2 + ridge ||W||^2, for several ridge
+    values from a single singular value decomposition of X. A ridge of
+    zero gives the pseudo-inverse solution.
+
+    Parameters
+    ----------
+    X : numpy array
+        The (n_samples, n_features) extended state matrix.
+    Y : numpy array
+        The (n_samples, n_outputs) target matrix.
+    ridges : list or numpy array
+        The ridge regularization values.
+
+    Returns
+    -------
+    readouts : numpy array
+        The (len(ridges), n_outputs, n_features) readout weights.
+    """
+    U, s, Vt = np.linalg.svd(X, full_matrices=False)
+    UtY = U.T @ _as_2d(Y)
+    # drop the directions np.linalg.pinv would treat as zero
+    keep = s > 1e-15 * s[0]
+    s = s[keep]
+    UtY = UtY[keep]
+    Vt = Vt[keep]
+
+    readouts = np.empty((len(ridges), UtY.shape[1], X.shape[1]))
+    for k, ridge in enumerate(ridges):
+        filters = s / (s**2 + ridge)
+        readouts[k] = (Vt.T @ (filters[:, None] * UtY)).T
+
+    return readouts
+
+
+def suffix_normal_equations(X, Y, starts):
+    """
+    This function accumulates the normal equations of the least
+    squares problems on the rows X[start:] for several start rows,
+    sweeping the matrix once from the end.
+
+    Parameters
+    ----------
+    X : numpy array
+        The (n_samples, n_features) extended state matrix.
+    Y : numpy array
+        The (n_samples, n_outputs) target matrix.
+    starts : list or numpy array
+        The first row of each problem.
+
+    Yields
+    ------
+    start, XtX, XtY : int, numpy array, numpy array
+        The start row and the Gram matrix and right hand side of
+        X[start:], from the latest start to the earliest. The arrays
+        are updated in place between iterations.
+    """
+    Y = _as_2d(Y)
+    XtX = np.zeros((X.shape[1], X.shape[1]))
+    XtY = np.zeros((X.shape[1], Y.shape[1]))
+    stop = len(X)
+    for start in sorted(starts, reverse=True):
+        XtX += X[start:stop].T @ X[start:stop]
+        XtY += X[start:stop].T @ Y[start:stop]
+        stop = start
+        yield start, XtX, XtY
+
+    return
+
+
+def solve_normal_equations(XtX, XtY, ridge=None):
+    """
+    This function solves the normal equations of a least squares
+    readout. With a ridge value the regularized system is solved by a
+    Cholesky factorization. Without one, eigenvalues of the Gram matrix
+    that are zero to working precision are dropped, which gives the
+    minimum norm solution.
+
+    Parameters
+    ----------
+    XtX : numpy array
+        The (n_features, n_features) Gram matrix.
+    XtY : numpy array
+        The (n_features, n_outputs) right hand side.
+    ridge : float or None
+        The Tikhonov regularization.
+
+    Returns
+    -------
+    W_out : numpy array
+        The (n_outputs, n_features) readout weights.
+    """
+    if ridge is not None:
+        A = XtX + ridge * np.eye(len(XtX))
+        return cho_solve(cho_factor(A), XtY).T
+
+    eigenvalues, V = np.linalg.eigh(XtX)
+    cutoff = len(XtX) * np.finfo(float).eps * eigenvalues[-1]
+    keep = eigenvalues > cutoff
+    V = V[:, keep]
+
+    return (V @ ((V.T @ XtY) / eigenvalues[keep, None])).T
+
+
+def solve_readout(X, Y, solver='pinv', ridge=None):
+    """
+    This function solves for the readout weights that map the extended
+    states to the targets in the least squares sense.
+
+    The solvers are:
+        * "pinv" : the pseudo-inverse, a full singular value
+          decomposition. This is what pyESN uses.
+        * "lstsq" : numpy's divide and conquer least squares solver.
+        * "qr" : a Householder QR factorization of X.
+        * "cholesky" : a Cholesky factorization of the normal
+          equations. The fastest, but it squares the condition number
+          of X, so it should be used with a ridge value.
+
+    Parameters
+    ----------
+    X : numpy array
+        The (n_samples, n_features) extended state matrix.
+    Y : numpy array
+        The (n_samples, n_outputs) target matrix.
+    solver : string
+        One of READOUT_SOLVERS.
+    ridge : float or None
+        The Tikhonov regularization of the readout.
+
+    Returns
+    -------
+    W_out : numpy array
+        The (n_outputs, n_features) readout weights.
+    """
+    assert(solver in READOUT_SOLVERS), f"Unknown readout solver {solver}"
+    Y = _as_2d(Y)
+
+    if solver == 'cholesky':
+        try:
+            return solve_normal_equations(X.T @ X, X.T @ Y, ridge or 0)
+        except LinAlgError:
+            return solve_normal_equations(X.T @ X, X.T @ Y)
+
+    if solver == 'pinv':
+        if ridge is None:
+            return np.dot(np.linalg.pinv(X), Y).T
+        return ridge_path(X, Y, [ridge])[0]
+
+    if ridge is not None:
+        # the ridge problem is the least squares problem of the
+        # augmented system [X; sqrt(ridge) I] W.T = [Y; 0]
+        X = np.vstack((X, np.sqrt(ridge) * np.eye(X.shape[1])))
+        Y = np.vstack((Y, np.zeros((X.shape[1], Y.shape[1]))))
+
+    if solver == 'lstsq':
+        return np.linalg.lstsq(X, Y, rcond=None)[0].T
+
+    Q, R = qr(X, mode='economic')
+    return solve_triangular(R, Q.T @ Y).T
+
+
+def clear_reservoir_cache():
+    """
+    This function empties the cache of unit spectral radius
+    reservoirs.
+    """
+    _unit_reservoirs.clear()
+
+    return
+
+
+def set_reservoir_store(path):
+    """
+    This function sets the directory where seeded unit reservoirs are
+    saved once drawn and loaded from afterwards, behind the in-process
+    cache. The setting is kept in the environment, so worker processes
+    started afterwards use the same store.
+
+    Parameters
+    ----------
+    path : string or None
+        The directory of the store, created when needed. None disables
+        the store.
+    """
+    if path is None:
+        os.environ.pop(STORE_VARIABLE, None)
+    else:
+        os.environ[STORE_VARIABLE] = os.fspath(path)
+
+    return
+
+
+def _store_path(key):
+    """
+    This function returns the file of the store that holds the unit
+    reservoir generated by the given parameters, or None without a
+    store. The file is named by a hash of the parameters.
+    """
+    store = os.environ.get(STORE_VARIABLE)
+    if not store:
+        return None
+    digest = hashlib.sha1(repr((STORE_VERSION,) + key).encode())
+
+    return os.path.join(store, digest.hexdigest() + '.npz')
+
+
+def _save_unit_reservoir(path, W, W_in, W_feedb, rng_state):
+    """
+    This function writes a unit reservoir and the random state left
+    after drawing it to a compressed npz file. The file is written
+    under a temporary name and renamed, so concurrent workers never
+    read a partial file.
+    """
+    arrays = {'W_in': W_in, 'W_feedb': W_feedb,
+              'rng_keys': rng_state[1],
+              'rng_pos': np.array([rng_state[2], rng_state[3]]),
+              'rng_gauss': np.array(rng_state[4])}
+    if sparse.issparse(W):
+        arrays.update(data=W.data, indices=W.indices, indptr=W.indptr,
+                      shape=np.array(W.shape))
+    else:
+        arrays['W'] = W
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(temporary, path)
+
+    return
+
+
+def _load_unit_reservoir(path):
+    """
+    This function reads a unit reservoir written by
+    _save_unit_reservoir. It returns None if the file is missing or
+    unreadable, so the reservoir is drawn again.
+    """
+    try:
+        with np.load(path) as f:
+            if 'W' in f:
+                W = f['W']
+            else:
+                W = sparse.csr_matrix((f['data'], f['indices'],
+                                       f['indptr']),
+                                      shape=tuple(f['shape']))
+            rng_pos, has_gauss = f['rng_pos']
+            rng_state = ('MT19937', f['rng_keys'], int(rng_pos),
+                         int(has_gauss), float(f['rng_gauss']))
+            return W, f['W_in'], f['W_feedb'], rng_state
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+class SparseESN():
+    """
+    An echo state network whose recurrent weights are stored as a
+    scipy.sparse CSR matrix, so that each reservoir update costs
+    O(nonzeros) rather than O(n_reservoir**2).
+
+    The constructor, fit and predict follow the contract of
+    pyESN.pyESN.ESN, and the weights and state noise are drawn in the
+    same order from the same random state, so both backends build the
+    same network for a given seed. As in pyESN, ``sparsity`` is the
+    fraction of recurrent connections that are removed. Reservoirs that
+    keep more than SPARSE_DENSITY of their connections are stored as
+    dense arrays instead.
+
+    Parameters
+    ----------
+    n_inputs : int
+        The number of input dimensions.
+    n_outputs : int
+        The number of output dimensions.
+    n_reservoir : int
+        The number of reservoir neurons.
+    spectral_radius : float
+        The spectral radius of the recurrent weight matrix.
+    sparsity : float
+        The fraction of recurrent weights set to zero.
+    noise : float
+        The amplitude of the noise added to each state update.
+    random_state : int, numpy RandomState, or None
+        The seed or random state used to draw the weights and noise.
+        Seeded reservoirs are kept in the on-disk store when one is
+        set, see set_reservoir_store.
+    dtype : string or numpy dtype
+        The precision of the weights, states and predictions. The
+        weights and noise are drawn in float64 and rounded, so a float32
+        network is the float64 one rounded. The readout is always solved
+        in float64. Default is float64.
+    """
+
+    def __init__(self, n_inputs, n_outputs, n_reservoir=200,
+                 spectral_radius=0.95, sparsity=0, noise=0.001,
+                 random_state=None, dtype=np.float64):
+        self.n_inputs = n_inputs
+        self.n_outputs = n_outputs
+        self.n_reservoir = n_reservoir
+        self.spectral_radius = spectral_radius
+        self.sparsity = sparsity
+        self.noise = noise
+        self.random_state = random_state
+        self.dtype = np.dtype(dtype)
+
+        if isinstance(random_state, np.random.RandomState):
+            self.random_state_ = random_state
+        elif random_state:
+            self.random_state_ = np.random.RandomState(random_state)
+        else:
+            self.random_state_ = np.random.mtrand._rand
+
+        self.initweights()
+
+    def initweights(self):
+        """
+        This function draws the recurrent, input, and feedback weights
+        and rescales the recurrent weights to the spectral radius.
+        Seeded reservoirs are drawn and decomposed once and then reused
+        for every spectral radius, from the in-process cache or from
+        the on-disk store.
+        """
+        key = None
+        path = None
+        if (isinstance(self.random_state, (int, np.integer))
+                and self.random_state):
+            key = (int(self.n_reservoir), float(self.sparsity),
+                   int(self.random_state), int(self.n_inputs),
+                   int(self.n_outputs), self.dtype.str)
+            path = _store_path(key)
+            if key not in _unit_reservoirs and path is not None:
+                stored = _load_unit_reservoir(path)
+                if stored is not None:
+                    _unit_reservoirs[key] = stored
+
+        if key in _unit_reservoirs:
+            _unit_reservoirs.move_to_end(key)
+            W, self.W_in, self.W_feedb, rng_state = _unit_reservoirs[key]
+            # continue the noise from where drawing the weights left it
+            self.random_state_.set_state(rng_state)
+        else:
+            n = self.n_reservoir
+            W = self.random_state_.rand(n, n) - 0.5
+            W[self.random_state_.rand(n, n) < self.sparsity] = 0
+            if np.count_nonzero(W) <= SPARSE_DENSITY * n * n:
+                W = sparse.csr_matrix(W)
+            W = rescale(W, 1 / spectral_radius(W))
+
+            self.W_in = self.random_state_.rand(n, self.n_inputs) * 2 - 1
+            self.W_feedb = self.random_state_.rand(n, self.n_outputs) * 2 - 1
+
+            W = W.astype(self.dtype)
+            self.W_in = self.W_in.astype(self.dtype)
+            self.W_feedb = self.W_feedb.astype(self.dtype)
+
+            if key is not None:
+                _unit_reservoirs[key] = (W, self.W_in, self.W_feedb,
+                                         self.random_state_.get_state())
+                if path is not None:
+                    _save_unit_reservoir(path, *_unit_reservoirs[key])
+
+        while len(_unit_reservoirs) > UNIT_CACHE_SIZE:
+            _unit_reservoirs.popitem(last=False)
+
+        # the unit reservoir is shared by every network drawn with the
+        # same seed, which lets batches of them share products
+        self._W_unit = W
+        self.W = rescale(W, self.spectral_radius)
+
+        return
+
+    @classmethod
+    def from_weights(cls, W, W_in, W_feedb, spectral_radius, sparsity=0,
+                     noise=0.001, random_state=None):
+        """
+        This function builds a network from existing weights instead of
+        drawing them, e.g. weights loaded from a saved model. The
+        arrays are used as given, so memory-mapped arrays stay on disk.
+
+        Parameters
+        ----------
+        W : numpy array or scipy CSR matrix
+            The (n_reservoir, n_reservoir) recurrent weights, already
+            rescaled to the spectral radius.
+        W_in : numpy array
+            The (n_reservoir, n_inputs) input weights.
+        W_feedb : numpy array
+            The (n_reservoir, n_outputs) feedback weights.
+        spectral_radius : float
+            The spectral radius W was rescaled to.
+        sparsity : float
+            The fraction of recurrent weights set to zero.
+        noise : float
+            The amplitude of the noise added to each state update.
+        random_state : int, numpy RandomState, or None
+            The seed or random state of the state noise.
+
+        Returns
+        -------
+        esn : SparseESN
+            The network, in the precision of W_in.
+        """
+        esn = cls.__new__(cls)
+        esn.n_reservoir, esn.n_inputs = W_in.shape
+        esn.n_outputs = W_feedb.shape[1]
+        esn.spectral_radius = spectral_radius
+        esn.sparsity = sparsity
+        esn.noise = noise
+        esn.random_state = random_state
+        esn.dtype = W_in.dtype
+
+        if isinstance(random_state, np.random.RandomState):
+            esn.random_state_ = random_state
+        elif random_state:
+            esn.random_state_ = np.random.RandomState(random_state)
+        else:
+            esn.random_state_ = np.random.mtrand._rand
+
+        esn.W = W
+        esn.W_in = W_in
+        esn.W_feedb = W_feedb
+        # only needed to batch the network, see W_unit
+        esn._W_unit = None
+
+        return esn
+
+    @property
+    def W_unit(self):
+        """
+        The recurrent weights at unit spectral radius. For networks
+        built from weights, it is computed when first needed.
+        """
+        if self._W_unit is None:
+            self._W_unit = rescale(self.W, 1 / self.spectral_radius)
+
+        return self._W_unit
+
+    def _update(self, state, input_pattern, output_pattern):
+        """
+        This function advances the reservoir by a single step.
+
+        Parameters
+        ----------
+        state : numpy array
+            The current reservoir state.
+        input_pattern : numpy array
+            The input at the next step.
+        output_pattern : numpy array
+            The output at the current step, fed back into the reservoir.
+
+        Returns
+        -------
+        state : numpy array
+            The next reservoir state.
+        """
+        preactivation = (self.W @ state
+                         + self.W_in @ input_pattern
+                         + self.W_feedb @ output_pattern)
+        noise = self._noise(self.n_reservoir)
+
+        return np.tanh(preactivation) + noise
+
+    def _noise(self, *shape):
+        """
+        This function draws the noise added to the reservoir states, in
+        the precision of the network.
+
+        Parameters
+        ----------
+        *shape : int
+            The shape of the noise.
+
+        Returns
+        -------
+        noise : numpy array
+            Uniform noise of amplitude noise, centered on zero.
+        """
+        noise = self.noise * (self.random_state_.rand(*shape) - 0.5)
+
+        return noise.astype(self.dtype, copy=False)
+
+    def _drive(self, state, inputs, feedback):
+        """
+        This function drives the reservoir from a given state with the
+        inputs and the fed back outputs, and yields the new states in
+        consecutive blocks of at most CHUNK steps.
+
+        Parameters
+        ----------
+        state : numpy array
+            The reservoir state before the first step.
+        inputs : numpy array
+            The (n_steps, n_inputs) input at each step.
+        feedback : numpy array
+            The (n_steps, n_outputs) output fed back at each step, the
+            teacher signal of the step before.
+
+        Yields
+        ------
+        start, states : int, numpy array
+            The step of the first state in the block and the block of
+            states.
+        """
+        n_steps = inputs.shape[0]
+
+        for start in range(0, n_steps, CHUNK):
+            stop = min(start + CHUNK, n_steps)
+            drive = (inputs[start:stop] @ self.W_in.T
+                     + feedback[start:stop] @ self.W_feedb.T)
+            noise = self._noise(stop - start, self.n_reservoir)
+            states = np.empty((stop - start, self.n_reservoir),
+                              dtype=self.dtype)
+            for k in range(stop - start):
+                state = np.tanh(self.W @ state + drive[k]) + noise[k]
+                states[k] = state
+            yield start, states
+
+        return
+
+    def harvest(self, inputs, outputs):
+        """
+        This function drives the reservoir with the inputs and the
+        teacher signal and collects the reservoir states.
+
+        Parameters
+        ----------
+        inputs : numpy array
+            The (n_samples, n_inputs) input signal.
+        outputs : numpy array
+            The (n_samples, n_outputs) teacher signal.
+
+        Returns
+        -------
+        states : numpy array
+            The (n_samples, n_reservoir) reservoir states. The first
+            state is zero.
+        """
+        inputs = _as_2d(inputs).astype(self.dtype, copy=False)
+        outputs = _as_2d(outputs).astype(self.dtype, copy=False)
+
+        states = np.zeros((inputs.shape[0], self.n_reservoir),
+                          dtype=self.dtype)
+        for start, block in self._drive(states[0], inputs[1:],
+                                        outputs[:-1]):
+            states[1 + start:1 + start + len(block)] = block
+
+        return states
+
+    def advance(self, state, inputs, outputs, last_output):
+        """
+        This function continues a teacher forced run of the reservoir
+        by a number of steps.
+
+        Parameters
+        ----------
+        state : numpy array
+            The last reservoir state of the run.
+        inputs : numpy array
+            The (n_steps, n_inputs) input signal of the new steps.
+        outputs : numpy array
+            The (n_steps, n_outputs) teacher signal of the new steps.
+        last_output : numpy array
+            The teacher signal at the last step of the run.
+
+        Returns
+        -------
+        states : numpy array
+            The (n_steps, n_reservoir) new reservoir states.
+        """
+        inputs = _as_2d(inputs).astype(self.dtype, copy=False)
+        outputs = _as_2d(outputs).astype(self.dtype, copy=False)
+        feedback = np.vstack((last_output, outputs[:-1])).astype(self.dtype)
+
+        states = np.empty((inputs.shape[0], self.n_reservoir),
+                          dtype=self.dtype)
+        for start, block in self._drive(state, inputs, feedback):
+            states[start:start + len(block)] = block
+
+        return states
+
+    def fit_streaming(self, inputs, outputs, ridge=None):
+        """
+        This function trains the readout without keeping the reservoir
+        states. The states are generated in blocks and only the normal
+        equations, X.T X and X.T Y, are accumulated, so the memory used
+        depends on n_reservoir and not on the number of samples.
+
+        Parameters
+        ----------
+        inputs : numpy array
+            The (n_samples, n_inputs) input signal.
+        outputs : numpy array
+            The (n_samples, n_outputs) teacher signal.
+        ridge : float or None
+            The Tikhonov regularization of the readout. None drops the
+            directions that are zero to working precision, which is
+            less accurate than the pseudo-inverse of fit for badly
+            conditioned states.
+        """
+        inputs = _as_2d(inputs)
+        outputs = _as_2d(outputs)
+        n_features = self.n_reservoir + self.n_inputs
+
+        transient = min(int(inputs.shape[1] / 10), 100)
+        XtX = np.zeros((n_features, n_features))
+        XtY = np.zeros((n_features, self.n_outputs))
+        state = np.zeros(self.n_reservoir, dtype=self.dtype)
+        # the zero initial state is the first row, the driven states
+        # the ones after it
+        blocks = chain([(-1, state[None, :])],
+                       self._drive(state,
+                                   inputs[1:].astype(self.dtype, copy=False),
+                                   outputs[:-1].astype(self.dtype,
+                                                       copy=False)))
+        for start, block in blocks:
+            start += 1
+            stop = start + len(block)
+            skip = max(transient - start, 0)
+            # the normal equations are accumulated in float64
+            X = np.hstack((block, inputs[start:stop]))[skip:].astype(
+                np.float64, copy=False)
+            XtX += X.T @ X
+            XtY += X.T @ outputs[start + skip:stop]
+
+        self.W_out = solve_normal_equations(XtX, XtY, ridge)
+        self.laststate = block[-1]
+        self.lastinput = inputs[-1]
+        self.lastoutput = outputs[-1]
+
+        return
+
+    def fit_readout(self, states, inputs, outputs, ridge=None,
+                    solver='pinv'):
+        """
+        This function solves for the readout weights given harvested
+        states and remembers the last state for prediction.
+
+        Parameters
+        ----------
+        states : numpy array
+            The (n_samples, n_reservoir) harvested states.
+        inputs : numpy array
+            The (n_samples, n_inputs) input signal.
+        outputs : numpy array
+            The (n_samples, n_outputs) teacher signal.
+        ridge : float or None
+            The Tikhonov regularization of the readout.
+        solver : string
+            The least squares solver, one of READOUT_SOLVERS. See
+            solve_readout.
+
+        Returns
+        -------
+        pred_train : numpy array
+            The readout applied to the training states.
+        """
+        inputs = _as_2d(inputs)
+        outputs = _as_2d(outputs)
+
+        transient = min(int(inputs.shape[1] / 10), 100)
+        # the readout is solved in float64 whatever the precision of
+        # the states
+        extended_states = np.hstack((states, inputs)).astype(np.float64,
+                                                             copy=False)
+        self.W_out = solve_readout(extended_states[transient:],
+                                   outputs[transient:], solver, ridge)
+
+        self.laststate = states[-1]
+        self.lastinput = inputs[-1]
+        self.lastoutput = outputs[-1]
+
+        return extended_states @ self.W_out.T
+
+    def fit(self, inputs, outputs):
+        """
+        This function trains the readout on the given input and
+        teacher signals.
+
+        Parameters
+        ----------
+        inputs : numpy array
+            The (n_samples, n_inputs) input signal.
+        outputs : numpy array
+            The (n_samples, n_outputs) teacher signal.
+
+        Returns
+        -------
+        pred_train : numpy array
+            The network output on the training data.
+        """
+        states = self.harvest(inputs, outputs)
+
+        return self.fit_readout(states, inputs, outputs)
+
+    def predict(self, inputs, continuation=True):
+        """
+        This function runs the trained network freely, feeding back
+        its own output. The input terms are projected before the loop,
+        once for constant inputs, and each step reuses the same
+        buffers.
+
+        Parameters
+        ----------
+        inputs : numpy array
+            The (n_samples, n_inputs) input signal.
+        continuation : boolean
+            Start from the last training state if True, otherwise from
+            a zero state.
+
+        Returns
+        -------
+        outputs : numpy array
+            The (n_samples, n_outputs) predicted signal.
+        """
+        inputs = _as_2d(inputs).astype(self.dtype, copy=False)
+        n_samples = inputs.shape[0]
+        n = self.n_reservoir
+        W_out = self.W_out.astype(self.dtype, copy=False)
+        W_state = np.ascontiguousarray(W_out[:, :n])
+        drive, input_output = _input_terms(inputs, self.W_in, W_out[:, n:])
+        # drawn at once, in the order of the steps
+        noise = self._noise(n_samples, n)
+
+        state = np.zeros(n, dtype=self.dtype)
+        outputs = np.zeros((n_samples + 1, self.n_outputs), dtype=self.dtype)
+        if continuation:
+            state[:] = self.laststate
+            outputs[0] = self.lastoutput
+
+        dense = not sparse.issparse(self.W)
+        preactivation = np.empty(n, dtype=self.dtype)
+        feedback = np.empty(n, dtype=self.dtype)
+        for k in range(n_samples):
+            if dense:
+                np.dot(self.W, state, out=preactivation)
+            else:
+                preactivation[:] = self.W @ state
+            preactivation += drive[k]
+            preactivation += np.dot(self.W_feedb, outputs[k], out=feedback)
+            np.tanh(preactivation, out=state)
+            state += noise[k]
+            np.dot(W_state, state, out=outputs[k + 1])
+            outputs[k + 1] += input_output[k]
+
+        return outputs[1:]
+
+
+def _batch_matvec(esns):
+    """
+    This function builds the recurrent product of a batch of
+    reservoirs of the same size. Reservoirs that share their unit
+    reservoir and only differ in spectral radius are advanced with a
+    single matrix-matrix product, and the remaining sparse reservoirs
+    are joined into one block diagonal matrix.
+
+    Parameters
+    ----------
+    esns : list
+        The SparseESN of each reservoir. A dense reservoir must share
+        its unit reservoir with another one of the batch.
+
+    Returns
+    -------
+    matvec : function
+        Maps the (K, n_reservoir) states to the (K, n_reservoir)
+        recurrent products, W_k @ state_k for each reservoir k.
+    """
+    groups = OrderedDict()
+    for k, esn in enumerate(esns):
+        groups.setdefault(id(esn.W_unit), (esn.W_unit, []))[1].append(k)
+
+    shared = [(W, members) for W, members in groups.values()
+              if len(members) > 1]
+    single = [members[0] for W, members in groups.values()
+              if len(members) == 1]
+    assert(all(sparse.issparse(esns[k].W_unit) for k in single)
+           ), "Unshared dense reservoirs cannot be batched."
+
+    n = esns[0].n_reservoir
+    rhos = np.array([esn.spectral_radius for esn in esns],
+                    dtype=esns[0].dtype)[:, None]
+    if single:
+        block = sparse.block_diag([esns[k].W_unit for k in single],
+                                  format='csr')
+
+    def matvec(states):
+        products = np.empty_like(states)
+        for W, members in shared:
+            products[members] = (W @ states[members].T).T
+        if single:
+            products[single] = (
+                block @ states[single].ravel()).reshape(-1, n)
+        return products * rhos
+
+    return matvec
+
+
+def _split_batch(esns):
+    """
+    This function separates the reservoirs of a batch that gain from
+    being advanced together from the dense reservoirs that do not share
+    their unit reservoir with any other. Those are cheaper to advance
+    one after the other, since each step then reads a single matrix
+    that stays in cache instead of all of them.
+
+    Parameters
+    ----------
+    esns : list
+        The SparseESN of each reservoir.
+
+    Returns
+    -------
+    together, alone : list
+        The positions in the batch of each kind of reservoir.
+    """
+    assert(len(esns) > 0), "The batch is empty."
+    first = esns[0]
+    counts = {}
+    for esn in esns:
+        assert(isinstance(esn, SparseESN)
+               ), "Batches need SparseESN reservoirs."
+        assert((esn.n_reservoir, esn.n_inputs, esn.n_outputs, esn.dtype)
+               == (first.n_reservoir, first.n_inputs, first.n_outputs,
+                   first.dtype)
+               ), "The reservoirs of a batch must have the same size."
+        counts[id(esn.W_unit)] = counts.get(id(esn.W_unit), 0) + 1
+
+    alone = [k for k, esn in enumerate(esns)
+             if counts[id(esn.W_unit)] == 1
+             and not sparse.issparse(esn.W_unit)]
+    together = [k for k in range(len(esns)) if k not in alone]
+
+    return together, alone
+
+
+def harvest_batch(esns, inputs, outputs):
+    """
+    This function drives a batch of reservoirs of the same size with
+    the same inputs and teacher signal. Reservoirs that share their
+    unit reservoir, and sparse reservoirs, are advanced together, see
+    _batch_matvec. Each reservoir draws its noise from its own random
+    state in the same order as SparseESN.harvest, so the states only
+    differ from separate harvests by rounding.
+
+    Parameters
+    ----------
+    esns : list
+        The SparseESN of each reservoir.
+    inputs : numpy array
+        The (n_samples, n_inputs) input signal.
+    outputs : numpy array
+        The (n_samples, n_outputs) teacher signal.
+
+    Returns
+    -------
+    states : numpy array
+        The (K, n_samples, n_reservoir) reservoir states of each of the
+        K reservoirs. The first state is zero.
+    """
+    together, alone = _split_batch(esns)
+    dtype = esns[0].dtype
+    inputs = _as_2d(inputs).astype(dtype, copy=False)
+    outputs = _as_2d(outputs).astype(dtype, copy=False)
+
+    n = esns[0].n_reservoir
+    states = np.zeros((len(esns), inputs.shape[0], n), dtype=dtype)
+    for k in alone:
+        states[k] = esns[k].harvest(inputs, outputs)
+    if not together:
+        return states
+
+    batch = [esns[k] for k in together]
+    matvec = _batch_matvec(batch)
+    W_in = np.stack([esn.W_in.T for esn in batch], axis=1)
+    W_feedb = np.stack([esn.W_feedb.T for esn in batch], axis=1)
+
+    n_steps = inputs.shape[0] - 1
+    # each step is written straight into the output, so no second
+    # (n_samples, K, n_reservoir) buffer doubles the memory
+    together = np.asarray(together)
+    state = np.zeros((len(batch), n), dtype=dtype)
+    for start in range(0, n_steps, CHUNK):
+        stop = min(start + CHUNK, n_steps)
+        drive = (np.tensordot(inputs[1 + start:1 + stop], W_in, axes=1)
+                 + np.tensordot(outputs[start:stop], W_feedb, axes=1))
+        noise = np.stack([esn._noise(stop - start, n) for esn in batch],
+                         axis=1)
+        for j in range(stop - start):
+            state = np.tanh(matvec(state) + drive[j]) + noise[j]
+            states[together, 1 + start + j] = state
+
+    return states
+
+
+def predict_batch(esns, inputs):
+    """
+    This function runs a batch of trained reservoirs of the same size
+    freely, each feeding back its own output, continuing from the last
+    training state of each. The reservoirs are grouped as in
+    harvest_batch. See SparseESN.predict.
+
+    Parameters
+    ----------
+    esns : list
+        The trained SparseESN of each reservoir.
+    inputs : numpy array
+        The (n_samples, n_inputs) input signal, shared by the batch.
+
+    Returns
+    -------
+    outputs : numpy array
+        The (K, n_samples, n_outputs) predicted signal of each of the
+        K reservoirs.
+    """
+    together, alone = _split_batch(esns)
+    dtype = esns[0].dtype
+    inputs = _as_2d(inputs).astype(dtype, copy=False)
+    n_samples = inputs.shape[0]
+
+    outputs = np.zeros((len(esns), n_samples, esns[0].n_outputs),
+                       dtype=dtype)
+    for k in alone:
+        outputs[k] = esns[k].predict(inputs)
+    if not together:
+        return outputs
+
+    batch = [esns[k] for k in together]
+    matvec = _batch_matvec(batch)
+    W_in = np.stack([esn.W_in for esn in batch])
+    W_feedb = np.stack([esn.W_feedb for esn in batch])
+    W_state = np.stack([esn.W_out[:, :esn.n_reservoir]
+                        for esn in batch]).astype(dtype, copy=False)
+    W_input = np.stack([esn.W_out[:, esn.n_reservoir:]
+                        for esn in batch]).astype(dtype, copy=False)
+    drive, input_output = _input_terms(inputs, W_in, W_input)
+    noise = np.stack([esn._noise(n_samples, esn.n_reservoir)
+                      for esn in batch], axis=1)
+
+    state = np.stack([esn.laststate for esn in batch]).astype(dtype)
+    output = np.stack([esn.lastoutput for esn in batch]).astype(dtype)
+    for k in range(n_samples):
+        preactivation = matvec(state)
+        preactivation += drive[k]
+        preactivation += np.matmul(W_feedb, output[:, :, None])[:, :, 0]
+        np.tanh(preactivation, out=state)
+        state += noise[k]
+        output = np.matmul(W_state, state[:, :, None])[:, :, 0]
+        output += input_output[k]
+        outputs[together, k] = output
+
+    return outputs
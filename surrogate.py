@@ -0,0 +1,279 @@
+import copy
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
+from scipy.optimize import minimize
+from scipy.stats import norm
+
+# Bounds of the log hyperparameters: length scales, amplitude and noise,
+# for inputs scaled to the unit cube and standardized targets.
+LENGTH_BOUNDS = (np.log(1e-2), np.log(1e1))
+AMPLITUDE_BOUNDS = (np.log(1e-2), np.log(1e2))
+NOISE_BOUNDS = (np.log(1e-8), np.log(1e0))
+
+
+def matern52(X1, X2, length_scale, amplitude=1.0):
+    """
+    This function computes the Matern 5/2 covariance between two sets
+    of points, with one length scale per dimension.
+
+    Parameters
+    ----------
+    X1 : numpy array
+        The (n, d) first set of points.
+    X2 : numpy array
+        The (m, d) second set of points.
+    length_scale : numpy array
+        The (d,) length scales.
+    amplitude : float
+        The variance of the process.
+
+    Returns
+    -------
+    K : numpy array
+        The (n, m) covariance matrix.
+    """
+    diff = (X1[:, None, :] - X2[None, :, :]) / length_scale
+    r = np.sqrt(5 * np.sum(diff**2, axis=-1))
+
+    return amplitude * (1 + r + r**2 / 3) * np.exp(-r)
+
+
+class GaussianProcess:
+    """
+    A Gaussian process regressor with a Matern 5/2 kernel, whose length
+    scales, amplitude and noise are fitted by maximizing the marginal
+    likelihood. The targets are standardized before fitting.
+
+    Parameters
+    ----------
+    length_scale : float
+        The initial length scale of every dimension.
+    noise : float
+        The initial noise variance, relative to the target variance.
+    optimize : boolean
+        Fit the hyperparameters to the data. Otherwise the initial
+        values are kept.
+    n_restarts : int
+        The number of random starts of the hyperparameter fit, in
+        addition to the initial values.
+    random_state : int, numpy RandomState or None
+        The seed of the random restarts.
+    """
+
+    def __init__(self, length_scale=0.3, noise=1e-4, optimize=True,
+                 n_restarts=2, random_state=None):
+        self.length_scale = length_scale
+        self.noise = noise
+        self.optimize = optimize
+        self.n_restarts = n_restarts
+        if isinstance(random_state, np.random.RandomState):
+            self.random_state_ = random_state
+        else:
+            self.random_state_ = np.random.RandomState(random_state)
+        self.theta_ = None
+
+    def _unpack(self, theta):
+        """
+        This function splits the log hyperparameters into the length
+        scales, amplitude and noise.
+        """
+        theta = np.exp(theta)
+        return theta[:-2], theta[-2], theta[-1]
+
+    def _neg_log_likelihood(self, theta, X, y):
+        """
+        This function returns the negative log marginal likelihood of
+        the standardized targets for the log hyperparameters theta.
+        """
+        length_scale, amplitude, noise = self._unpack(theta)
+        K = matern52(X, X, length_scale, amplitude)
+        K[np.diag_indices_from(K)] += noise
+        try:
+            factor = cho_factor(K, lower=True)
+        except LinAlgError:
+            return np.inf
+        alpha = cho_solve(factor, y)
+
+        return (0.5 * y @ alpha + np.sum(np.log(np.diag(factor[0])))
+                + 0.5 * len(y) * np.log(2 * np.pi))
+
+    def fit(self, X, y, optimize=None):
+        """
+        This function fits the process to the observations.
+
+        Parameters
+        ----------
+        X : numpy array
+            The (n, d) observed points.
+        y : numpy array
+            The (n,) observed values.
+        optimize : boolean or None
+            Overrides the optimize attribute for this fit. Without
+            optimization, the hyperparameters of the previous fit are
+            kept.
+
+        Returns
+        -------
+        self : GaussianProcess
+            The fitted process.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        y = np.asarray(y, dtype=float).ravel()
+        assert(len(X) == len(y)), "X and y have different lengths."
+
+        self.X_ = X
+        self.y_mean_ = np.mean(y)
+        self.y_scale_ = np.std(y) if np.std(y) > 0 else 1.0
+        z = (y - self.y_mean_) / self.y_scale_
+
+        if optimize is None:
+            optimize = self.optimize
+        d = X.shape[1]
+        if self.theta_ is None or len(self.theta_) != d + 2:
+            self.theta_ = np.log(np.r_[np.full(d, self.length_scale),
+                                       1.0, self.noise])
+
+        if optimize and len(y) > 1:
+            bounds = [LENGTH_BOUNDS] * d + [AMPLITUDE_BOUNDS, NOISE_BOUNDS]
+            starts = [self.theta_]
+            for _ in range(self.n_restarts):
+                starts.append(np.array([self.random_state_.uniform(*b)
+                                        for b in bounds]))
+            best = None
+            for start in starts:
+                result = minimize(self._neg_log_likelihood, start,
+                                  args=(X, z), method='L-BFGS-B',
+                                  bounds=bounds)
+                if best is None or result.fun < best.fun:
+                    best = result
+            if np.isfinite(best.fun):
+                self.theta_ = best.x
+
+        length_scale, amplitude, noise = self._unpack(self.theta_)
+        K = matern52(X, X, length_scale, amplitude)
+        # a little jitter keeps the factorization stable for duplicates
+        K[np.diag_indices_from(K)] += noise + 1e-10
+        self.factor_ = cho_factor(K, lower=True)
+        self.alpha_ = cho_solve(self.factor_, z)
+
+        return self
+
+    def predict(self, X):
+        """
+        This function returns the posterior mean and standard deviation
+        of the process.
+
+        Parameters
+        ----------
+        X : numpy array
+            The (m, d) points to predict.
+
+        Returns
+        -------
+        mean, std : numpy array
+            The (m,) posterior mean and standard deviation.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        length_scale, amplitude, _ = self._unpack(self.theta_)
+        Ks = matern52(X, self.X_, length_scale, amplitude)
+
+        mean = Ks @ self.alpha_
+        v = cho_solve(self.factor_, Ks.T)
+        var = np.maximum(amplitude - np.sum(Ks * v.T, axis=1), 0)
+
+        return (mean * self.y_scale_ + self.y_mean_,
+                np.sqrt(var) * self.y_scale_)
+
+
+def expected_improvement(mean, std, best):
+    """
+    This function computes the expected improvement over the smallest
+    observed value, for a minimization.
+
+    Parameters
+    ----------
+    mean : numpy array
+        The posterior mean of each candidate.
+    std : numpy array
+        The posterior standard deviation of each candidate.
+    best : float
+        The smallest observed value.
+
+    Returns
+    -------
+    ei : numpy array
+        The expected improvement of each candidate.
+    """
+    mean = np.asarray(mean, dtype=float)
+    std = np.asarray(std, dtype=float)
+    improvement = best - mean
+
+    ei = np.maximum(improvement, 0)
+    uncertain = std > 0
+    z = improvement[uncertain] / std[uncertain]
+    ei[uncertain] = (improvement[uncertain] * norm.cdf(z)
+                     + std[uncertain] * norm.pdf(z))
+
+    return ei
+
+
+def propose_batch(gp, X, y, n_points, n_candidates=2000, random_state=None):
+    """
+    This function proposes a batch of points in the unit cube that
+    maximize the expected improvement. After each pick, a copy of the
+    process is refitted as if the pick had returned its posterior mean,
+    so the following picks explore elsewhere. The process passed in is
+    left fitted to X and y.
+
+    Parameters
+    ----------
+    gp : GaussianProcess
+        The process, with its hyperparameters fitted to X and y.
+    X : numpy array
+        The (n, d) observed points, in the unit cube.
+    y : numpy array
+        The (n,) observed values.
+    n_points : int
+        The number of points to propose.
+    n_candidates : int
+        The number of random candidates the expected improvement is
+        maximized over. Half of them are drawn uniformly, the other
+        half around the best observations.
+    random_state : int, numpy RandomState or None
+        The seed of the candidates.
+
+    Returns
+    -------
+    batch : numpy array
+        The (n_points, d) proposed points.
+    """
+    if isinstance(random_state, np.random.RandomState):
+        rng = random_state
+    else:
+        rng = np.random.RandomState(random_state)
+
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    y = np.asarray(y, dtype=float).ravel()
+    d = X.shape[1]
+    best = np.min(y)
+
+    uniform = rng.uniform(size=(n_candidates // 2, d))
+    centers = X[np.argsort(y)[:5]]
+    local = (centers[rng.randint(len(centers), size=n_candidates // 2)]
+             + 0.05 * rng.standard_normal((n_candidates // 2, d)))
+    candidates = np.clip(np.vstack([uniform, local]), 0, 1)
+
+    batch = []
+    X_fant, y_fant = X, y
+    gp = copy.deepcopy(gp)
+    for _ in range(n_points):
+        mean, std = gp.predict(candidates)
+        pick = np.argmax(expected_improvement(mean, std, best))
+        batch.append(candidates[pick])
+
+        X_fant = np.vstack([X_fant, candidates[pick]])
+        y_fant = np.append(y_fant, mean[pick])
+        gp.fit(X_fant, y_fant, optimize=False)
+        candidates = np.delete(candidates, pick, axis=0)
+
+    return np.array(batch)
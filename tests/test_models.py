@@ -0,0 +1,182 @@
+import os
+import pytest
+import numpy as np
+from pytest import approx
+from lorenz import generate_L96
+from tools import esn_scenario
+from reservoir import SparseESN
+from models import *
+
+# =========================================================
+# Set up code
+# =========================================================
+q = np.arange(0, 30.0, 0.01)
+x = generate_L96(q)[-500:]
+params = {
+    'n_reservoir': 200,
+    'sparsity': 0.9,
+    'rand_seed': 85,
+    'rho': 1.2,
+    'noise': 0.001,
+    'future': 20,
+    'window': 20,
+    'trainlen': 500,
+    'backend': 'sparse'
+}
+# =========================================================
+# =========================================================
+
+
+@pytest.mark.parametrize('options', [{}, {'sparsity': 0.1},
+                                     {'dtype': 'float32'},
+                                     {'backend': 'pyesn'}])
+def test_save_load_model(tmp_path, options):
+    """
+    A saved network loads as a SparseESN that predicts
+    what the trained network predicts, noise included,
+    with its arrays memory-mapped.
+    """
+    model_params = dict(params, **options)
+    _, esn = esn_scenario(x, model_params)
+    save_model(tmp_path / 'model', esn, model_params)
+    expected = esn.predict(np.ones((20, x.shape[1])))
+
+    loaded, loaded_params, norms = load_model(tmp_path / 'model')
+    obs = loaded.predict(np.ones((20, x.shape[1])))
+
+    assert isinstance(loaded, SparseESN)
+    assert isinstance(loaded.W_out, np.memmap)
+    assert loaded_params == model_params
+    assert norms is None
+    assert obs.dtype == expected.dtype
+    assert obs == approx(expected, abs=1e-6)
+
+    return
+
+
+def test_model_forecast(tmp_path):
+    """
+    The forecast of a saved model is scaled back by the
+    data norms, for the saved or given horizon.
+    """
+    norms = np.array([2.0] * x.shape[1])
+    scenario, esn = esn_scenario(x, dict(params, noise=0))
+    save_model(tmp_path / 'model', esn, params, data_norms=norms)
+
+    forecast = model_forecast(tmp_path / 'model', mmap=False)
+    assert forecast == approx(2 * scenario)
+    forecast = model_forecast(tmp_path / 'model', future=5)
+    assert forecast.shape == (5, x.shape[1])
+
+    return
+
+
+def test_save_model_overwrite(tmp_path):
+    """
+    Saving over a model replaces all of it, leaving no
+    array of the old model behind.
+    """
+    _, dense = esn_scenario(x, dict(params, sparsity=0.1))
+    save_model(tmp_path / 'model', dense, params)
+    _, esn = esn_scenario(x, params)
+    save_model(tmp_path / 'model', esn, params)
+
+    assert not os.path.exists(tmp_path / 'model' / 'W.npy')
+    assert sorted(os.listdir(tmp_path)) == ['model']
+    loaded, _, _ = load_model(tmp_path / 'model', mmap=False)
+    assert loaded.predict(np.ones((20, x.shape[1]))) == approx(
+        esn.predict(np.ones((20, x.shape[1]))), abs=1e-6)
+
+    return
+
+
+def test_save_model_foreign_directory(tmp_path):
+    """
+    A directory holding other files than a model is not
+    replaced, and its files are kept.
+    """
+    _, esn = esn_scenario(x, params)
+    (tmp_path / 'model').mkdir()
+    (tmp_path / 'model' / 'data.csv').write_text('time,kw\n')
+    with pytest.raises(AssertionError):
+        save_model(tmp_path / 'model', esn, params)
+    assert os.listdir(tmp_path / 'model') == ['data.csv']
+
+    (tmp_path / 'empty').mkdir()
+    save_model(tmp_path / 'empty', esn, params)
+    assert os.path.exists(tmp_path / 'empty' / 'model.json')
+
+    return
+
+
+def test_load_incomplete_model(tmp_path):
+    """
+    An untrained network cannot be saved, and a model
+    without its metadata cannot be loaded.
+    """
+    esn = SparseESN(3, 3, n_reservoir=50, random_state=85)
+    with pytest.raises(AssertionError):
+        save_model(tmp_path / 'model', esn, params)
+
+    os.makedirs(tmp_path / 'model')
+    with pytest.raises(FileNotFoundError):
+        load_model(tmp_path / 'model')
+
+    return
+
+
+@pytest.mark.parametrize('forgetting', [1.0, 0.98])
+def test_online_forecaster_updates(forgetting):
+    """
+    Learning a series one observation at a time gives
+    the readout and state of fitting it in one batch,
+    and of fitting a prefix and updating on the rest.
+    """
+    series = x[:300, :2]
+
+    def network():
+        return SparseESN(1, 2, n_reservoir=100, sparsity=0.9,
+                         spectral_radius=0.9, noise=1e-3,
+                         random_state=85)
+
+    streamed = OnlineForecaster(network(), forgetting, ridge=1e-2)
+    for value in series:
+        streamed.update(value, inputs=[1.0])
+    batch = OnlineForecaster(network(), forgetting, ridge=1e-2).fit(series)
+    resumed = OnlineForecaster(network(), forgetting,
+                               ridge=1e-2).fit(series[:200])
+    for value in series[200:]:
+        resumed.update(value)
+
+    for other in [batch, resumed]:
+        assert other.esn.laststate == approx(streamed.esn.laststate)
+        assert other.esn.W_out == approx(streamed.esn.W_out, rel=1e-5,
+                                         abs=1e-8)
+        assert other.P == approx(streamed.P, rel=1e-5, abs=1e-8)
+
+    return
+
+
+def test_online_forecaster_forecast(tmp_path):
+    """
+    A forecaster continues a saved model, and its
+    forecast does not move the current state or the
+    state noise.
+    """
+    _, esn = esn_scenario(x, params)
+    save_model(tmp_path / 'model', esn, params)
+    forecaster = OnlineForecaster(load_model(tmp_path / 'model')[0])
+
+    errors = [forecaster.update(value) for value in x[-50:]]
+    state = forecaster.esn.laststate.copy()
+    forecast = forecaster.forecast(24)
+
+    assert forecast.shape == (24, x.shape[1])
+    assert np.all(np.isfinite(errors))
+    assert np.array_equal(forecaster.esn.laststate, state)
+    assert np.array_equal(forecaster.forecast(24), forecast)
+
+    with pytest.raises(AssertionError):
+        OnlineForecaster(esn, forgetting=0)
+
+    return
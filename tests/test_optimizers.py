@@ -1,8 +1,11 @@
+import os
 import pytest
 import numpy as np
 import numpy.random as rd
-from tools import MSE, optimal_values, esn_prediction
-from optimizers import grid_optimizer
+from tools import MSE, optimal_values, esn_prediction, esn_partial_prediction
+import optimizers
+from optimizers import grid_optimizer, read_checkpoint, successive_halving
+from optimizers import grid_search, bayesian_optimizer, incremental_optimizer
 
 # =========================================================
 # Set up code
@@ -129,3 +132,433 @@ def test_grid_optimize_7():
                               yset=reservoir_set)
 
     return
+
+
+def test_grid_optimize_ridge():
+    """
+    A ridge axis gives the same losses as evaluating
+    each ridge value separately.
+    """
+    ridge_params = dict(params, ridge=None, noise=0, backend='sparse')
+    ridges = [1e-6, 1e-3, 1e-1]
+    loss = grid_optimizer(X_in.T, ridge_params, args=['rho', 'ridge'],
+                          xset=[0.7, 1.1], yset=ridges)
+    for x, rho in enumerate([0.7, 1.1]):
+        for y, ridge in enumerate(ridges):
+            cell = dict(ridge_params, rho=rho, ridge=ridge)
+            predicted = esn_prediction(X_in.T, cell)
+            exp = MSE(predicted, X_in.T[-params['future']:])
+            assert loss[x, y] == pytest.approx(exp)
+
+    return
+
+
+def test_grid_optimize_n_jobs():
+    """
+    Spreading the cells over a process pool gives the same losses
+    and leaves params unchanged.
+    """
+    before = dict(params)
+    serial = grid_optimizer(X_in.T, params, args=['rho', 'noise'],
+                            xset=[0.7, 1.1], yset=[0.001, 0.003])
+    pooled = grid_optimizer(X_in.T, params, args=['rho', 'noise'],
+                            xset=[0.7, 1.1], yset=[0.001, 0.003],
+                            n_jobs=2)
+    assert np.array_equal(serial, pooled)
+    assert params == before
+
+    return
+
+
+def test_grid_optimize_resume(tmp_path, monkeypatch):
+    """
+    Resuming an interrupted grid only evaluates the missing cells
+    and gives the same losses as an uninterrupted run.
+    """
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('data')
+    grid = dict(args=['rho', 'noise'], xset=[0.7, 1.1], yset=[0.001, 0.003],
+                save_path='resume')
+    full = grid_optimizer(X_in.T, params, **grid)
+    checkpoint = os.path.join('data', 'resume_rho_noise_cells.jsonl')
+    assert len(read_checkpoint(checkpoint)) == 4
+
+    # keep two cells and a line cut short by the interruption
+    with open(checkpoint) as file:
+        lines = file.readlines()
+    with open(checkpoint, 'w') as file:
+        file.writelines(lines[:2])
+        file.write(lines[2][:20])
+
+    calls = []
+
+    def counted(*args, **kwargs):
+        calls.append(args[1])
+        return esn_partial_prediction(*args, **kwargs)
+
+    monkeypatch.setattr(optimizers, 'esn_partial_prediction', counted)
+    resumed = grid_optimizer(X_in.T, params, resume=True, **grid)
+    assert np.array_equal(full, resumed)
+    assert len(calls) == 2
+    # the cut line is dropped, and the resumed cells are readable
+    cells = read_checkpoint(checkpoint)
+    assert len(cells) == 4
+    assert sorted(loss for loss, _ in cells.values()) == pytest.approx(
+        sorted(full.ravel()))
+
+    # another dataset does not reuse the cells
+    other = grid_optimizer(X_in.T[::-1].copy(), params, resume=True, **grid)
+    assert len(calls) == 6
+    assert not np.array_equal(full, other)
+
+    return
+
+
+def test_grid_optimize_cache_states(monkeypatch):
+    """
+    In a sweep over the readout, cells that share their reservoir
+    harvest its states once, and the losses are unchanged.
+    """
+    import tools
+    harvests = []
+
+    def counted(*args):
+        harvests.append(1)
+        return harvest(*args)
+
+    harvest = tools._harvest_states
+    monkeypatch.setattr(tools, '_harvest_states', counted)
+    sweep_params = dict(params, n_reservoir=200, ridge=1e-6,
+                        readout_solver='pinv')
+    grid = dict(args=['readout_solver', 'rho'], xset=['pinv', 'qr'],
+                yset=[0.7, 1.1])
+
+    tools.clear_state_cache()
+    full = grid_optimizer(X_in.T, sweep_params, **grid)
+    assert len(harvests) == 4 * 5
+    cached = grid_optimizer(X_in.T, sweep_params, cache_states=True, **grid)
+    # one harvest per window and spectral radius
+    assert len(harvests) == 4 * 5 + 2 * 5
+    assert np.array_equal(full, cached)
+    tools.clear_state_cache()
+
+    return
+
+
+def test_successive_halving():
+    """
+    Successive halving keeps the best third of the grid after the
+    first round, and the survivors have the same loss as in the full
+    grid.
+    """
+    rho_set = [0.5, 0.7, 0.9]
+    noise_set = [0.0001, 0.001, 0.003]
+    full = grid_optimizer(X_in.T, params, args=['rho', 'noise'],
+                          xset=rho_set, yset=noise_set)
+    loss = successive_halving(X_in.T, params, args=['rho', 'noise'],
+                              xset=rho_set, yset=noise_set)
+
+    survivors = np.isfinite(loss)
+    assert survivors.sum() == 3
+    assert np.array_equal(loss[survivors], full[survivors])
+    assert survivors[np.unravel_index(np.argmin(loss), loss.shape)]
+
+    with pytest.raises(AssertionError):
+        successive_halving(X_in.T, params, args=['trainlen'],
+                           xset=trainingLengths)
+
+    return
+
+
+def test_successive_halving_diverged(monkeypatch):
+    """
+    Diverged configurations are dropped first, and a
+    budget below the minimum is rejected.
+    """
+    def diverged(data, cell, **kwargs):
+        prediction, n_predicted = esn_partial_prediction(data, cell,
+                                                         **kwargs)
+        if cell['rho'] == 0.5:
+            prediction[:] = np.nan
+        return prediction, n_predicted
+
+    monkeypatch.setattr(optimizers, 'esn_partial_prediction', diverged)
+    rho_set = [0.5, 0.7, 0.9]
+    noise_set = [0.0001, 0.001, 0.003]
+    loss = successive_halving(X_in.T, params, args=['rho', 'noise'],
+                              xset=rho_set, yset=noise_set)
+    assert np.isinf(loss[0]).all()
+    assert np.isfinite(loss).sum() == 3
+
+    with pytest.raises(AssertionError):
+        successive_halving(X_in.T, params, args=['rho'], xset=rho_set,
+                           budgets=[0, params['trainlen']])
+
+    return
+
+
+def test_grid_search():
+    """
+    A joint search over three parameters gives the losses of
+    separate predictions, and a subsample only evaluates the
+    requested number of cells.
+    """
+    space = {'rho': [0.7, 1.1], 'noise': [0.001, 0.003],
+             'n_reservoir': [100, 200]}
+    loss, best = grid_search(X_in.T, params, space, top_k=3)
+    assert loss.shape == (2, 2, 2)
+
+    settings, best_loss = best[0]
+    predicted = esn_prediction(X_in.T, dict(params, **settings))
+    assert best_loss == MSE(predicted, X_in.T[-params['future']:])
+    assert best_loss == np.min(loss)
+    assert [b[1] for b in best] == sorted(loss.ravel())[:3]
+
+    sample, best = grid_search(X_in.T, params, space, order='random',
+                               max_cells=3, random_state=1)
+    assert np.sum(~np.isnan(sample)) == 3
+    assert np.array_equal(sample[~np.isnan(sample)], loss[~np.isnan(sample)])
+
+    prioritized, best = grid_search(X_in.T, params, space,
+                                    order=[(1, 1, 1), (0, 0, 0)], n_jobs=2)
+    assert prioritized[1, 1, 1] == loss[1, 1, 1]
+    assert prioritized[0, 0, 0] == loss[0, 0, 0]
+    assert np.sum(~np.isnan(prioritized)) == 2
+
+    with pytest.raises(AssertionError):
+        grid_search(X_in.T, params, space, order='grd')
+
+    return
+
+
+def test_grid_search_single_cell(monkeypatch):
+    """
+    A single cell is evaluated in this process, without
+    starting a pool.
+    """
+    space = {'rho': [0.7, 1.1], 'noise': [0.001, 0.003]}
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("pool started for a single cell")
+
+    monkeypatch.setattr(optimizers, 'shared_pool', no_pool)
+    loss, best = grid_search(X_in.T, params, space, order=[(1, 0)],
+                             n_jobs=2)
+    predicted = esn_prediction(X_in.T, dict(params, rho=1.1, noise=0.001))
+    assert loss[1, 0] == MSE(predicted, X_in.T[-params['future']:])
+
+    return
+
+
+def test_grid_optimize_prune():
+    """
+    Pruning keeps the losses of the cells it completes and
+    the optimum, while divergent cells are cut short with
+    a partial loss above the optimum.
+    """
+    grid = dict(args=['rho', 'noise'], xset=[0.5, 3.0], yset=[1e-4, 1e-2])
+    full = grid_optimizer(X_in.T, params, **grid)
+    pruned = np.zeros(full.shape, dtype=bool)
+    loss = grid_optimizer(X_in.T, params, prune=True, pruned_mask=pruned,
+                          **grid)
+
+    assert np.array_equal(loss[~pruned], full[~pruned])
+    assert pruned.any()
+    assert np.all(loss[pruned] > np.min(full))
+    assert np.all(loss[pruned] <= full[pruned])
+    assert np.argmin(loss) == np.argmin(full)
+
+    return
+
+
+def test_grid_optimize_diverged(monkeypatch):
+    """
+    A cell whose prediction diverges to NaN has a NaN loss,
+    is not marked as pruned, and is not the optimum.
+    """
+    def diverged(data, cell, **kwargs):
+        prediction, n_predicted = esn_partial_prediction(data, cell,
+                                                         **kwargs)
+        if cell['rho'] == 0.5:
+            prediction[:] = np.nan
+        return prediction, n_predicted
+
+    monkeypatch.setattr(optimizers, 'esn_partial_prediction', diverged)
+    pruned = np.ones((2, 1), dtype=bool)
+    loss = grid_optimizer(X_in.T, params, ['rho', 'noise'], [0.5, 0.7],
+                          [1e-3], pruned_mask=pruned)
+
+    assert np.isnan(loss[0, 0]) and np.isfinite(loss[1, 0])
+    assert not pruned.any()
+    assert optimal_values(loss, [0.5, 0.7], [1e-3]) == (0.7, 1e-3)
+
+    return
+
+
+def test_bayesian_optimizer():
+    """
+    The Bayesian optimizer evaluates the budget within the
+    bounds, starts from a warm start grid, and reports the
+    best configuration it has seen.
+    """
+    bounds = {'rho': (0.5, 1.5), 'noise': (1e-4, 1e-2)}
+    space = {'rho': [0.7, 1.1], 'noise': [0.001, 0.003]}
+    grid, _ = grid_search(X_in.T, params, space)
+
+    best, history = bayesian_optimizer(X_in.T, params, bounds, budget=6,
+                                       batch_size=2,
+                                       warm_start=[(grid, space)],
+                                       random_state=0)
+    assert len(history) == 10
+    assert [loss for _, loss in history[:4]] == list(grid.ravel())
+    assert best[1] == min(loss for _, loss in history)
+
+    for settings, loss in history[4:]:
+        assert 0.5 <= settings['rho'] <= 1.5
+        assert 1e-4 <= settings['noise'] <= 1e-2
+
+    settings, loss = history[-1]
+    predicted = esn_prediction(X_in.T, dict(params, **settings))
+    assert loss == MSE(predicted, X_in.T[-params['future']:])
+
+    return
+
+
+def test_bayesian_optimizer_diverged(monkeypatch):
+    """
+    Diverged configurations are fitted by the surrogate
+    as the worst finite loss, and are never the best.
+    """
+    def diverged(data, cell, **kwargs):
+        prediction, n_predicted = esn_partial_prediction(data, cell,
+                                                         **kwargs)
+        if cell['rho'] > 1:
+            prediction[:] = np.nan
+        return prediction, n_predicted
+
+    targets = []
+    fit = optimizers.GaussianProcess.fit
+
+    def recording_fit(self, X, y, **kwargs):
+        targets.append(np.array(y))
+        return fit(self, X, y, **kwargs)
+
+    monkeypatch.setattr(optimizers, 'esn_partial_prediction', diverged)
+    monkeypatch.setattr(optimizers.GaussianProcess, 'fit', recording_fit)
+    bounds = {'rho': (0.5, 1.5), 'noise': (1e-4, 1e-2)}
+    best, history = bayesian_optimizer(X_in.T, params, bounds, budget=8,
+                                       batch_size=2, random_state=0)
+
+    losses = np.array([loss for _, loss in history])
+    assert np.isnan(losses).any()
+    assert targets and all(np.isfinite(y).all() for y in targets)
+    assert np.isfinite(best[1]) and best[1] == np.nanmin(losses)
+
+    return
+
+
+def test_incremental_optimizer():
+    """
+    Starting from the optimum of an earlier surface only evaluates
+    its neighborhood, and a stale optimum is followed across the
+    grid while the boundary of the neighborhood keeps winning.
+    """
+    small = dict(params, n_reservoir=100)
+    space = {'rho': [0.3, 0.5, 0.7, 0.9, 1.1, 1.3],
+             'noise': [1e-4, 1e-3, 1e-2]}
+    full, _ = grid_search(X_in.T, small, space)
+
+    loss, best = incremental_optimizer(X_in.T, small, space, previous=full)
+    evaluated = ~np.isnan(loss)
+    assert evaluated.sum() < full.size
+    assert np.array_equal(loss[evaluated], full[evaluated])
+    assert best[0][1] == np.min(full)
+
+    # an earlier optimum in the opposite corner of the grid
+    stale = np.ones(full.shape)
+    stale[-1, -1] = 0
+    loss, best = incremental_optimizer(X_in.T, small, space, previous=stale)
+    evaluated = ~np.isnan(loss)
+    assert np.array_equal(loss[evaluated], full[evaluated])
+    index = np.unravel_index(np.nanargmin(loss), loss.shape)
+    neighbors = full[max(index[0] - 1, 0):index[0] + 2,
+                     max(index[1] - 1, 0):index[1] + 2]
+    assert loss[index] == np.min(neighbors)
+
+    return
+
+
+def test_incremental_optimizer_diverged(monkeypatch):
+    """
+    Diverged cells are evaluated once and never win, and
+    a search where every cell diverges fails clearly.
+    """
+    calls = []
+
+    def diverged(data, cell, **kwargs):
+        calls.append((cell['rho'], cell['noise']))
+        prediction, n_predicted = esn_partial_prediction(data, cell,
+                                                         **kwargs)
+        if cell['rho'] > limit:
+            prediction[:] = np.nan
+        return prediction, n_predicted
+
+    monkeypatch.setattr(optimizers, 'esn_partial_prediction', diverged)
+    small = dict(params, n_reservoir=100)
+    space = {'rho': [0.3, 0.5, 0.7, 0.9, 1.1, 1.3],
+             'noise': [1e-4, 1e-3, 1e-2]}
+    previous = np.ones((6, 3))
+    previous[2, 1] = 0
+
+    limit = 0.6
+    loss, best = incremental_optimizer(X_in.T, small, space,
+                                       previous=previous)
+    assert len(calls) == len(set(calls))
+    assert np.isfinite(best[0][1]) and best[0][0]['rho'] < limit
+
+    limit = 0
+    with pytest.raises(AssertionError, match="diverged"):
+        incremental_optimizer(X_in.T, small, space, previous=previous)
+
+    return
+
+
+def test_grid_optimize_batch_rows():
+    """
+    Advancing the reservoirs of each row together gives the
+    losses of separate cells, and cannot use the state cache.
+    """
+    batch_params = dict(params, backend='sparse', n_reservoir=200)
+    grid = dict(args=['noise', 'rho'], xset=[0.001, 0.003],
+                yset=[0.5, 0.9, 1.3])
+    loss = grid_optimizer(X_in.T, batch_params, **grid)
+    batched = grid_optimizer(X_in.T, batch_params, batch_rows=True, **grid)
+    assert batched == pytest.approx(loss, rel=1e-6)
+
+    with pytest.raises(AssertionError):
+        grid_optimizer(X_in.T, batch_params, batch_rows=True,
+                       cache_states=True, **grid)
+
+    return
+
+
+def test_grid_optimize_seeds():
+    """
+    A grid over several seeds stacks the grids of each seed
+    along a last axis.
+    """
+    seed_params = dict(params, backend='sparse', n_reservoir=200)
+    grid = dict(args=['rho', 'noise'], xset=[0.5, 0.9], yset=[0.001, 0.01])
+    loss = grid_optimizer(X_in.T, seed_params, seeds=[85, 7, 3], **grid)
+    assert loss.shape == (2, 2, 3)
+
+    for s, seed in enumerate([85, 7, 3]):
+        single = grid_optimizer(X_in.T, dict(seed_params, rand_seed=seed),
+                                **grid)
+        assert np.array_equal(loss[:, :, s], single)
+
+    with pytest.raises(AssertionError):
+        grid_optimizer(X_in.T, seed_params, args=['rand_seed'],
+                       xset=[1, 2], seeds=[85, 7])
+
+    return
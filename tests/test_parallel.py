@@ -0,0 +1,41 @@
+import numpy as np
+import parallel
+from parallel import *
+
+# =========================================================
+# Set up code
+# =========================================================
+data = np.arange(12.0).reshape(4, 3)
+# =========================================================
+# =========================================================
+
+
+def _row_sum(k):
+    """
+    Sums a row of the shared array in a worker.
+    """
+    return get_shared('data')[k].sum()
+
+
+def test_shared_pool():
+    """
+    Pool workers read the shared array.
+    """
+    with shared_pool(2, data=data) as executor:
+        sums = list(executor.map(_row_sum, range(4)))
+    assert sums == list(data.sum(axis=1))
+
+    return
+
+
+def test_shared_pool_copies(monkeypatch):
+    """
+    Without shared memory, the workers read a copy of
+    the array.
+    """
+    monkeypatch.setattr(parallel, 'shared_memory', None)
+    with shared_pool(2, data=data) as executor:
+        sums = list(executor.map(_row_sum, range(4)))
+    assert sums == list(data.sum(axis=1))
+
+    return
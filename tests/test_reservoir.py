@@ -0,0 +1,425 @@
+import os
+import pytest
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from pytest import approx
+import reservoir
+from reservoir import *
+
+# =========================================================
+# Set up code
+# =========================================================
+N = 600
+t = np.linspace(0, 6 * np.pi, N)
+smooth_cos = np.cos(t)
+# =========================================================
+# =========================================================
+
+
+def test_sparse_esn_csr():
+    """
+    A reservoir with most connections removed is
+    stored as a CSR matrix with the requested
+    spectral radius.
+    """
+    esn = SparseESN(1, 1, n_reservoir=200, sparsity=0.95,
+                    spectral_radius=0.9, random_state=85)
+    assert sparse.isspmatrix_csr(esn.W)
+    radius = np.max(np.abs(np.linalg.eigvals(esn.W.toarray())))
+    assert radius == approx(0.9)
+
+    return
+
+
+def test_sparse_esn_dense():
+    """
+    A reservoir that keeps most connections is
+    stored as a dense array.
+    """
+    esn = SparseESN(1, 1, n_reservoir=100, sparsity=0.1,
+                    random_state=85)
+    assert isinstance(esn.W, np.ndarray)
+
+    return
+
+
+def test_sparse_esn_seeded():
+    """
+    Two networks with the same seed give the
+    same prediction.
+    """
+    preds = []
+    for i in range(2):
+        esn = SparseESN(1, 1, n_reservoir=100, sparsity=0.9,
+                        random_state=85)
+        esn.fit(np.ones((500, 1)), smooth_cos[:500])
+        preds.append(esn.predict(np.ones((20, 1))))
+    assert np.array_equal(preds[0], preds[1])
+    assert preds[0].shape == (20, 1)
+
+    return
+
+
+def test_sparse_esn_harvest_fit_readout():
+    """
+    Harvesting states and solving the readout
+    separately is the same as fit.
+    """
+    esn = SparseESN(1, 1, n_reservoir=100, sparsity=0.9,
+                    random_state=85)
+    exp = esn.fit(np.ones((500, 1)), smooth_cos[:500])
+
+    esn = SparseESN(1, 1, n_reservoir=100, sparsity=0.9,
+                    random_state=85)
+    states = esn.harvest(np.ones((500, 1)), smooth_cos[:500])
+    obs = esn.fit_readout(states, np.ones((500, 1)), smooth_cos[:500])
+    assert np.array_equal(obs, exp)
+
+    return
+
+
+def test_spectral_radius_sparse():
+    """
+    The Arnoldi estimate for a sparse matrix agrees
+    with the dense eigendecomposition.
+    """
+    rs = np.random.RandomState(85)
+    W = rs.rand(300, 300) - 0.5
+    W[rs.rand(300, 300) < 0.95] = 0
+    exp = np.max(np.abs(np.linalg.eigvals(W)))
+    obs = spectral_radius(sparse.csr_matrix(W))
+    assert obs == approx(exp)
+
+    return
+
+
+def test_sparse_esn_reuses_unit_reservoir():
+    """
+    A reservoir taken from the cache of unit radius
+    reservoirs gives the same network as a freshly
+    drawn one, and rho only rescales it.
+    """
+    clear_reservoir_cache()
+    fresh = SparseESN(1, 1, n_reservoir=100, sparsity=0.9,
+                      spectral_radius=1.0, random_state=85)
+    exp = fresh.fit(np.ones((500, 1)), smooth_cos[:500])
+    cached = SparseESN(1, 1, n_reservoir=100, sparsity=0.9,
+                       spectral_radius=1.0, random_state=85)
+    obs = cached.fit(np.ones((500, 1)), smooth_cos[:500])
+    half = SparseESN(1, 1, n_reservoir=100, sparsity=0.9,
+                     spectral_radius=0.5, random_state=85)
+
+    assert len(reservoir._unit_reservoirs) == 1
+    assert np.array_equal(obs, exp)
+    assert np.allclose(2 * half.W.toarray(), fresh.W.toarray())
+    clear_reservoir_cache()
+
+    return
+
+
+def test_ridge_path():
+    """
+    Each readout on the ridge path solves the
+    regularized normal equations, and a ridge of
+    zero is the pseudo-inverse solution.
+    """
+    rs = np.random.RandomState(85)
+    X = rs.rand(200, 20)
+    Y = rs.rand(200, 2)
+    readouts = ridge_path(X, Y, [0, 0.1, 10])
+
+    assert readouts.shape == (3, 2, 20)
+    assert np.allclose(readouts[0], (np.linalg.pinv(X) @ Y).T)
+    for k, ridge in enumerate([0.1, 10]):
+        exp = np.linalg.solve(X.T @ X + ridge * np.eye(20), X.T @ Y).T
+        assert np.allclose(readouts[k + 1], exp)
+
+    return
+
+
+def test_suffix_normal_equations():
+    """
+    The accumulated normal equations match the ones
+    formed directly from each suffix of the rows.
+    """
+    rs = np.random.RandomState(85)
+    X = rs.rand(100, 5)
+    Y = rs.rand(100, 2)
+    starts = [0, 40, 90]
+    for start, XtX, XtY in suffix_normal_equations(X, Y, starts):
+        assert np.allclose(XtX, X[start:].T @ X[start:])
+        assert np.allclose(XtY, X[start:].T @ Y[start:])
+
+    return
+
+
+def test_solve_normal_equations():
+    """
+    The normal equations give the least squares and
+    the ridge readouts.
+    """
+    rs = np.random.RandomState(85)
+    X = rs.rand(200, 20)
+    Y = rs.rand(200, 2)
+    obs = solve_normal_equations(X.T @ X, X.T @ Y)
+    assert np.allclose(obs, (np.linalg.pinv(X) @ Y).T)
+    obs = solve_normal_equations(X.T @ X, X.T @ Y, ridge=0.1)
+    assert np.allclose(obs, ridge_path(X, Y, [0.1])[0])
+
+    return
+
+
+def test_sparse_esn_fit_streaming():
+    """
+    Streaming training over several blocks gives the
+    same readout and prediction as keeping the states.
+    """
+    data = np.cos(np.linspace(0, 60 * np.pi, 2500))
+    exp_esn = SparseESN(1, 1, n_reservoir=50, sparsity=0.9,
+                        random_state=85)
+    states = exp_esn.harvest(np.ones((2500, 1)), data)
+    exp_esn.fit_readout(states, np.ones((2500, 1)), data, ridge=1e-4)
+    exp = exp_esn.predict(np.ones((20, 1)))
+
+    esn = SparseESN(1, 1, n_reservoir=50, sparsity=0.9,
+                    random_state=85)
+    esn.fit_streaming(np.ones((2500, 1)), data, ridge=1e-4)
+    obs = esn.predict(np.ones((20, 1)))
+
+    assert np.allclose(esn.W_out, exp_esn.W_out)
+    assert np.allclose(obs, exp)
+
+    return
+
+
+def test_solve_readout():
+    """
+    Every readout solver gives the least squares
+    solution of a well conditioned problem, with
+    and without a ridge value.
+    """
+    rs = np.random.RandomState(85)
+    X = rs.rand(200, 20)
+    Y = rs.rand(200, 2)
+    for ridge in [None, 0.1]:
+        exp = ridge_path(X, Y, [ridge or 0])[0]
+        for solver in READOUT_SOLVERS:
+            obs = solve_readout(X, Y, solver, ridge)
+            assert np.allclose(obs, exp)
+
+    with pytest.raises(AssertionError):
+        solve_readout(X, Y, 'jimmy')
+
+    return
+
+
+def test_readout_solver_accuracy():
+    """
+    On reservoir states driven by the UIUC demand
+    data, every readout solver reaches the training
+    error of the pseudo-inverse. The solvers are
+    timed by benchmarks.py.
+    """
+    path = os.path.join(os.path.dirname(__file__), '..', 'data',
+                        'UIUCDATA', 'uiuc_demand_data.csv')
+    demand = pd.read_csv(path, usecols=['time', 'kw']).kw.values[-3000:]
+    demand = demand / np.linalg.norm(demand, ord=np.inf)
+
+    esn = SparseESN(1, 1, n_reservoir=300, sparsity=0.9,
+                    spectral_radius=0.9, random_state=85)
+    states = esn.harvest(np.ones((3000, 1)), demand)
+    X = np.hstack((states, np.ones((3000, 1))))
+
+    errors = {}
+    for solver in READOUT_SOLVERS:
+        W_out = solve_readout(X, demand, solver, ridge=1e-8)
+        errors[solver] = np.sqrt(np.mean((X @ W_out.T - demand[:, None])**2))
+
+    for solver in READOUT_SOLVERS:
+        assert errors[solver] == approx(errors['pinv'], rel=1e-3)
+
+    return
+
+
+def test_harvest_predict_batch():
+    """
+    A batch mixing reservoirs that share a seed with unshared sparse
+    and dense ones gives the states and predictions of each reservoir
+    run separately.
+    """
+    inputs = np.ones((300, 1))
+    outputs = smooth_cos[:300, None]
+
+    def batch():
+        return [SparseESN(1, 1, n_reservoir=100, sparsity=sparsity,
+                          spectral_radius=rho, noise=noise,
+                          random_state=seed)
+                for sparsity, rho, noise, seed in [
+                    (0.95, 0.8, 1e-3, 85), (0.95, 1.2, 1e-4, 85),
+                    (0.95, 0.9, 1e-3, 7), (0.1, 0.9, 1e-3, 7),
+                    (0.1, 1.1, 1e-3, 85), (0.1, 0.7, 1e-3, 85),
+                    (0.1, 0.9, 1e-3, 3)]]
+
+    separate = batch()
+    expected_states = [esn.harvest(inputs, outputs) for esn in separate]
+    for esn, states in zip(separate, expected_states):
+        esn.fit_readout(states, inputs, outputs)
+    expected = [esn.predict(np.ones((20, 1))) for esn in separate]
+
+    together = batch()
+    states = harvest_batch(together, inputs, outputs)
+    for esn, esn_states in zip(together, states):
+        esn.fit_readout(esn_states, inputs, outputs)
+    predictions = predict_batch(together, np.ones((20, 1)))
+
+    for k in range(len(separate)):
+        assert states[k] == approx(expected_states[k], abs=1e-10)
+        assert predictions[k] == approx(expected[k], abs=1e-6)
+
+    with pytest.raises(AssertionError):
+        harvest_batch(together + [SparseESN(1, 1, n_reservoir=50)],
+                      inputs, outputs)
+
+    return
+
+
+def test_sparse_esn_float32():
+    """
+    A float32 reservoir runs its states and prediction
+    in float32 and stays close to the float64 one,
+    which remains the default.
+    """
+    inputs = np.ones((300, 1))
+    outputs = smooth_cos[:300, None]
+
+    predictions = {}
+    for dtype in [np.float64, np.float32]:
+        esn = SparseESN(1, 1, n_reservoir=200, sparsity=0.95,
+                        spectral_radius=0.9, noise=1e-4,
+                        random_state=85, dtype=dtype)
+        states = esn.harvest(inputs, outputs)
+        assert states.dtype == dtype
+        esn.fit_readout(states, inputs, outputs)
+        predictions[dtype] = esn.predict(np.ones((50, 1)))
+        assert predictions[dtype].dtype == dtype
+
+    assert SparseESN(1, 1, n_reservoir=50).dtype == np.float64
+    assert predictions[np.float32] == approx(predictions[np.float64],
+                                             abs=1e-3)
+
+    return
+
+
+def test_float32_accuracy():
+    """
+    On the three UIUC data sets, the float32 forecasts
+    of three days are as accurate as the float64 ones,
+    which are within twice the error of repeating the
+    previous day. See the table in docs/reservoir.rst.
+    """
+    folder = os.path.join(os.path.dirname(__file__), '..', 'data',
+                          'UIUCDATA')
+    trainlen, future, days = 2000, 24, 3
+    options = {'uiuc_demand_data': (0.95, 1e-4, 1e-4),
+               'solarfarm_data': (0.8, 1e-2, 1.0),
+               'railsplitter_data': (0.8, 1e-2, 1.0)}
+
+    for name, (rho, noise, ridge) in options.items():
+        series = pd.read_csv(os.path.join(folder, name + '.csv'),
+                             usecols=['kw']).kw.values
+        series = series[-(trainlen + future * days):]
+        series = series / np.linalg.norm(series, ord=np.inf)
+
+        errors = {np.float64: [], np.float32: []}
+        persistence = []
+        for day in range(days):
+            start = day * future
+            train = series[start:start + trainlen, None]
+            test = series[start + trainlen:start + trainlen + future, None]
+            persistence.append(np.mean((train[-future:] - test)**2))
+            for dtype in errors:
+                esn = SparseESN(1, 1, n_reservoir=500, sparsity=0.9,
+                                spectral_radius=rho, noise=noise,
+                                random_state=85, dtype=dtype)
+                states = esn.harvest(np.ones((trainlen, 1)), train)
+                esn.fit_readout(states, np.ones((trainlen, 1)), train,
+                                ridge=ridge)
+                prediction = esn.predict(np.ones((future, 1)))
+                errors[dtype].append(np.mean((prediction - test)**2))
+
+        assert np.mean(errors[np.float64]) < 2 * np.mean(persistence)
+        assert errors[np.float32] == approx(errors[np.float64], rel=1e-3)
+
+    return
+
+
+def test_predict_matches_step_updates():
+    """
+    The free running prediction matches single step
+    updates fed back through the readout, for constant
+    and varying inputs and for sparse and dense
+    reservoirs.
+    """
+    outputs = np.vstack([smooth_cos[:300], -smooth_cos[:300]]).T
+    for sparsity in [0.95, 0.1]:
+        for inputs in [np.ones((320, 2)),
+                       np.vstack([smooth_cos[:320], np.ones(320)]).T]:
+            esn = SparseESN(2, 2, n_reservoir=100, sparsity=sparsity,
+                            spectral_radius=0.9, noise=1e-3,
+                            random_state=85)
+            esn.fit(inputs[:300], outputs)
+            laststate, lastoutput = esn.laststate, esn.lastoutput
+            seed = esn.random_state_.get_state()
+            obs = esn.predict(inputs[300:])
+
+            esn.random_state_.set_state(seed)
+            state, output = laststate, lastoutput
+            for n in range(20):
+                state = esn._update(state, inputs[300 + n], output)
+                output = esn.W_out @ np.concatenate([state,
+                                                     inputs[300 + n]])
+                assert obs[n] == approx(output, abs=1e-10)
+            assert np.array_equal(esn.laststate, laststate)
+
+    return
+
+
+def test_reservoir_store(tmp_path, monkeypatch):
+    """
+    Seeded reservoirs are saved to the store once drawn
+    and loaded back as the same network, noise included.
+    A damaged file is drawn again.
+    """
+    monkeypatch.setenv(reservoir.STORE_VARIABLE, '')
+    set_reservoir_store(tmp_path / 'store')
+    inputs = np.ones((300, 1))
+    outputs = smooth_cos[:300, None]
+
+    for sparsity in [0.95, 0.1]:
+        networks = []
+        for _ in range(2):
+            clear_reservoir_cache()
+            esn = SparseESN(1, 1, n_reservoir=100, sparsity=sparsity,
+                            spectral_radius=0.9, random_state=85)
+            esn.fit(inputs, outputs)
+            networks.append((esn, esn.predict(np.ones((20, 1)))))
+        (first, expected), (second, obs) = networks
+
+        assert type(second.W) == type(first.W)
+        assert second.W_in == approx(first.W_in)
+        assert obs == approx(expected, abs=1e-12)
+    assert len(os.listdir(tmp_path / 'store')) == 2
+
+    for name in os.listdir(tmp_path / 'store'):
+        with open(tmp_path / 'store' / name, 'wb') as f:
+            f.write(b'jimmy')
+    clear_reservoir_cache()
+    esn = SparseESN(1, 1, n_reservoir=100, sparsity=0.1,
+                    spectral_radius=0.9, random_state=85)
+    assert esn.W_in == approx(first.W_in)
+
+    set_reservoir_store(None)
+    assert reservoir.STORE_VARIABLE not in os.environ
+
+    return
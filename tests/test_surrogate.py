@@ -0,0 +1,73 @@
+import pytest
+import numpy as np
+from pytest import approx
+from surrogate import *
+
+
+def test_gaussian_process_interpolates():
+    """
+    The fitted process reproduces smooth observations, and
+    is more uncertain far from them.
+    """
+    rng = np.random.RandomState(0)
+    X = rng.uniform(size=(20, 2))
+    y = np.sin(3 * X[:, 0]) + X[:, 1]**2
+
+    gp = GaussianProcess(random_state=0).fit(X, y)
+    mean, std = gp.predict(X)
+    assert mean == approx(y, abs=1e-2)
+
+    near, std_near = gp.predict(X[:1] + 1e-3)
+    far, std_far = gp.predict(np.array([[3.0, 3.0]]))
+    assert std_far[0] > std_near[0]
+
+    return
+
+
+def test_gaussian_process_lengths():
+    """
+    X and y must have the same number of points.
+    """
+    with pytest.raises(AssertionError):
+        GaussianProcess().fit(np.ones((3, 2)), np.ones(4))
+
+    return
+
+
+def test_expected_improvement():
+    """
+    The expected improvement grows with the predicted improvement
+    and with the uncertainty, and is the plain improvement when
+    there is no uncertainty.
+    """
+    ei = expected_improvement([0.5, 0.0, 0.0, 2.0], [0.1, 0.1, 1.0, 0.0],
+                              best=1.0)
+    assert ei[1] > ei[0]
+    assert ei[2] > ei[1]
+    assert ei[3] == 0
+    assert expected_improvement([0.2], [0.0], best=1.0) == approx(0.8)
+
+    return
+
+
+def test_propose_batch():
+    """
+    A batch holds distinct points of the unit cube, the first of
+    them close to the minimum of a quadratic, and the process stays
+    fitted to the observations.
+    """
+    rng = np.random.RandomState(1)
+    X = rng.uniform(size=(15, 2))
+    y = np.sum((X - 0.3)**2, axis=1)
+
+    gp = GaussianProcess(random_state=1).fit(X, y)
+    mean, std = gp.predict(X)
+    batch = propose_batch(gp, X, y, 3, random_state=1)
+    assert np.array_equal(gp.X_, X)
+    assert np.array_equal(gp.predict(X)[0], mean)
+    assert batch.shape == (3, 2)
+    assert np.all((batch >= 0) & (batch <= 1))
+    assert len(np.unique(batch, axis=0)) == 3
+    assert np.sum((batch[0] - 0.3)**2) < np.min(y)
+
+    return
@@ -2,6 +2,7 @@ import pytest
 from lorenz import generate_L96
 import numpy as np
 import numpy.random as rd
+import tools
 from tools import *
 from pytest import approx
 import os
@@ -176,6 +177,30 @@ def test_MAE_diffsize():
     return
 
 
+def test_error_metrics():
+    """
+    The fused metrics of each target are the separate
+    metrics of that target, with the MASE scale given
+    or computed from the training data.
+    """
+    y = np.vstack([smooth_cos, 2 * smooth_cos]).T[-100:]
+    yhat = np.vstack([noisy_cos, smooth_cos]).T[-100:]
+    training = np.vstack([noisy_cos, smooth_cos]).T[:-100]
+
+    metrics = error_metrics(yhat, y, training, nsteps=3)
+    scaled = error_metrics(yhat, y, scale=MASE_scale(training, 3))
+    for j in range(2):
+        assert metrics['MSE'][j] == approx(MSE(yhat[:, j], y[:, j]))
+        assert metrics['MAE'][j] == approx(MAE(yhat[:, j], y[:, j]))
+        assert metrics['NRMSE'][j] == approx(NRMSE(yhat[:, j], y[:, j]))
+        assert metrics['MASE'][j] == approx(
+            MASE(yhat[:, j], y[:, j], training[:, j], nsteps=3))
+    assert scaled['MASE'] == approx(metrics['MASE'])
+    assert 'MASE' not in error_metrics(yhat, y)
+
+    return
+
+
 def test_param_string():
     """
     Verifies that param_string returns string.
@@ -186,6 +211,28 @@ def test_param_string():
     return
 
 
+def test_esn_batch_prediction():
+    """
+    A batch of configurations predicts the same as
+    separate esn_prediction calls, up to rounding.
+    """
+    batch_params = dict(params_work, backend='sparse', n_reservoir=200,
+                        future=20, window=10, trainlen=500)
+    cells = [{'rho': 0.9}, {'rho': 1.2, 'noise': 0.001},
+             {'rand_seed': 7, 'ridge': 1e-4}]
+    predictions = esn_batch_prediction(X_in.T, batch_params, cells)
+
+    assert predictions.shape == (3, 20, 2)
+    for cell, predicted in zip(cells, predictions):
+        expected = esn_prediction(X_in.T, dict(batch_params, **cell))
+        assert predicted == approx(expected, abs=1e-6)
+
+    with pytest.raises(AssertionError):
+        esn_batch_prediction(X_in.T, batch_params, [{'n_reservoir': 100}])
+
+    return
+
+
 def test_optimal_values_pmone():
     """
     Optimal_values returns the correct set
@@ -224,6 +271,105 @@ def test_optimal_values_equal_arrays():
     return
 
 
+def test_partial_MSE():
+    """
+    Partial_MSE is the MSE of a complete prediction
+    and a lower bound of it for a partial one.
+    """
+    y = np.cos(np.linspace(0, 1, 10))
+    yhat = y + 0.1 * np.arange(10)
+    partial = yhat.copy()
+    partial[6:] = np.nan
+
+    assert partial_MSE(yhat, y, 10) == MSE(yhat, y)
+    assert partial_MSE(partial, y, 6) < MSE(yhat, y)
+    assert partial_MSE(partial, y, 6) == approx(
+        np.sqrt(np.sum((yhat[:6] - y[:6])**2) / 10))
+    assert np.isnan(partial_MSE(np.nan * yhat, y, 10))
+
+    return
+
+
+def test_esn_prediction_prune():
+    """
+    A pruned prediction stops after the window that
+    makes its MSE exceed the threshold and agrees with
+    the complete prediction up to there.
+    """
+    pruned_params = dict(params_work, future=20, window=4, trainlen=500)
+    full = esn_prediction(X_in.T, pruned_params)
+    assert esn_prediction(X_in.T, pruned_params,
+                          prune_above=np.inf) == approx(full)
+
+    threshold = partial_MSE(full, X_in.T[-20:], 8) * 0.99
+    pruned = esn_prediction(X_in.T, pruned_params, prune_above=threshold)
+    partial, n_predicted = esn_partial_prediction(
+        X_in.T, pruned_params, prune_above=threshold)
+    assert n_predicted <= 8
+    assert np.isnan(pruned[n_predicted:]).all()
+    assert pruned[:n_predicted] == approx(full[:n_predicted])
+    assert np.array_equal(partial, pruned, equal_nan=True)
+    assert partial_MSE(pruned, X_in.T[-20:], n_predicted) > threshold
+
+    return
+
+
+def test_optimal_values_ties():
+    """
+    Optimal_values returns the first of several
+    equal minima.
+    """
+    x = np.array([1, 2, 3])
+    y = np.array([4, 5])
+    b = np.array([
+        [0.5, 0.2],
+        [0.2, 0.9],
+        [np.nan, 0.2]
+    ])
+
+    opt_set = optimal_values(b, x, y)
+    assert (opt_set == (1, 5))
+
+    return
+
+
+def test_optimal_values_seeds():
+    """
+    Optimal_values selects on the mean over the
+    seeds, or on a quantile of them.
+    """
+    x = np.array([1, 2])
+    y = np.array([3, 4])
+    b = np.array([
+        [[0.1, 0.9], [0.4, 0.4]],
+        [[0.6, 0.6], [0.8, 0.8]]
+    ])
+
+    assert optimal_values(b, x, y) == (1, 4)
+    assert optimal_values(b[:, :, :1], x, y) == (1, 3)
+    assert optimal_values(b, x, y, quantile=0.1) == (1, 3)
+
+    return
+
+
+def test_top_configurations():
+    """
+    Top_configurations returns the best cells of a
+    3D loss, best first, with ties in array order
+    and NaN cells skipped.
+    """
+    space = {'rho': [0.5, 1.0], 'noise': [0.1, 0.2], 'sparsity': [0.1]}
+    loss = np.array([[[0.3], [np.nan]],
+                     [[0.1], [0.3]]])
+
+    best = top_configurations(loss, space, k=2)
+    assert best == [({'rho': 1.0, 'noise': 0.1, 'sparsity': 0.1}, 0.1),
+                    ({'rho': 0.5, 'noise': 0.1, 'sparsity': 0.1}, 0.3)]
+    assert len(top_configurations(loss, space, k=10)) == 3
+
+    return
+
+
 def test_esn_prediction_diffsize():
     """
     The ESN does not train because of
@@ -296,3 +442,242 @@ def test_esn_scenario_output_type():
     assert type(output[0][0]) is np.ndarray
 
     return
+
+
+def test_esn_ensemble():
+    """
+    Each member of an ensemble is the scenario of its
+    seed and noise, the pool gives the serial ensemble,
+    and the quantiles are ordered.
+    """
+    params = dict(params_work, n_reservoir=200, future=20,
+                  backend='sparse')
+    data = x[-500:]
+    noises = [0.01, 0.001, 0.01, 0.003, 0.01]
+    scenarios, summary = esn_ensemble(data, params, 5, noises=noises)
+
+    assert scenarios.shape == (5, 20, x.shape[1])
+    assert summary.shape == (3, 20, x.shape[1])
+    assert np.all(np.diff(summary, axis=0) >= 0)
+    exp = esn_scenario(data, dict(params, rand_seed=86, noise=0.001))[0]
+    assert np.array_equal(scenarios[1], exp)
+
+    obs, _ = esn_ensemble(data, params, 5, noises=noises, n_jobs=2)
+    assert np.array_equal(obs, scenarios)
+
+    with pytest.raises(AssertionError):
+        esn_ensemble(data, params, 2, seeds=[0, 1])
+
+    return
+
+
+def test_esn_prediction_cache_states():
+    """
+    Reusing cached reservoir states does not change the
+    prediction, and the second call hits the cache.
+    """
+    params = dict(params_work, future=20, window=10, trainlen=500)
+    clear_state_cache()
+    exp = esn_prediction(x, params)
+    first = esn_prediction(x, params, cache_states=True)
+    n_cached = len(tools._state_cache)
+    second = esn_prediction(x, params, cache_states=True)
+
+    assert n_cached == 2
+    assert len(tools._state_cache) == n_cached
+    assert np.array_equal(exp, first)
+    assert np.array_equal(exp, second)
+    clear_state_cache()
+
+    return
+
+
+def test_esn_prediction_sparse_backend():
+    """
+    The native sparse backend produces a prediction
+    of the same shape as the pyESN backend.
+    """
+    params = dict(params_work, future=20, window=10, trainlen=500,
+                  backend='sparse')
+    pred = esn_prediction(x, params)
+    assert pred.shape == (20, x.shape[1])
+
+    return
+
+
+def test_esn_prediction_unknown_backend():
+    """
+    An unknown backend is rejected.
+    """
+    params = dict(params_work, backend='jimmy')
+    with pytest.raises(AssertionError):
+        pred = esn_prediction(x, params)
+
+    return
+
+
+def test_esn_prediction_float32():
+    """
+    The float32 sparse backend follows the float64
+    prediction in every mode, and the pyESN backend
+    rejects it.
+    """
+    params = dict(params_work, future=20, window=10, trainlen=500,
+                  noise=0, ridge=1e-4, backend='sparse')
+    for options in [{}, {'streaming': True}, {'rolling': True}]:
+        exp = esn_prediction(x, dict(params, **options))
+        obs = esn_prediction(x, dict(params, dtype='float32', **options))
+        assert obs == approx(exp, rel=1e-2, abs=1e-2)
+
+    with pytest.raises(AssertionError):
+        esn_prediction(x, dict(params_work, dtype='float32'))
+
+    return
+
+
+def test_esn_ridge_path():
+    """
+    The ridge path gives the same predictions as
+    esn_prediction with each ridge value.
+    """
+    ridges = [1e-6, 1e-2]
+    params = dict(params_work, future=20, window=10, trainlen=500,
+                  noise=0)
+    obs = esn_ridge_path(x, params, ridges)
+    assert obs.shape == (2, 20, x.shape[1])
+    for k, ridge in enumerate(ridges):
+        exp = esn_prediction(x, dict(params, ridge=ridge))
+        assert np.allclose(obs[k], exp)
+
+    return
+
+
+def test_esn_trainlen_scan():
+    """
+    The training length scan returns one prediction
+    per length, and the longest length matches
+    esn_prediction.
+    """
+    trainlens = [300, 400, 500]
+    params = dict(params_work, future=20, window=10, noise=0,
+                  ridge=1e-2)
+    obs = esn_trainlen_scan(x, params, trainlens)
+    exp = esn_prediction(x, dict(params, trainlen=500))
+    assert obs.shape == (3, 20, x.shape[1])
+    assert np.allclose(obs[-1], exp)
+
+    return
+
+
+def test_esn_trainlen_scan_pinv():
+    """
+    Without ridge, every length of the training
+    length scan is the pseudo-inverse readout on
+    its tail of the longest run, as esn_prediction
+    fits it, so no length is regularized more.
+    """
+    trainlens = [300, 400, 500]
+    params = dict(params_work, future=10, window=10, noise=0)
+    obs = esn_trainlen_scan(x, params, trainlens)
+
+    n_vars = x.shape[1]
+    inputs = np.ones((500, n_vars))
+    outputs = x[-510:-10]
+    esn = build_esn(n_vars, params)
+    states = tools._get_states(esn, inputs, outputs, params)
+    extended_states = np.hstack((states, inputs))
+    for k, length in enumerate(trainlens):
+        esn = build_esn(n_vars, params)
+        esn.W_out = np.dot(np.linalg.pinv(extended_states[-length:]),
+                           outputs[-length:]).T
+        esn.laststate = states[-1]
+        esn.lastinput = inputs[-1]
+        esn.lastoutput = outputs[-1]
+        exp = esn.predict(np.ones((10, n_vars)))
+        assert MSE(obs[k], x[-10:], n_vars) == approx(
+            MSE(exp, x[-10:], n_vars), rel=1e-6)
+    assert np.allclose(obs[-1], esn_prediction(x, dict(params,
+                                                       trainlen=500)))
+
+    return
+
+
+def test_esn_prediction_streaming_pyesn():
+    """
+    Streaming fits are only available with the
+    sparse backend.
+    """
+    params = dict(params_work, future=20, window=10, streaming=True)
+    with pytest.raises(AssertionError):
+        pred = esn_prediction(x, params)
+
+    return
+
+
+def test_esn_prediction_unsupported_options():
+    """
+    Streaming fits reject the state cache and a
+    readout solver, and rolling windows reject the
+    state cache, instead of ignoring them.
+    """
+    params = dict(params_work, future=20, window=10, trainlen=500,
+                  backend='sparse')
+    with pytest.raises(AssertionError):
+        esn_prediction(x, dict(params, streaming=True), cache_states=True)
+    with pytest.raises(AssertionError):
+        esn_prediction(x, dict(params, streaming=True,
+                               readout_solver='qr'))
+    with pytest.raises(AssertionError):
+        esn_prediction(x, dict(params, rolling=True), cache_states=True)
+    with pytest.raises(AssertionError):
+        esn_prediction(x, dict(params, rolling=True), prune_above=1.0)
+    with pytest.raises(AssertionError):
+        esn_prediction(x, params, n_jobs=2, prune_above=1.0)
+    with pytest.raises(AssertionError):
+        esn_partial_prediction(x, dict(params, rolling=True),
+                               prune_above=1.0)
+
+    return
+
+
+def test_esn_prediction_rolling():
+    """
+    Rolling windows train each window on the last
+    trainlen steps of one continuous teacher forced
+    run of the reservoir, also in grid cells.
+    """
+    params = dict(params_work, future=20, window=10, trainlen=500,
+                  noise=0, ridge=1e-4, backend='sparse', rolling=True)
+    data = x.copy()
+    obs = esn_prediction(data, params)
+
+    esn = build_esn(x.shape[1], params)
+    outputs = x[-520:-10]
+    states = esn.harvest(np.ones((510, x.shape[1])), outputs)
+    esn.fit_readout(states[10:], np.ones((500, x.shape[1])),
+                    outputs[10:], ridge=1e-4)
+    exp = esn.predict(np.ones((10, x.shape[1])))
+
+    assert obs.shape == (20, x.shape[1])
+    assert np.allclose(obs[10:], exp)
+    assert np.array_equal(data, x)
+
+    partial, n_predicted = esn_partial_prediction(x, params)
+    assert np.array_equal(partial, obs) and n_predicted == 20
+
+    return
+
+
+def test_esn_prediction_parallel():
+    """
+    Spreading the windows over processes gives the
+    same prediction as the serial loop.
+    """
+    for backend in ['pyesn', 'sparse']:
+        params = dict(params_work, future=20, window=5, trainlen=500,
+                      backend=backend)
+        exp = esn_prediction(x, params)
+        obs = esn_prediction(x, params, n_jobs=2)
+        assert np.array_equal(obs, exp)
+
+    return
@@ -1,5 +1,26 @@
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import as_completed
 import numpy as np
 from pyESN.pyESN import ESN
+from reservoir import SparseESN, ridge_path, solve_readout
+from reservoir import suffix_normal_equations, solve_normal_equations
+from reservoir import harvest_batch, predict_batch
+from parallel import shared_pool, get_shared
+
+# Reservoir engines selectable with params['backend']
+BACKENDS = {'pyesn': ESN,
+            'sparse': SparseESN}
+
+# Harvested reservoir states, keyed by the training slice, the
+# parameters that shape the reservoir, and the state of the random
+# number generator that drives the state noise.
+_state_cache = OrderedDict()
+STATE_CACHE_BYTES = 2 * 1024**3
+
+# Random numbers discarded at once while skipping the noise generator
+# ahead to the start of a window.
+SKIP_BLOCK = 2**20
 
 
 def MSE(yhat, y, ntargets=1):
@@ -32,6 +53,36 @@ def MSE(yhat, y, ntargets=1):
     return mse
 
 
+def partial_MSE(yhat, y, n_predicted, ntargets=1):
+    '''
+    This function calculates the smallest root mean squared error a
+    prediction can have when only its first rows are known. The rows
+    after them are assumed to be exact. For a complete prediction,
+    this is the MSE.
+
+    Parameters
+    ----------
+    yhat : numpy array
+        The predicted, approximated, or calculated vector
+    y : numpy array
+        The target vector
+    n_predicted : int
+        The number of rows of yhat that were predicted
+
+    Returns
+    -------
+    mse : float
+        The lower bound of the mean squared error between yhat and y.
+        NaN if a predicted row is NaN.
+    '''
+    if n_predicted == 0:
+        return 0.0
+
+    mse = MSE(yhat[:n_predicted], y[:n_predicted], ntargets)
+
+    return mse * np.sqrt(n_predicted / len(yhat))
+
+
 def NRMSE(yhat, y, ntargets=1):
     '''
     This function calculates the normalized root mean squared error
@@ -102,7 +153,6 @@ def MASE(yhat, y, training, ntargets=1, nsteps=1):
         yhat = yhat.flatten()
         n = len(training)
         et = y - yhat
-        print(f'training shape {training.shape}')
         rdwalk = np.sum(
             np.abs(
                 training.flatten()[
@@ -146,6 +196,78 @@ def MAE(yhat, y, ntargets=1):
     return mae
 
 
+def MASE_scale(training, nsteps=1):
+    '''
+    This function calculates the denominator of the mean absolute
+    scaled error of each target variable, the mean absolute error of
+    the naive forecast on the training data. It only depends on the
+    training data, so backtests can compute it once.
+
+    Parameters
+    ----------
+    training : numpy array
+        The (n_samples, n_targets) training data
+    nsteps : integer
+        The number of steps ahead for the forecast
+
+    Returns
+    -------
+    scale : numpy array
+        The (n_targets,) mean absolute naive forecast error.
+    '''
+    training = np.asarray(training).reshape(len(training), -1)
+    naive_error = np.abs(training[nsteps:] - training[:-nsteps])
+
+    # column sums as a product with ones, which is faster than a
+    # reduction along the rows of a narrow array
+    return np.ones(len(naive_error)) @ naive_error / len(naive_error)
+
+
+def error_metrics(yhat, y, training=None, nsteps=1, scale=None):
+    '''
+    This function calculates the MSE, MAE, NRMSE and MASE of each
+    target variable at once, from a single residual. For the first
+    target they are the values of the separate functions with
+    ntargets=1.
+
+    Parameters
+    ----------
+    yhat : numpy array
+        The (n_samples, n_targets) forecast
+    y : numpy array
+        The (n_samples, n_targets) target values
+    training : numpy array or None
+        The training data the MASE is scaled by. See MASE_scale.
+    nsteps : integer
+        The number of steps ahead for the forecast
+    scale : numpy array or None
+        The precomputed MASE_scale, used instead of training.
+
+    Returns
+    -------
+    metrics : dictionary
+        The (n_targets,) "MSE", "MAE", "NRMSE" and, with training or
+        scale, "MASE" of each target.
+    '''
+    y = np.asarray(y).reshape(len(y), -1)
+    residual = y - np.asarray(yhat).reshape(y.shape)
+
+    n = len(y)
+    ones = np.ones(n)
+    mse = np.sqrt(np.einsum('ij,ij->j', residual, residual) / n)
+    mae = ones @ np.abs(residual, out=residual) / n
+    centered = y - ones @ y / n
+    sigma = np.sqrt(np.einsum('ij,ij->j', centered, centered) / n)
+    metrics = {'MSE': mse, 'MAE': mae, 'NRMSE': mse / sigma}
+
+    if scale is None and training is not None:
+        scale = MASE_scale(training, nsteps)
+    if scale is not None:
+        metrics['MASE'] = mae / scale
+
+    return metrics
+
+
 def param_string(params):
     """
     This function generates a formatted string from
@@ -188,7 +310,7 @@ def param_string(params):
     return pstring
 
 
-def optimal_values(loss, xset, yset):
+def optimal_values(loss, xset, yset, quantile=None):
     """
     This function returns the optimal set of values given
     a matrix of error values. The optimal set is the pair
@@ -197,25 +319,611 @@ def optimal_values(loss, xset, yset):
     Parameters
     ----------
     loss : numpy matrix
-        The matrix of loss values.
+        The matrix of loss values. A third axis holds the
+        losses of several seeds, see grid_optimizer, and is
+        reduced to their mean or quantile.
     xset : numpy matirx
     yset: numpy matirx
+    quantile : float or None
+        Select on this quantile of the losses over the seeds,
+        e.g. 0.9 for a configuration that is good for most
+        seeds, instead of on their mean. Default is None.
 
     Returns
     -------
     x, y : float
-        The optimal set of values
+        The optimal set of values. If several pairs have the minimum
+        error, the first one in the order of the matrix is returned.
+        NaN values, such as cells that were not evaluated, are ignored.
     """
+    loss = np.asarray(loss)
+    if loss.ndim == 3:
+        if quantile is None:
+            loss = np.nanmean(loss, axis=-1)
+        else:
+            loss = np.nanquantile(loss, quantile, axis=-1)
 
-    minLoss = np.min(loss)
-    index_min = np.where(loss == minLoss)
-    x_optimal = xset[int(index_min[0])]
-    y_optimal = yset[int(index_min[1])]
+    index_min = np.unravel_index(np.nanargmin(loss), np.shape(loss))
+    x_optimal = xset[index_min[0]]
+    y_optimal = yset[index_min[1]]
 
     return x_optimal, y_optimal
 
 
-def esn_prediction(data, params, save_path=None):
+def top_configurations(loss, space, k=5):
+    """
+    This function returns the k best configurations of a loss array
+    of any dimension. Only the best candidates are sorted, after a
+    partition of the array.
+
+    Parameters
+    ----------
+    loss : numpy array
+        The loss values, with one axis per parameter. NaN values, such
+        as cells that were not evaluated, are ignored.
+    space : dictionary
+        The values of each axis, keyed by parameter name in the order
+        of the axes.
+    k : int
+        The number of configurations to return.
+
+    Returns
+    -------
+    best : list
+        The (settings, loss) of the k best configurations, best first,
+        where settings is a dictionary of parameter values. Ties are
+        returned in the order of the array.
+    """
+    loss = np.asarray(loss)
+    assert(loss.ndim == len(space)), "One set of values is needed per axis."
+
+    flat = loss.ravel()
+    evaluated = np.flatnonzero(~np.isnan(flat))
+    k = min(k, len(evaluated))
+    if k == 0:
+        return []
+
+    # everything up to the k-th smallest loss, including its ties
+    kth = np.partition(flat[evaluated], k - 1)[k - 1]
+    candidates = evaluated[flat[evaluated] <= kth]
+    # sort the candidates by loss, then by position
+    candidates = candidates[np.lexsort((candidates, flat[candidates]))][:k]
+
+    best = []
+    names = list(space)
+    for position in candidates:
+        index = np.unravel_index(position, loss.shape)
+        settings = {name: space[name][i] for name, i in zip(names, index)}
+        best.append((settings, flat[position]))
+
+    return best
+
+
+def build_esn(n_vars, params):
+    """
+    This function initializes an ESN with the reservoir engine
+    selected in the parameters.
+
+    Parameters
+    ----------
+    n_vars : int
+        The number of inputs and outputs of the network.
+    params : dictionary
+        The ESN parameters. See esn_prediction.
+
+    Returns
+    -------
+    esn : ESN or SparseESN
+        The untrained echo state network.
+    """
+    backend = params.get('backend', 'pyesn')
+    assert(backend in BACKENDS), f"Unknown backend {backend}"
+
+    options = {}
+    dtype = np.dtype(params.get('dtype', 'float64'))
+    if backend == 'sparse':
+        options['dtype'] = dtype
+    else:
+        assert(dtype == np.float64), "Only the sparse backend supports dtype."
+
+    esn = BACKENDS[backend](n_inputs=n_vars,
+                            n_outputs=n_vars,
+                            n_reservoir=params['n_reservoir'],
+                            sparsity=params['sparsity'],
+                            random_state=params['rand_seed'],
+                            spectral_radius=params['rho'],
+                            noise=params['noise'],
+                            **options)
+
+    return esn
+
+
+def clear_state_cache():
+    """
+    This function empties the cache of harvested reservoir states
+    used by esn_prediction.
+    """
+    _state_cache.clear()
+
+    return
+
+
+def _state_key(esn, outputs, params):
+    """
+    This function builds the cache key for the states harvested by
+    driving an ESN with a particular training slice. The states of a
+    slice cannot be reused for a shorter one, which the reservoir would
+    reach from a different state and with different noise, so the key
+    holds the exact slice.
+
+    Parameters
+    ----------
+    esn : ESN
+        The echo state network about to be trained.
+    outputs : numpy array
+        The teacher signal the reservoir will be driven with.
+    params : dictionary
+        The ESN parameters. See esn_prediction.
+
+    Returns
+    -------
+    key : tuple
+        A hashable key identifying the harvested states.
+    """
+    rng = esn.random_state_.get_state()
+    rng_digest = hashlib.sha1(rng[1].tobytes())
+    rng_digest.update(repr(rng[2:]).encode())
+    data_digest = hashlib.sha1(np.ascontiguousarray(outputs).tobytes())
+
+    key = (data_digest.hexdigest(),
+           outputs.shape,
+           params['n_reservoir'],
+           params['sparsity'],
+           params['rho'],
+           params['rand_seed'],
+           params['noise'],
+           params.get('backend', 'pyesn'),
+           np.dtype(params.get('dtype', 'float64')).str,
+           rng_digest.hexdigest())
+
+    return key
+
+
+def _harvest_states(esn, inputs, outputs):
+    """
+    This function drives the reservoir with the teacher signal and
+    returns the states, exactly as ESN.fit does.
+
+    Parameters
+    ----------
+    esn : ESN
+        The echo state network.
+    inputs : numpy array
+        The (trainlen, n_inputs) input signal.
+    outputs : numpy array
+        The (trainlen, n_outputs) teacher signal.
+
+    Returns
+    -------
+    states : numpy array
+        The (trainlen, n_reservoir) harvested reservoir states.
+    """
+    if isinstance(esn, SparseESN):
+        return esn.harvest(inputs, outputs)
+
+    inputs_scaled = esn._scale_inputs(inputs)
+    teachers_scaled = esn._scale_teacher(outputs)
+
+    states = np.zeros((inputs.shape[0], esn.n_reservoir))
+    for n in range(1, inputs.shape[0]):
+        states[n, :] = esn._update(states[n - 1],
+                                   inputs_scaled[n, :],
+                                   teachers_scaled[n - 1, :])
+
+    return states
+
+
+def _fit_readout(esn, states, inputs, outputs, ridge=None, solver='pinv'):
+    """
+    This function solves for the ESN readout weights given the
+    harvested states. Without a ridge value and with the "pinv" solver
+    the readout is exactly the one ESN.fit computes.
+
+    Parameters
+    ----------
+    esn : ESN
+        The echo state network. Its readout and last state are set.
+    states : numpy array
+        The (trainlen, n_reservoir) harvested reservoir states.
+    inputs : numpy array
+        The (trainlen, n_inputs) input signal.
+    outputs : numpy array
+        The (trainlen, n_outputs) teacher signal.
+    ridge : float or None
+        The Tikhonov regularization of the readout. None uses no
+        regularization.
+    solver : string
+        The least squares solver. See reservoir.solve_readout.
+    """
+    if isinstance(esn, SparseESN):
+        esn.fit_readout(states, inputs, outputs, ridge, solver)
+        return
+
+    inputs_scaled = esn._scale_inputs(inputs)
+    teachers_scaled = esn._scale_teacher(outputs)
+
+    transient = min(int(inputs.shape[1] / 10), 100)
+    extended_states = np.hstack((states, inputs_scaled))
+    esn.W_out = solve_readout(extended_states[transient:, :],
+                              esn.inverse_out_activation(
+                                  teachers_scaled[transient:, :]),
+                              solver, ridge)
+
+    esn.laststate = states[-1, :]
+    esn.lastinput = inputs[-1, :]
+    esn.lastoutput = teachers_scaled[-1, :]
+
+    return
+
+
+def _get_states(esn, inputs, outputs, params, cache_states=False):
+    """
+    This function returns the states harvested by driving an ESN with
+    a training slice, reusing previously harvested states when the same
+    reservoir has already been driven with the same slice.
+
+    Parameters
+    ----------
+    esn : ESN
+        The echo state network.
+    inputs : numpy array
+        The (trainlen, n_inputs) input signal.
+    outputs : numpy array
+        The (trainlen, n_outputs) teacher signal.
+    params : dictionary
+        The ESN parameters. See esn_prediction.
+    cache_states : boolean
+        Look the states up in, and add them to, the state cache.
+
+    Returns
+    -------
+    states : numpy array
+        The (trainlen, n_reservoir) harvested reservoir states.
+    """
+    if not cache_states:
+        return _harvest_states(esn, inputs, outputs)
+
+    key = _state_key(esn, outputs, params)
+    if key in _state_cache:
+        _state_cache.move_to_end(key)
+        states, rng_state = _state_cache[key]
+        # leave the noise generator where the harvest would have left it
+        esn.random_state_.set_state(rng_state)
+    else:
+        states = _harvest_states(esn, inputs, outputs)
+        rng_state = esn.random_state_.get_state()
+        if states.nbytes <= STATE_CACHE_BYTES:
+            _state_cache[key] = (states, rng_state)
+        cached_bytes = sum(v[0].nbytes for v in _state_cache.values())
+        while cached_bytes > STATE_CACHE_BYTES:
+            _, (old_states, _) = _state_cache.popitem(last=False)
+            cached_bytes -= old_states.nbytes
+
+    return states
+
+
+def _fit(esn, inputs, outputs, params, cache_states=False):
+    """
+    This function trains an ESN. Without any of the options below it
+    simply calls ESN.fit.
+
+    Parameters
+    ----------
+    esn : ESN
+        The echo state network.
+    inputs : numpy array
+        The (trainlen, n_inputs) input signal.
+    outputs : numpy array
+        The teacher signal.
+    params : dictionary
+        The ESN parameters. See esn_prediction. params['ridge'] and
+        params['readout_solver'] select the readout, and
+        params['streaming'] a SparseESN fit that does not keep the
+        reservoir states. A streaming fit solves the normal equations,
+        so it takes no readout_solver.
+    cache_states : boolean
+        Use the state cache. Not supported by streaming fits.
+    """
+    if outputs.ndim < 2:
+        outputs = np.reshape(outputs, (len(outputs), -1))
+    ridge = params.get('ridge')
+    solver = params.get('readout_solver', 'pinv')
+
+    if params.get('streaming', False):
+        assert(isinstance(esn, SparseESN)
+               ), "Streaming fits need the sparse backend."
+        assert(not cache_states), "Streaming fits keep no states to cache."
+        assert(params.get('readout_solver') is None
+               ), "Streaming fits do not take a readout_solver."
+        esn.fit_streaming(inputs, outputs, ridge)
+    elif cache_states or ridge is not None or solver != 'pinv':
+        states = _get_states(esn, inputs, outputs, params, cache_states)
+        _fit_readout(esn, states, inputs, outputs, ridge, solver)
+    else:
+        esn.fit(inputs, outputs)
+
+    return
+
+
+def _predict_window(esn, data, params, i, cache_states=False):
+    """
+    This function trains an ESN on the training slice that ends i
+    steps into the forecast and predicts the following window.
+
+    Parameters
+    ----------
+    esn : ESN
+        The echo state network.
+    data : numpy array
+        The dataset. See esn_prediction.
+    params : dictionary
+        The ESN parameters. See esn_prediction.
+    i : int
+        The offset of the window from the start of the forecast.
+    cache_states : boolean
+        Use the state cache.
+
+    Returns
+    -------
+    inter_pred : numpy array
+        The (window, n_vars) prediction.
+    """
+    trainlen = params['trainlen']
+    futureTotal = params['future']
+    n_vars = esn.n_inputs
+
+    data_slice = data[-trainlen - futureTotal + i:-futureTotal + i]
+    _fit(esn, np.ones((trainlen, n_vars)), data_slice, params, cache_states)
+    inter_pred = esn.predict(np.ones((params['window'], n_vars)))
+
+    return inter_pred
+
+
+def _window_rng_states(esn, params, n_windows):
+    """
+    This function returns the state of the noise generator at the start
+    of each window of the serial window loop in esn_prediction. Every
+    reservoir update draws one noise vector: trainlen - 1 of them while
+    training and window of them while predicting.
+
+    Parameters
+    ----------
+    esn : ESN
+        The freshly initialized echo state network.
+    params : dictionary
+        The ESN parameters. See esn_prediction.
+    n_windows : int
+        The number of windows.
+
+    Returns
+    -------
+    rng_states : list
+        The generator state at the start of each window.
+    """
+    rng = esn.random_state_
+    initial = rng.get_state()
+    draws = (params['trainlen'] - 1 + params['window']) * esn.n_reservoir
+
+    rng_states = []
+    for k in range(n_windows):
+        rng_states.append(rng.get_state())
+        for skipped in range(0, draws, SKIP_BLOCK):
+            rng.random_sample(min(SKIP_BLOCK, draws - skipped))
+    rng.set_state(initial)
+
+    return rng_states
+
+
+def _predict_windows(params, n_vars, windows, cache_states=False):
+    """
+    This function predicts a series of windows in a pool worker, from
+    the data shared by esn_prediction.
+
+    Parameters
+    ----------
+    params : dictionary
+        The ESN parameters. See esn_prediction.
+    n_vars : int
+        The number of inputs and outputs.
+    windows : list
+        The offset of each window and the state of the noise generator
+        at its start.
+    cache_states : boolean
+        Use the state cache of the worker.
+
+    Returns
+    -------
+    predictions : list
+        The prediction of each window.
+    """
+    data = get_shared('data')
+    esn = build_esn(n_vars, params)
+
+    predictions = []
+    for i, rng_state in windows:
+        esn.random_state_.set_state(rng_state)
+        predictions.append(_predict_window(esn, data, params, i,
+                                           cache_states))
+
+    return predictions
+
+
+def _rolling_prediction(esn, data, params):
+    """
+    This function generates the windowed prediction of esn_prediction
+    while keeping the reservoir running between windows. Each window
+    after the first advances the teacher forced run by the window
+    length, adds the new rows to the normal equations of the readout,
+    removes the oldest rows, and re-solves the readout from them.
+
+    Parameters
+    ----------
+    esn : SparseESN
+        The untrained echo state network.
+    data : numpy array
+        The dataset. See esn_prediction.
+    params : dictionary
+        The ESN parameters. See esn_prediction.
+
+    Returns
+    -------
+    prediction : numpy array
+        The (future, n_vars) prediction.
+    """
+    trainlen = params['trainlen']
+    window = params['window']
+    futureTotal = params['future']
+    n_vars = esn.n_inputs
+    assert(window <= trainlen), "Window must not exceed the training length."
+
+    inputs = np.ones((trainlen, n_vars))
+    outputs = np.reshape(data[-trainlen - futureTotal:-futureTotal],
+                         (trainlen, n_vars))
+    states = esn.harvest(inputs, outputs)
+    state = states[-1]
+    last_output = outputs[-1]
+
+    # the extended states and teacher of the current training window,
+    # kept as ring buffers whose oldest row is at head
+    X = np.hstack((states, inputs))
+    Y = outputs.copy()
+    head = 0
+    transient = min(int(n_vars / 10), 100)
+    XtX = X[transient:].T @ X[transient:]
+    XtY = X[transient:].T @ Y[transient:]
+
+    prediction = np.ones((futureTotal, n_vars))
+    window_pred = np.ones((window, n_vars))
+    for i in range(0, futureTotal, window):
+        if i > 0:
+            new_Y = np.reshape(data[-futureTotal + i - window:
+                                    -futureTotal + i], (window, n_vars))
+            new_states = esn.advance(state, window_pred, new_Y, last_output)
+            new_X = np.hstack((new_states, window_pred))
+
+            old_rows = (head + transient + np.arange(window)) % trainlen
+            XtX += new_X.T @ new_X - X[old_rows].T @ X[old_rows]
+            XtY += new_X.T @ new_Y - X[old_rows].T @ Y[old_rows]
+
+            new_rows = (head + np.arange(window)) % trainlen
+            X[new_rows] = new_X
+            Y[new_rows] = new_Y
+            head = (head + window) % trainlen
+            state = new_states[-1]
+            last_output = new_Y[-1]
+
+        esn.W_out = solve_normal_equations(XtX, XtY, params.get('ridge'))
+        esn.laststate = state
+        esn.lastinput = inputs[-1]
+        esn.lastoutput = last_output
+        prediction[i:i + window] = esn.predict(window_pred)
+
+    return prediction
+
+
+def _serial_windows(esn, data, params, cache_states=False, prune_above=None,
+                    ntargets=1):
+    """
+    This function predicts the windows of esn_prediction one after the
+    other, and stops early once the prediction is certain to have a
+    larger MSE than prune_above.
+
+    Parameters
+    ----------
+    esn : ESN
+        The echo state network.
+    data : numpy array
+        The dataset. See esn_prediction.
+    params : dictionary
+        The ESN parameters. See esn_prediction.
+    cache_states : boolean
+        Use the state cache.
+    prune_above : float or None
+        The MSE above which the prediction is stopped.
+    ntargets : integer
+        The number of target variables the MSE is computed over.
+
+    Returns
+    -------
+    prediction : numpy array
+        The (future, n_vars) prediction, NaN in the windows that were
+        not predicted.
+    n_predicted : int
+        The number of rows predicted before stopping.
+    """
+    window = params['window']
+    futureTotal = params['future']
+
+    prediction = np.full((futureTotal, esn.n_inputs), np.nan)
+    for i in range(0, futureTotal, window):
+        inter_pred = _predict_window(esn, data, params, i, cache_states)
+        prediction[i:i + window] = inter_pred
+
+        if prune_above is not None:
+            bound = partial_MSE(prediction, data[-futureTotal:], i + window,
+                                ntargets)
+            if bound > prune_above:
+                return prediction, i + window
+
+    return prediction, futureTotal
+
+
+def esn_partial_prediction(data, params, prune_above=None, ntargets=1,
+                           cache_states=False):
+    """
+    This function generates the prediction of esn_prediction, window
+    after window, and stops after the window whose partial_MSE exceeds
+    prune_above, since the complete prediction cannot have a smaller
+    MSE. Rolling windows are predicted by esn_prediction and cannot be
+    stopped.
+
+    Parameters
+    ----------
+    data : numpy array
+        The dataset. See esn_prediction.
+    params : dictionary
+        The ESN parameters. See esn_prediction.
+    prune_above : float or None
+        The MSE above which the prediction is stopped. None predicts
+        every window.
+    ntargets : integer
+        The number of target variables the MSE is computed over.
+    cache_states : boolean
+        Use the state cache. See esn_prediction.
+
+    Returns
+    -------
+    prediction : numpy array
+        The prediction, NaN in the windows that were skipped.
+    n_predicted : int
+        The number of rows predicted before stopping, params["future"]
+        if no window was skipped. A prediction that diverges to NaN is
+        not stopped.
+    """
+    if params.get('rolling', False):
+        assert(prune_above is None), "Rolling windows cannot be pruned."
+        return (esn_prediction(data, params, cache_states=cache_states),
+                params['future'])
+
+    n_vars = data.shape[1] if data.ndim > 1 else 1
+    esn = build_esn(n_vars, params)
+
+    return _serial_windows(esn, data, params, cache_states, prune_above,
+                           ntargets)
+
+
+def esn_prediction(data, params, save_path=None, cache_states=False,
+                   n_jobs=1, prune_above=None, ntargets=1):
     """
     This function generates a prediction with an ESN over
     the specified time range. Currently, only n_inputs=n_outputs
@@ -249,8 +957,55 @@ def esn_prediction(data, params, save_path=None):
             * "future" : int, the total prediction length
             * "window" : int or None, the window size
 
+        Optional parameters are:
+            * "backend" : string, the reservoir engine, either "pyesn"
+              (default) or "sparse" for the native SparseESN
+            * "ridge" : float or None, the Tikhonov regularization of
+              the readout. None (default) uses the pseudo-inverse.
+            * "readout_solver" : string, the least squares solver of the
+              readout, "pinv" (default), "lstsq", "qr" or "cholesky".
+              See reservoir.solve_readout.
+            * "streaming" : boolean, train the "sparse" backend without
+              keeping the reservoir states, so memory does not grow with
+              trainlen. Not supported with "readout_solver" or
+              cache_states. Default is False.
+            * "rolling" : boolean, keep the "sparse" backend running
+              from one window to the next and update the readout with
+              the new and dropped rows instead of refitting. The
+              reservoir is not restarted from a zero state for each
+              window, so the prediction differs slightly from the
+              refitted one. Not supported with cache_states. Default
+              is False.
+            * "dtype" : string, the precision of the reservoir states
+              and prediction of the "sparse" backend, "float64"
+              (default) or "float32". The readout is solved in float64.
+
     save_path : string
         Save the prediction data to this location as a .npy file.
+    cache_states : boolean
+        Reuse reservoir states harvested by earlier calls with the same
+        data and reservoir parameters instead of re-driving the
+        reservoir. The prediction is unchanged. The states are keyed
+        by the exact training slice, so only calls that differ in the
+        readout, "ridge" or "readout_solver", reuse them. A different
+        "trainlen" or "future" drives the reservoir again, see
+        esn_trainlen_scan for training length sweeps. Default is False.
+    n_jobs : int
+        The number of processes the windows are spread over. Each
+        worker starts the noise generator where the serial loop would
+        be, so the prediction is identical to the serial one. Requires
+        a "rand_seed". Default is 1.
+    prune_above : float or None
+        Stop after the window whose partial_MSE against the last
+        "future" rows of data exceeds this value, since the complete
+        prediction cannot have a smaller MSE. The windows that were not
+        predicted are NaN. Only supported by the serial window loop,
+        not with n_jobs > 1 or "rolling". See esn_partial_prediction
+        for the number of predicted rows.
+        Default is None.
+    ntargets : integer
+        The number of target variables the MSE of prune_above is
+        computed over.
 
     Return
     ------
@@ -258,7 +1013,6 @@ def esn_prediction(data, params, save_path=None):
         The prediction generated by the ESN. Should have the
         same second dimension as data.
     """
-    trainlen = params['trainlen']
     window = params['window']
     futureTotal = params['future']
 
@@ -272,24 +1026,36 @@ def esn_prediction(data, params, save_path=None):
     else:
         n_vars = 1
 
-    esn = ESN(n_inputs=n_vars,
-              n_outputs=n_vars,
-              n_reservoir=params['n_reservoir'],
-              sparsity=params['sparsity'],
-              random_state=params['rand_seed'],
-              spectral_radius=params['rho'],
-              noise=params['noise'])
+    esn = build_esn(n_vars, params)
 
     # train the ESN
-    prediction = np.ones((futureTotal, n_vars))
-    window_pred = np.ones((window, n_vars))
-
-    for i in range(0, futureTotal, window):
-        data_slice = data[-trainlen - futureTotal + i:-futureTotal + i]
-        pred_training = esn.fit(np.ones((trainlen, n_vars)),
-                                data_slice)
-        inter_pred = esn.predict(window_pred)
-        prediction[i:i + window] = inter_pred
+    prediction = np.full((futureTotal, n_vars), np.nan)
+
+    if params.get('rolling', False):
+        assert(isinstance(esn, SparseESN)
+               ), "Rolling windows need the sparse backend."
+        assert(not cache_states), "Rolling windows do not use the state cache."
+        assert(prune_above is None), "Rolling windows cannot be pruned."
+        prediction = _rolling_prediction(esn, data, params)
+    elif n_jobs > 1:
+        assert(params['rand_seed']), "Parallel windows need a rand_seed."
+        assert(prune_above is None), "Parallel windows cannot be pruned."
+        offsets = list(range(0, futureTotal, window))
+        rng_states = _window_rng_states(esn, params, len(offsets))
+        tasks = [[(offsets[k], rng_states[k]) for k in task]
+                 for task in np.array_split(range(len(offsets)), n_jobs)
+                 if len(task) > 0]
+
+        with shared_pool(n_jobs, data=data) as executor:
+            futures = [executor.submit(_predict_windows, params, n_vars,
+                                       task, cache_states)
+                       for task in tasks]
+            for task, future in zip(tasks, futures):
+                for (i, _), inter_pred in zip(task, future.result()):
+                    prediction[i:i + window] = inter_pred
+    else:
+        prediction, _ = _serial_windows(esn, data, params, cache_states,
+                                        prune_above, ntargets)
 
     # ===================================================
     # Save Data
@@ -301,6 +1067,251 @@ def esn_prediction(data, params, save_path=None):
     return prediction
 
 
+def esn_ridge_path(data, params, ridges, cache_states=False):
+    """
+    This function generates one prediction for each of several ridge
+    regularization values. The reservoir is driven once per window and
+    the readouts for every ridge value come from a single singular value
+    decomposition of the harvested states, so the result matches calling
+    esn_prediction with each params['ridge'] at the cost of one call.
+
+    Parameters
+    ----------
+    data : numpy array
+        This is the dataset that the ESN should train and predict.
+        See esn_prediction.
+    params : dictionary
+        The ESN parameters. See esn_prediction. Any "ridge" entry is
+        ignored.
+    ridges : list or numpy array
+        The ridge regularization values.
+    cache_states : boolean
+        Reuse reservoir states harvested by earlier calls. Default is
+        False.
+
+    Return
+    ------
+    predictions : numpy array
+        The (len(ridges), future, n_vars) predictions.
+    """
+    trainlen = params['trainlen']
+    window = params['window']
+    futureTotal = params['future']
+
+    if window is not None:
+        assert(futureTotal % window == 0), "Window must be multiple of future."
+
+    # get the shape
+    ndims = len(data.shape)
+    if ndims > 1:
+        n_vars = data.shape[1]
+    else:
+        n_vars = 1
+
+    esn = build_esn(n_vars, params)
+
+    predictions = np.ones((len(ridges), futureTotal, n_vars))
+    window_pred = np.ones((window, n_vars))
+    inputs = np.ones((trainlen, n_vars))
+
+    for i in range(0, futureTotal, window):
+        data_slice = data[-trainlen - futureTotal + i:-futureTotal + i]
+        outputs = np.reshape(data_slice, (trainlen, n_vars))
+        states = _get_states(esn, inputs, outputs, params, cache_states)
+
+        transient = min(int(inputs.shape[1] / 10), 100)
+        extended_states = np.hstack((states, inputs))
+        readouts = ridge_path(extended_states[transient:],
+                              outputs[transient:],
+                              ridges)
+
+        esn.laststate = states[-1]
+        esn.lastinput = inputs[-1]
+        esn.lastoutput = outputs[-1]
+        # every rollout sees the same state noise
+        rng_state = esn.random_state_.get_state()
+        for k, W_out in enumerate(readouts):
+            esn.random_state_.set_state(rng_state)
+            esn.W_out = W_out
+            predictions[k, i:i + window] = esn.predict(window_pred)
+
+    return predictions
+
+
+def esn_batch_prediction(data, params, cells):
+    """
+    This function generates the predictions of several configurations
+    that share the reservoir size with a batch of "sparse" reservoirs
+    advanced together, see reservoir.harvest_batch. Reservoirs drawn
+    from the same seed, which only differ in spectral radius or noise,
+    take one matrix-matrix product per step instead of one matrix-vector
+    product each. Every reservoir draws its noise as in esn_prediction,
+    so the predictions match separate calls up to rounding.
+
+    Parameters
+    ----------
+    data : numpy array
+        This is the dataset that the ESN should train and predict.
+        See esn_prediction.
+    params : dictionary
+        The ESN parameters. See esn_prediction. The "backend" must be
+        "sparse", and "streaming" and "rolling" are not supported.
+    cells : list
+        The parameters of each configuration that differ from params,
+        as dictionaries. "rho", "noise", "sparsity", "rand_seed",
+        "ridge" and "readout_solver" can differ.
+
+    Return
+    ------
+    predictions : numpy array
+        The (len(cells), future, n_vars) predictions.
+    """
+    trainlen = params['trainlen']
+    window = params['window']
+    futureTotal = params['future']
+
+    if window is not None:
+        assert(futureTotal % window == 0), "Window must be multiple of future."
+
+    batch = [dict(params, **cell) for cell in cells]
+    for cell in batch:
+        assert(cell.get('backend', 'pyesn') == 'sparse'
+               ), "Batches need the sparse backend."
+        assert(not cell.get('streaming', False)
+               and not cell.get('rolling', False)
+               ), "Batches do not support streaming or rolling windows."
+        for key in ('n_reservoir', 'trainlen', 'future', 'window'):
+            assert(cell[key] == params[key]
+                   ), f"{key} must be the same for the whole batch."
+
+    # get the shape
+    ndims = len(data.shape)
+    if ndims > 1:
+        n_vars = data.shape[1]
+    else:
+        n_vars = 1
+
+    esns = [build_esn(n_vars, cell) for cell in batch]
+
+    predictions = np.ones((len(batch), futureTotal, n_vars))
+    window_pred = np.ones((window, n_vars))
+    inputs = np.ones((trainlen, n_vars))
+
+    for i in range(0, futureTotal, window):
+        data_slice = data[-trainlen - futureTotal + i:-futureTotal + i]
+        outputs = np.reshape(data_slice, (trainlen, n_vars))
+        states = harvest_batch(esns, inputs, outputs)
+
+        for esn, cell, cell_states in zip(esns, batch, states):
+            esn.fit_readout(cell_states, inputs, outputs,
+                            cell.get('ridge', None),
+                            cell.get('readout_solver', 'pinv'))
+        predictions[:, i:i + window] = predict_batch(esns, window_pred)
+
+    return predictions
+
+
+def esn_trainlen_scan(data, params, trainlens, cache_states=False):
+    """
+    This function generates one prediction for each of several
+    training lengths. All training windows end right before the
+    forecast, so the reservoir is driven once over the longest window
+    and each training length is fitted on the last rows of its states.
+
+    Only the longest training length is reproduced exactly. A shorter
+    length differs from esn_prediction in two ways:
+
+        * its states are the tail of the longest run rather than a run
+          started from a zero state, so they miss the start-up
+          transient of the reservoir
+        * its states and forecast see other draws of the state noise,
+          since the noise is drawn from the start of the longest run
+
+    Its loss is therefore not the one of a separate fit, and the
+    training length minimizing it can differ.
+
+    With params['ridge'] set, each length is solved from the normal
+    equations accumulated backwards from the end, which is where the
+    scan saves time. Without it, each length is solved by
+    reservoir.solve_readout on its rows of the states, with the
+    params['readout_solver'] of esn_prediction, since dropping the small
+    eigenvalues of the normal equations would regularize the readout
+    more than the pseudo-inverse does. Only the reservoir run is then
+    shared.
+
+    Parameters
+    ----------
+    data : numpy array
+        This is the dataset that the ESN should train and predict.
+        See esn_prediction.
+    params : dictionary
+        The ESN parameters. See esn_prediction. Any "trainlen" entry is
+        ignored.
+    trainlens : list or numpy array
+        The training lengths.
+    cache_states : boolean
+        Reuse reservoir states harvested by earlier calls. Default is
+        False.
+
+    Return
+    ------
+    predictions : numpy array
+        The (len(trainlens), future, n_vars) predictions.
+    """
+    window = params['window']
+    futureTotal = params['future']
+    longest = int(np.max(trainlens))
+    ridge = params.get('ridge')
+    solver = params.get('readout_solver', 'pinv')
+
+    if window is not None:
+        assert(futureTotal % window == 0), "Window must be multiple of future."
+
+    # get the shape
+    ndims = len(data.shape)
+    if ndims > 1:
+        n_vars = data.shape[1]
+    else:
+        n_vars = 1
+
+    esn = build_esn(n_vars, params)
+
+    predictions = np.ones((len(trainlens), futureTotal, n_vars))
+    window_pred = np.ones((window, n_vars))
+    inputs = np.ones((longest, n_vars))
+    transient = min(int(inputs.shape[1] / 10), 100)
+    starts = {}
+    for k, length in enumerate(trainlens):
+        starts.setdefault(longest - int(length) + transient, []).append(k)
+
+    for i in range(0, futureTotal, window):
+        data_slice = data[-longest - futureTotal + i:-futureTotal + i]
+        outputs = np.reshape(data_slice, (longest, n_vars))
+        states = _get_states(esn, inputs, outputs, params, cache_states)
+        extended_states = np.hstack((states, inputs))
+
+        esn.laststate = states[-1]
+        esn.lastinput = inputs[-1]
+        esn.lastoutput = outputs[-1]
+        # every rollout sees the same state noise
+        rng_state = esn.random_state_.get_state()
+        if ridge is None:
+            readouts = ((start, solve_readout(extended_states[start:],
+                                              outputs[start:], solver))
+                        for start in starts)
+        else:
+            readouts = ((start, solve_normal_equations(XtX, XtY, ridge))
+                        for start, XtX, XtY in suffix_normal_equations(
+                            extended_states, outputs, list(starts)))
+        for start, W_out in readouts:
+            esn.random_state_.set_state(rng_state)
+            esn.W_out = W_out
+            inter_pred = esn.predict(window_pred)
+            predictions[starts[start], i:i + window] = inter_pred
+
+    return predictions
+
+
 def esn_scenario(data, params):
     """
     This function generates a prediction with an ESN over
@@ -335,6 +1346,19 @@ def esn_scenario(data, params):
             * "future" : int, the total prediction length
             * "window" : int or None, the window size
 
+        Optional parameters are:
+            * "backend" : string, the reservoir engine, either "pyesn"
+              (default) or "sparse" for the native SparseESN
+            * "ridge" : float or None, the Tikhonov regularization of
+              the readout. None (default) uses the pseudo-inverse.
+            * "readout_solver" : string, the least squares solver of the
+              readout, "pinv" (default), "lstsq", "qr" or "cholesky".
+              See reservoir.solve_readout.
+            * "streaming" : boolean, train the "sparse" backend without
+              keeping the reservoir states. Default is False.
+            * "dtype" : string, the precision of the "sparse" backend,
+              "float64" (default) or "float32".
+
     Return
     ------
     prediction : numpy array
@@ -349,13 +1373,7 @@ def esn_scenario(data, params):
     else:
         n_vars = 1
 
-    esn = ESN(n_inputs=n_vars,
-              n_outputs=n_vars,
-              n_reservoir=params['n_reservoir'],
-              sparsity=params['sparsity'],
-              random_state=params['rand_seed'],
-              spectral_radius=params['rho'],
-              noise=params['noise'])
+    esn = build_esn(n_vars, params)
 
 #    trainlen = params['trainlen']
     trainlen = len(data)
@@ -363,8 +1381,106 @@ def esn_scenario(data, params):
     pred_tot = np.ones((futureTotal, n_vars))
 
     # train the ESN
-    pred_training = esn.fit(np.ones((trainlen, n_vars)),
-                            data)
+    _fit(esn, np.ones((trainlen, n_vars)), data, params)
     scenario = esn.predict(pred_tot)
 
     return scenario, esn
+
+
+def _scenario_members(params, n_vars, members):
+    """
+    This function fits and rolls out ensemble members in a pool worker,
+    from the data shared by esn_ensemble.
+
+    Parameters
+    ----------
+    params : dictionary
+        The ESN parameters. See esn_scenario.
+    n_vars : int
+        The number of inputs and outputs.
+    members : list
+        The index, seed and noise of each member.
+
+    Returns
+    -------
+    scenarios : list
+        The index and scenario of each member.
+    """
+    data = get_shared('data')
+
+    return [(k, esn_scenario(data, dict(params, rand_seed=seed,
+                                        noise=noise))[0])
+            for k, seed, noise in members]
+
+
+def esn_ensemble(data, params, n_members, seeds=None, noises=None,
+                 quantiles=(0.05, 0.5, 0.95), n_jobs=1):
+    """
+    This function generates an ensemble of scenarios with
+    esn_scenario, one per reservoir seed and, optionally, noise value.
+    With several jobs the members are spread over a process pool that
+    reads the data from shared memory, and each scenario is written
+    into the ensemble as soon as its worker returns it.
+
+    Parameters
+    ----------
+    data : numpy array
+        The dataset the members train on. See esn_scenario.
+    params : dictionary
+        The ESN parameters. See esn_scenario.
+    n_members : int
+        The number of members.
+    seeds : list or None
+        The "rand_seed" of each member. None uses consecutive seeds
+        from params["rand_seed"], or 1 without one.
+    noises : list or None
+        The "noise" of each member. None uses params["noise"].
+    quantiles : list
+        The quantiles of the ensemble to summarize it with.
+    n_jobs : int
+        The number of processes the members are spread over.
+        Default is 1.
+
+    Returns
+    -------
+    scenarios : numpy array
+        The (n_members, future, n_vars) scenario of each member.
+    summary : numpy array
+        The (len(quantiles), future, n_vars) quantiles of the
+        scenarios at each step.
+    """
+    if seeds is None:
+        seeds = (params['rand_seed'] or 1) + np.arange(n_members)
+    if noises is None:
+        noises = np.full(n_members, params['noise'])
+    assert(len(seeds) == n_members and len(noises) == n_members
+           ), "There must be one seed and noise per member."
+    assert(all(seeds)), "Seeds must be nonzero to be reproducible."
+
+    data = np.asarray(data)
+    n_vars = data.shape[1] if data.ndim > 1 else 1
+    members = [(k, int(seed), float(noise))
+               for k, (seed, noise) in enumerate(zip(seeds, noises))]
+
+    scenarios = np.empty((n_members, params['future'], n_vars))
+    if n_jobs > 1:
+        # a few tasks per worker balance the load without sending a
+        # task per member
+        tasks = [[members[k] for k in task] for task in
+                 np.array_split(range(n_members), 4 * n_jobs)
+                 if len(task) > 0]
+        with shared_pool(n_jobs, data=data) as executor:
+            futures = [executor.submit(_scenario_members, params, n_vars,
+                                       task)
+                       for task in tasks]
+            for future in as_completed(futures):
+                for k, scenario in future.result():
+                    scenarios[k] = scenario
+    else:
+        for k, seed, noise in members:
+            scenarios[k] = esn_scenario(data, dict(params, rand_seed=seed,
+                                                   noise=noise))[0]
+
+    summary = np.quantile(scenarios, quantiles, axis=0)
+
+    return scenarios, summary